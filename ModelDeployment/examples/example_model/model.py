@@ -14,6 +14,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import os
 import pickle
 
 
@@ -37,8 +38,20 @@ class Model:
 
         self.labels = lbl_list
 
-    def predict(self, file_path):
-        idx = int(len(file_path) * self.param_a / self.param_b) % len(self.labels)
+    # Whether predict() needs the image as a file. If not, the image is passed
+    # in memory.
+    requires_path = False
+
+    def predict(self, image):
+        """
+        :param image:   The image as bytes or memoryview, or, if requires_path
+                        is set, the path to the image
+        """
+        if isinstance(image, (bytes, bytearray, memoryview)):
+            size = memoryview(image).nbytes
+        else:
+            size = len(os.fspath(image))
+        idx = int(size * self.param_a / self.param_b) % len(self.labels)
         i = self.labels[idx]
         return i
 
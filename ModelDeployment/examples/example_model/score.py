@@ -17,14 +17,28 @@
 from azureml.contrib.services.aml_request import AMLRequest, rawhttp
 from azureml.contrib.services.aml_response import AMLResponse
 from model import Model
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import atexit
+import json
 import os
-import random
-import string
+import tempfile
+import threading
 
 
 model = None
 
+# Images of a multi-image request are handled in parallel
+pool = ThreadPoolExecutor(int(os.getenv('DECODE_WORKERS', 4)))
+
+# Images are passed to the model in memory. Only for models that require a
+# path, they are written to a scratch file, on tmpfs if available, so no disk
+# is involved.
+SCRATCH_DIR = os.getenv(
+    'SCRATCH_DIR',
+    '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+)
+_scratch = threading.local()
+
 
 def init():
     global model
@@ -35,30 +49,62 @@ def init():
     ))
 
 
-@rawhttp
-def run(request):
+def scratch_file(data):
     """
-    Perform inference on a single image, using the model.
+    Write data to the scratch file of the current thread. Every thread reuses
+    a single file, which is kept open.
 
     :param data:    Binary representation of the image
-    :returns:       AMLResponse
+    :returns:       Path to the file
     """
+    if not hasattr(_scratch, 'file'):
+        path = os.path.join(
+            SCRATCH_DIR, f'score-{os.getpid()}-{threading.get_ident()}')
+        _scratch.file = open(path, 'wb')
+        atexit.register(os.remove, path)
 
-    if request.method == 'POST':
-        data = request.get_data(False)
+    f = _scratch.file
+    f.seek(0)
+    f.truncate()
+    f.write(data)
+    f.flush()
+    return f.name
+
+
+def predict(data):
+    """
+    Perform inference on a single image.
+
+    :param data:    Binary representation of the image, as bytes or
+                    memoryview
+    :returns:       The prediction of the model
+    """
+    if model.requires_path:
+        return model.predict(scratch_file(data))
+    return model.predict(data)
 
-        # Open file and write binary data to file:
-        Path('tmp').mkdir(parents=True, exist_ok=True)
-        fname = 'tmp/' + \
-            ''.join(random.choice(string.ascii_lowercase) for i in range(32))
 
-        with open(fname, 'wb') as f:
-            f.write(data)
+@rawhttp
+def run(request):
+    """
+    Perform inference on a single image, using the model. Multiple images can
+    be sent at once as the parts of a multipart/form-data body, in which case
+    a JSON list with the prediction for each image is returned, in the order
+    of the parts.
 
-        result = model.predict(fname)
+    :param data:    Binary representation of the image
+    :returns:       AMLResponse
+    """
 
-        os.remove(fname)
+    if request.method == 'POST':
+        if request.mimetype == 'multipart/form-data':
+            images = [
+                f.read() for _, f in request.files.items(multi=True)
+            ]
+            result = list(pool.map(predict, images))
+            return AMLResponse(json.dumps(result), 200)
 
-        return AMLResponse(result, 200)
+        data = request.get_data(False)
+        return AMLResponse(predict(data), 200)
     else:
         return AMLResponse("Method not allowed", 405)
@@ -19,7 +19,7 @@ sys.path.insert(1, os.getcwd())
 
 import tensorflow as tf
 from yolov3.yolov4 import Create_Yolo
-from yolov3.utils import load_yolo_weights
+from yolov3.utils import load_yolo_weights, export_with_postprocessing
 from yolov3.configs import *
 
 if YOLO_TYPE == "yolov4":
@@ -38,3 +38,9 @@ yolo.summary()
 yolo.save(f'./checkpoints/{YOLO_TYPE}-{YOLO_INPUT_SIZE}')
 
 print(f"model saves to /checkpoints/{YOLO_TYPE}-{YOLO_INPUT_SIZE}")
+
+if YOLO_EXPORT_POSTPROCESS:
+    # Serving this model returns final boxes, without postprocessing in Python
+    export_with_postprocessing(yolo, f'./checkpoints/{YOLO_TYPE}-{YOLO_INPUT_SIZE}-postprocess', YOLO_INPUT_SIZE,
+                               TEST_SCORE_THRESHOLD, TEST_IOU_THRESHOLD, YOLO_EXPORT_MAX_BOXES)
+    print(f"model with postprocessing saves to /checkpoints/{YOLO_TYPE}-{YOLO_INPUT_SIZE}-postprocess")
@@ -0,0 +1,67 @@
+#================================================================
+#
+#   File name   : benchmark_dataset.py
+#   Description : compares the images per second of the Dataset
+#                 iterator to its tf.data pipeline and worker processes
+#
+#================================================================
+import os
+import sys
+
+foldername = os.path.basename(os.getcwd())
+if foldername == "tools":
+    os.chdir("..")
+sys.path.insert(1, os.getcwd())
+
+import time
+import argparse
+import itertools
+import tensorflow as tf
+from yolov3.dataset import Dataset
+from yolov3.loader import ProcessLoader
+from yolov3.configs import *
+
+
+def measure(batches, count):
+    # Returns the images per second over count batches, after a first batch
+    # that includes the start-up of the pipeline
+    images = 0
+    next(batches)
+    start = time.perf_counter()
+    for _ in range(count):
+        image_data, target = next(batches)
+        images += image_data.shape[0]
+    return images / (time.perf_counter() - start)
+
+
+def python_batches(dataset):
+    # The iterator of Dataset, without the tf.data pipeline
+    while True:
+        try:
+            yield dataset.__next__()
+        except StopIteration:
+            pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataset_type", default="train", choices=["train", "test"])
+    parser.add_argument("--batches", type=int, default=50)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    dataset = Dataset(args.dataset_type)
+    print(f"{dataset.num_samples} samples, batch size {dataset.batch_size}, "
+          f"augmentation {dataset.data_aug}, images in RAM {TRAIN_LOAD_IMAGES_TO_RAM}")
+
+    results = [
+        ("Dataset iterator", measure(python_batches(dataset), args.batches)),
+        ("tf.data pipeline", measure(iter(dataset.tf_dataset()), args.batches)),
+    ]
+    # Started after the others, so its workers do not compete with them
+    loader = ProcessLoader(dataset, args.workers, TRAIN_DATA_PREFETCH, TRAIN_DATA_SEED)
+    results.append((f"{args.workers} worker processes",
+                    measure(itertools.chain.from_iterable(itertools.repeat(loader)), args.batches)))
+    loader.close()
+    for name, images_per_second in results:
+        print(f"{name:20s} {images_per_second:8.1f} images/s")
@@ -0,0 +1,75 @@
+#================================================================
+#
+#   File name   : benchmark_preprocess.py
+#   Description : compares the allocations and time of the previous
+#                 image_preprocess() to letterbox() with a reused buffer
+#
+#================================================================
+import os
+import sys
+
+foldername = os.path.basename(os.getcwd())
+if foldername == "tools":
+    os.chdir("..")
+sys.path.insert(1, os.getcwd())
+
+import time
+import tracemalloc
+import cv2
+import numpy as np
+from yolov3.utils import letterbox
+
+
+def previous_preprocess(image, target_size):
+    # image_preprocess() as it was, followed by the copy and conversion the
+    # scoring script did
+    image = np.copy(image)
+    ih, iw    = target_size
+    h,  w, _  = image.shape
+
+    scale = min(iw/w, ih/h)
+    nw, nh  = int(scale * w), int(scale * h)
+    image_resized = cv2.resize(image, (nw, nh))
+
+    image_paded = np.full(shape=[ih, iw, 3], fill_value=128.0)
+    dw, dh = (iw - nw) // 2, (ih-nh) // 2
+    image_paded[dh:nh+dh, dw:nw+dw, :] = image_resized
+    image_paded = image_paded / 255.
+    return image_paded.astype(np.float32)
+
+
+def measure(func, iterations):
+    # Returns the time per call in ms, and the bytes allocated per call
+    func()
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    allocated = 0
+    start = time.perf_counter()
+    for _ in range(iterations):
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        func()
+        allocated += tracemalloc.get_traced_memory()[1] - before
+    elapsed = time.perf_counter() - start
+    tracemalloc.stop()
+    return elapsed / iterations * 1000, allocated / iterations
+
+
+if __name__ == "__main__":
+    iterations = 200
+    image = np.random.randint(0, 256, (1080, 1920, 3), dtype=np.uint8)
+
+    for input_size in [416, 608]:
+        target_size = [input_size, input_size]
+        buffer = np.empty((input_size, input_size, 3), dtype=np.float32)
+
+        expected = previous_preprocess(image, target_size)
+        assert np.array_equal(letterbox(image, target_size, buffer)[0], expected)
+
+        results = [
+            ("image_preprocess", measure(lambda: previous_preprocess(image, target_size), iterations)),
+            ("letterbox", measure(lambda: letterbox(image, target_size), iterations)),
+            ("letterbox, reused buffer", measure(lambda: letterbox(image, target_size, buffer), iterations)),
+        ]
+        for name, (ms, allocated) in results:
+            print(f"{input_size}: {name:25s} {ms:6.2f} ms, peak {allocated / 1024 ** 2:6.2f} MB allocated per image")
@@ -12,12 +12,13 @@ import os
 os.environ['CUDA_VISIBLE_DEVICES'] = '0'
 from tensorflow.python.client import device_lib
 print(device_lib.list_local_devices())
+import time
 import shutil
 import numpy as np
 import tensorflow as tf
 #from tensorflow.keras.utils import plot_model
 from .yolov3.dataset import Dataset
-from .yolov3.yolov4 import Create_Yolo, compute_loss
+from .yolov3.yolov4 import Create_Yolo, compute_loss, mixed_precision_policy, loss_scale_optimizer
 from .yolov3.utils import load_yolo_weights
 from .yolov3.configs import *
 from .evaluate_mAP import get_mAP
@@ -28,9 +29,114 @@ if YOLO_TYPE == "yolov3":
     Darknet_weights = YOLO_V3_TINY_WEIGHTS if TRAIN_YOLO_TINY else YOLO_V3_WEIGHTS
 if TRAIN_YOLO_TINY: TRAIN_MODEL_NAME += "_Tiny"
 
-def main(lr_init=None, lr_end=None, warmup_epochs=None, epochs=None):
+
+class WarmupCosineDecay(tf.keras.optimizers.schedules.LearningRateSchedule):
+    # Linear warmup to lr_init over warmup_steps, followed by a cosine decay
+    # to lr_end at total_steps
+    # about warmup: https://arxiv.org/pdf/1812.01187.pdf&usg=ALkJrhglKOPDjNt6SHGbphTHyMcT0cuMJg
+    def __init__(self, lr_init, lr_end, warmup_steps, total_steps):
+        super(WarmupCosineDecay, self).__init__()
+        self.lr_init = lr_init
+        self.lr_end = lr_end
+        self.warmup_steps = warmup_steps
+        self.total_steps = total_steps
+
+    def __call__(self, step):
+        # Steps count from 1, so the first step is not taken with a rate of 0
+        step = tf.cast(step, tf.float32) + 1
+        warmup = step / self.warmup_steps * self.lr_init
+        cosine = self.lr_end + 0.5 * (self.lr_init - self.lr_end)*(
+            (1 + tf.cos((step - self.warmup_steps) / (self.total_steps - self.warmup_steps) * np.pi)))
+        return tf.where(step < self.warmup_steps, warmup, cosine)
+
+    def get_config(self):
+        return {"lr_init": self.lr_init, "lr_end": self.lr_end,
+                "warmup_steps": self.warmup_steps, "total_steps": self.total_steps}
+
+
+def grouped_batches(dataset, steps):
+    # Groups the batches of an epoch by up to steps, as arrays of (steps, batch, ...). The batches are copied into
+    # buffers that are reused, as the batches of the worker processes are only valid until the next one. With a
+    # single step per call, the batches are passed on as they are.
+    if steps == 1:
+        yield from dataset
+        return
+    buffers, count = None, 0
+    for batch in dataset:
+        if buffers is None:
+            buffers = tf.nest.map_structure(lambda array: np.empty((steps,) + tuple(array.shape), np.float32), batch)
+        for buffer, array in zip(tf.nest.flatten(buffers), tf.nest.flatten(batch)):
+            buffer[count] = array
+        count += 1
+        if count == steps:
+            yield buffers
+            count = 0
+    if count > 0:
+        yield tf.nest.map_structure(lambda buffer: buffer[:count], buffers)
+
+
+def create_train_steps(yolo, optimizer, lr_schedule, global_steps, writer):
+    # Returns the tf.function that trains yolo on a batch, or on the batches stacked by grouped_batches(), and writes
+    # the summaries of the steps to writer.
+    # With TRAIN_JIT_COMPILE, a step is compiled by XLA, which fuses its ops. Summaries can not be compiled, so they
+    # are written outside of it.
+    @tf.function(experimental_compile=TRAIN_JIT_COMPILE)
+    def train_step(image_data, target):
+        with tf.GradientTape() as tape:
+            pred_result = yolo(image_data, training=True)
+            giou_loss=conf_loss=prob_loss=0
+
+            # optimizing process
+            grid = 3 if not TRAIN_YOLO_TINY else 2
+            for i in range(grid):
+                conv, pred = pred_result[i*2], pred_result[i*2+1]
+                loss_items = compute_loss(pred, conv, *target[i], i, CLASSES=TRAIN_CLASSES)
+                giou_loss += loss_items[0]
+                conf_loss += loss_items[1]
+                prob_loss += loss_items[2]
+
+            total_loss = giou_loss + conf_loss + prob_loss
+
+            if TRAIN_PRECISION == "mixed_float16":
+                scaled_gradients = tape.gradient(optimizer.get_scaled_loss(total_loss), yolo.trainable_variables)
+                gradients = optimizer.get_unscaled_gradients(scaled_gradients)
+            else:
+                gradients = tape.gradient(total_loss, yolo.trainable_variables)
+            optimizer.apply_gradients(zip(gradients, yolo.trainable_variables))
+            global_steps.assign_add(1)
+
+        return tf.stack([giou_loss, conf_loss, prob_loss, total_loss])
+
+    @tf.function
+    def train_steps(images, targets):
+        # A step for each of the stacked batches, unrolled in a single graph, so they run without returning to
+        # Python. A batch that is not stacked is a single step. Returns the mean of the losses.
+        if images.shape.rank == 4:
+            batches = [(images, targets)]
+        else:
+            batches = [(images[step], tf.nest.map_structure(lambda array: array[step], targets))
+                       for step in range(images.shape[0])]
+        losses = 0
+        for image_data, target in batches:
+            step_losses = train_step(image_data, target)
+            losses += step_losses
+
+            # writing summary data every TRAIN_SUMMARY_STEPS steps, the writer flushes them in the background
+            with writer.as_default(), tf.summary.record_if(global_steps % TRAIN_SUMMARY_STEPS == 0):
+                giou_loss, conf_loss, prob_loss, total_loss = tf.unstack(step_losses)
+                tf.summary.scalar("lr", lr_schedule(optimizer.iterations), step=global_steps)
+                tf.summary.scalar("loss/total_loss", total_loss, step=global_steps)
+                tf.summary.scalar("loss/giou_loss", giou_loss, step=global_steps)
+                tf.summary.scalar("loss/conf_loss", conf_loss, step=global_steps)
+                tf.summary.scalar("loss/prob_loss", prob_loss, step=global_steps)
+        return (global_steps, lr_schedule(optimizer.iterations)) + tuple(tf.unstack(losses / len(batches)))
+
+    return train_steps
+
+
+def main(lr_init=None, lr_end=None, warmup_epochs=None, epochs=None, precision=None, jit_compile=None):
     global TRAIN_FROM_CHECKPOINT, TRAIN_LR_INIT, TRAIN_LR_END, \
-        TRAIN_WARMUP_EPOCHS, TRAIN_EPOCHS
+        TRAIN_WARMUP_EPOCHS, TRAIN_EPOCHS, TRAIN_PRECISION, TRAIN_JIT_COMPILE
     if lr_init is not None:
         TRAIN_LR_INIT = lr_init
 
@@ -43,6 +149,16 @@ def main(lr_init=None, lr_end=None, warmup_epochs=None, epochs=None):
     if epochs is not None:
         TRAIN_EPOCHS = epochs
 
+    if precision is not None:
+        TRAIN_PRECISION = precision
+
+    if jit_compile is not None:
+        TRAIN_JIT_COMPILE = jit_compile
+
+    # The policy applies to all models created below
+    assert TRAIN_PRECISION in ["fp32", "mixed_float16", "mixed_bfloat16"]
+    mixed_precision_policy("float32" if TRAIN_PRECISION == "fp32" else TRAIN_PRECISION)
+
     gpus = tf.config.experimental.list_physical_devices('GPU')
     
     print(f'GPUs {gpus}')
@@ -82,78 +198,54 @@ def main(lr_init=None, lr_end=None, warmup_epochs=None, epochs=None):
                 except:
                     print("skipping", yolo.layers[i].name)
     
-    optimizer = tf.keras.optimizers.Adam()
-
+    # The learning rate is computed from the step in the graph, instead of
+    # being assigned after every step
+    lr_schedule = WarmupCosineDecay(TRAIN_LR_INIT, TRAIN_LR_END, warmup_steps, total_steps)
+    optimizer = tf.keras.optimizers.Adam(learning_rate=lr_schedule)
+    if TRAIN_PRECISION == "mixed_float16":
+        # Small float16 gradients underflow, unless the loss is scaled up
+        optimizer = loss_scale_optimizer(optimizer)
 
-    def train_step(image_data, target):
-        with tf.GradientTape() as tape:
-            pred_result = yolo(image_data, training=True)
-            giou_loss=conf_loss=prob_loss=0
-
-            # optimizing process
-            grid = 3 if not TRAIN_YOLO_TINY else 2
-            for i in range(grid):
-                conv, pred = pred_result[i*2], pred_result[i*2+1]
-                loss_items = compute_loss(pred, conv, *target[i], i, CLASSES=TRAIN_CLASSES)
-                giou_loss += loss_items[0]
-                conf_loss += loss_items[1]
-                prob_loss += loss_items[2]
-
-            total_loss = giou_loss + conf_loss + prob_loss
-
-            gradients = tape.gradient(total_loss, yolo.trainable_variables)
-            optimizer.apply_gradients(zip(gradients, yolo.trainable_variables))
-
-            # update learning rate
-            # about warmup: https://arxiv.org/pdf/1812.01187.pdf&usg=ALkJrhglKOPDjNt6SHGbphTHyMcT0cuMJg
-            global_steps.assign_add(1)
-            if global_steps < warmup_steps:# and not TRAIN_TRANSFER:
-                lr = global_steps / warmup_steps * TRAIN_LR_INIT
-            else:
-                lr = TRAIN_LR_END + 0.5 * (TRAIN_LR_INIT - TRAIN_LR_END)*(
-                    (1 + tf.cos((global_steps - warmup_steps) / (total_steps - warmup_steps) * np.pi)))
-            optimizer.lr.assign(lr.numpy())
 
-            # writing summary data
-            with writer.as_default():
-                tf.summary.scalar("lr", optimizer.lr, step=global_steps)
-                tf.summary.scalar("loss/total_loss", total_loss, step=global_steps)
-                tf.summary.scalar("loss/giou_loss", giou_loss, step=global_steps)
-                tf.summary.scalar("loss/conf_loss", conf_loss, step=global_steps)
-                tf.summary.scalar("loss/prob_loss", prob_loss, step=global_steps)
-            writer.flush()
-            
-        return global_steps.numpy(), optimizer.lr.numpy(), giou_loss.numpy(), conf_loss.numpy(), prob_loss.numpy(), total_loss.numpy()
+    train_steps = create_train_steps(yolo, optimizer, lr_schedule, global_steps, writer)
 
     validate_writer = tf.summary.create_file_writer(TRAIN_LOGDIR)
+    @tf.function(experimental_compile=TRAIN_JIT_COMPILE)
     def validate_step(image_data, target):
-        with tf.GradientTape() as tape:
-            pred_result = yolo(image_data, training=False)
-            giou_loss=conf_loss=prob_loss=0
+        pred_result = yolo(image_data, training=False)
+        giou_loss=conf_loss=prob_loss=0
 
-            # optimizing process
-            grid = 3 if not TRAIN_YOLO_TINY else 2
-            for i in range(grid):
-                conv, pred = pred_result[i*2], pred_result[i*2+1]
-                loss_items = compute_loss(pred, conv, *target[i], i, CLASSES=TRAIN_CLASSES)
-                giou_loss += loss_items[0]
-                conf_loss += loss_items[1]
-                prob_loss += loss_items[2]
+        # optimizing process
+        grid = 3 if not TRAIN_YOLO_TINY else 2
+        for i in range(grid):
+            conv, pred = pred_result[i*2], pred_result[i*2+1]
+            loss_items = compute_loss(pred, conv, *target[i], i, CLASSES=TRAIN_CLASSES)
+            giou_loss += loss_items[0]
+            conf_loss += loss_items[1]
+            prob_loss += loss_items[2]
 
-            total_loss = giou_loss + conf_loss + prob_loss
-            
-        return giou_loss.numpy(), conf_loss.numpy(), prob_loss.numpy(), total_loss.numpy()
+        total_loss = giou_loss + conf_loss + prob_loss
+
+        return giou_loss, conf_loss, prob_loss, total_loss
 
     mAP_model = Create_Yolo(input_size=YOLO_INPUT_SIZE, CLASSES=TRAIN_CLASSES) # create second model to measure mAP
 
     best_val_loss = 1000 # should be large at start
+    epoch_images_per_second = []
     for epoch in range(TRAIN_EPOCHS):
-        for image_data, target in trainset:
-            results = train_step(image_data, target)
+        epoch_start = time.perf_counter()
+        for images, targets in grouped_batches(trainset, TRAIN_STEPS_PER_CALL):
+            results = [result.numpy() for result in train_steps(images, targets)]
             cur_step = results[0]%steps_per_epoch
             print("epoch:{:2.0f} step:{:5.0f}/{}, lr:{:.6f}, giou_loss:{:7.2f}, conf_loss:{:7.2f}, prob_loss:{:7.2f}, total_loss:{:7.2f}"
                   .format(epoch, cur_step, steps_per_epoch, results[1], results[2], results[3], results[4], results[5]))
 
+        writer.flush()
+        # Training throughput, including the loading of the batches
+        epoch_images_per_second.append(steps_per_epoch * trainset.batch_size / (time.perf_counter() - epoch_start))
+        print("epoch:{:2.0f} {:.1f} images/s ({}, XLA {})".format(
+            epoch, epoch_images_per_second[-1], TRAIN_PRECISION, "on" if TRAIN_JIT_COMPILE else "off"))
+
         if len(testset) == 0:
             print("configure TEST options to validate model")
             yolo.save_weights(os.path.join(TRAIN_CHECKPOINTS_FOLDER, TRAIN_MODEL_NAME))
@@ -161,7 +253,7 @@ def main(lr_init=None, lr_end=None, warmup_epochs=None, epochs=None):
         
         count, giou_val, conf_val, prob_val, total_val = 0., 0, 0, 0, 0
         for image_data, target in testset:
-            results = validate_step(image_data, target)
+            results = [result.numpy() for result in validate_step(image_data, target)]
             count += 1
             giou_val += results[0]
             conf_val += results[1]
@@ -189,9 +281,13 @@ def main(lr_init=None, lr_end=None, warmup_epochs=None, epochs=None):
             save_directory = os.path.join(TRAIN_CHECKPOINTS_FOLDER, TRAIN_MODEL_NAME)
             yolo.save_weights(save_directory)
 
+    # The first epoch includes tracing and compiling the steps, so it only counts if it is the only one
+    images_per_second = np.mean(epoch_images_per_second[1:] or epoch_images_per_second)
+
     # measure mAP of trained custom model
     mAP_model.load_weights(save_directory) # use keras weights
-    return get_mAP(mAP_model, testset, score_threshold=TEST_SCORE_THRESHOLD, iou_threshold=TEST_IOU_THRESHOLD)
+    mAP, fps = get_mAP(mAP_model, testset, score_threshold=TEST_SCORE_THRESHOLD, iou_threshold=TEST_IOU_THRESHOLD)
+    return mAP, fps, images_per_second
 
 if __name__ == '__main__':
     main()
@@ -25,6 +25,8 @@ YOLO_IOU_LOSS_THRESH        = 0.5
 YOLO_ANCHOR_PER_SCALE       = 3
 YOLO_MAX_BBOX_PER_SCALE     = 100
 YOLO_INPUT_SIZE             = 416
+YOLO_EXPORT_POSTPROCESS     = False # tools/Convert_to_pb.py also exports a model with score filtering and NMS in the graph
+YOLO_EXPORT_MAX_BOXES       = 100 # maximum number of boxes per image returned by that model
 if YOLO_TYPE                == "yolov4":
     YOLO_ANCHORS            = [[[12,  16], [19,   36], [40,   28]],
                                [[36,  75], [76,   55], [72,  146]],
@@ -43,7 +45,12 @@ TRAIN_LOGDIR                = "logs/yolo/"
 TRAIN_CHECKPOINTS_FOLDER    = "outputs/checkpoint/"
 TRAIN_MODEL_NAME            = f"{YOLO_TYPE}_custom"
 TRAIN_LOAD_IMAGES_TO_RAM    = True # With True faster training, but need more RAM
+TRAIN_IMAGE_STORE_DIR       = "cache/yolo/" # images loaded to RAM are packed into a memory mapped file in this folder
 TRAIN_BATCH_SIZE            = 4
+TRAIN_TF_DATA               = False # produce batches with a tf.data pipeline, loading samples in parallel and prefetching batches
+TRAIN_DATA_WORKERS          = 0 # with more than 0, produce batches in this number of worker processes instead (Linux only)
+TRAIN_DATA_SEED             = 0 # seed of the shuffling and augmentation of the tf.data pipeline or workers, None for a different order every run
+TRAIN_DATA_PREFETCH         = 2 # number of batches the tf.data pipeline or workers prepare ahead
 TRAIN_INPUT_SIZE            = 416
 TRAIN_DATA_AUG              = True
 TRAIN_TRANSFER              = True
@@ -52,6 +59,10 @@ TRAIN_LR_INIT               = 1e-4
 TRAIN_LR_END                = 1e-6
 TRAIN_WARMUP_EPOCHS         = 2
 TRAIN_EPOCHS                = 100
+TRAIN_STEPS_PER_CALL        = 1 # training steps run in a single call of the graph, more steps give less Python overhead but a larger graph
+TRAIN_SUMMARY_STEPS         = 10 # write the learning rate and losses to Tensorboard every this number of steps
+TRAIN_PRECISION             = "fp32" # "fp32", "mixed_float16" (GPU, with loss scaling) or "mixed_bfloat16" (TPU, recent CPUs)
+TRAIN_JIT_COMPILE           = False # compile the training and validation steps with XLA
 
 # TEST options
 TEST_ANNOT_PATH             = "outputs/test.txt"
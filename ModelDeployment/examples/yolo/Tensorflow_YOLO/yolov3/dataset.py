@@ -10,15 +10,92 @@
 #================================================================
 # TODO: transfer numpy to tensorflow operations
 import os
+import hashlib
+import itertools
 import cv2
 import random
 import numpy as np
 import tensorflow as tf
 from .utils import read_class_names, image_preprocess
-from .yolov3 import bbox_iou
+from .loader import ProcessLoader
 from .configs import *
 
 
+def read_image(image_path):
+    # Images prepared as .npy arrays (see resize_images() in utils.py) are
+    # stored in the same BGR order as cv2.imread returns
+    if image_path.endswith('.npy'):
+        return np.load(image_path)
+    return cv2.imread(image_path)
+
+
+def load_image_store(image_paths):
+    # Decoded images are packed into a single file, which is memory mapped.
+    # Every image is a read-only view into that file, so its pages are shared
+    # through the page cache by all Datasets and processes using the same
+    # images, and the images are decoded only once.
+    image_paths = sorted(set(image_paths))
+    if not image_paths:
+        return {}
+
+    # The store is identified by the paths, sizes and modification times of
+    # the images, so it is rebuilt when any of them changes
+    signature = hashlib.md5()
+    for image_path in image_paths:
+        stat = os.stat(image_path)
+        signature.update(f"{image_path}\0{stat.st_size}\0{stat.st_mtime}\n".encode())
+    store_path = os.path.join(TRAIN_IMAGE_STORE_DIR, signature.hexdigest())
+
+    if not os.path.exists(store_path + '.npz'):
+        os.makedirs(TRAIN_IMAGE_STORE_DIR, exist_ok=True)
+        offsets = np.zeros(len(image_paths) + 1, dtype=np.int64)
+        shapes = np.zeros((len(image_paths), 3), dtype=np.int64)
+
+        # The index is written last, so a store without index is incomplete
+        tmp_path = f"{store_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            for i, image_path in enumerate(image_paths):
+                image = read_image(image_path)
+                if image is None:
+                    raise KeyError("%s could not be read ... " %image_path)
+                shapes[i] = image.shape
+                f.write(np.ascontiguousarray(image, dtype=np.uint8).tobytes())
+                offsets[i + 1] = f.tell()
+        os.replace(tmp_path, store_path + '.bin')
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, offsets=offsets, shapes=shapes)
+        os.replace(tmp_path, store_path + '.npz')
+
+    index = np.load(store_path + '.npz')
+    offsets, shapes = index['offsets'], index['shapes']
+    blob = np.memmap(store_path + '.bin', dtype=np.uint8, mode='r')
+    return {
+        image_path: blob[offsets[i]:offsets[i + 1]].reshape(shapes[i])
+        for i, image_path in enumerate(image_paths)
+    }
+
+
+def anchor_iou(boxes1, boxes2):
+    # NumPy version of bbox_iou(), for (x, y, w, h) boxes of any shape
+    boxes1_area = boxes1[..., 2] * boxes1[..., 3]
+    boxes2_area = boxes2[..., 2] * boxes2[..., 3]
+
+    boxes1 = np.concatenate([boxes1[..., :2] - boxes1[..., 2:] * 0.5,
+                             boxes1[..., :2] + boxes1[..., 2:] * 0.5], axis=-1)
+    boxes2 = np.concatenate([boxes2[..., :2] - boxes2[..., 2:] * 0.5,
+                             boxes2[..., :2] + boxes2[..., 2:] * 0.5], axis=-1)
+
+    left_up = np.maximum(boxes1[..., :2], boxes2[..., :2])
+    right_down = np.minimum(boxes1[..., 2:], boxes2[..., 2:])
+
+    inter_section = np.maximum(right_down - left_up, 0.0)
+    inter_area = inter_section[..., 0] * inter_section[..., 1]
+    union_area = boxes1_area + boxes2_area - inter_area
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return 1.0 * inter_area / union_area
+
+
 class Dataset(object):
     # Dataset preprocess implementation
     def __init__(self, dataset_type, TEST_INPUT_SIZE=TEST_INPUT_SIZE):
@@ -40,6 +117,11 @@ class Dataset(object):
         self.num_batchs = int(np.ceil(self.num_samples / self.batch_size))
         self.batch_count = 0
 
+        self.train_input_size = self.train_input_sizes
+        self.train_output_sizes = self.train_input_size // self.strides
+        self.loader = None
+        self.tf_batches = None
+
 
     def load_annotations(self, dataset_type):
         final_annotations = []
@@ -61,16 +143,69 @@ class Dataset(object):
                     break
             if not os.path.exists(image_path):
                 raise KeyError("%s does not exist ... " %image_path)
-            if TRAIN_LOAD_IMAGES_TO_RAM:
-                image = cv2.imread(image_path)
-            else:
-                image = ''
-            final_annotations.append([image_path, line[index:], image])
+            final_annotations.append([image_path, line[index:], ''])
+
+        if TRAIN_LOAD_IMAGES_TO_RAM:
+            images = load_image_store([a[0] for a in final_annotations])
+            for annotation in final_annotations:
+                annotation[2] = images[annotation[0]]
         return final_annotations
 
     def __iter__(self):
+        if TRAIN_DATA_WORKERS > 0:
+            # The workers are started once, and keep running between epochs
+            if self.loader is None:
+                self.loader = ProcessLoader(self, TRAIN_DATA_WORKERS, TRAIN_DATA_PREFETCH, TRAIN_DATA_SEED)
+            return iter(self.loader)
+        if TRAIN_TF_DATA:
+            # The pipeline is built once, every epoch takes the next batches
+            # of its stream, so epochs do not repeat the order and
+            # augmentation of the first one
+            if self.tf_batches is None:
+                self.tf_batches = iter(self.tf_dataset())
+            return itertools.islice(self.tf_batches, self.num_batchs)
         return self
 
+    def tf_dataset(self, seed=TRAIN_DATA_SEED):
+        # The batches __next__ produces, as an endless stream from a tf.data
+        # pipeline. Samples are loaded by parallel calls, and batches are
+        # prefetched while the model trains. The order of the samples, and
+        # their augmentation, only depend on the seed.
+        image_shape = (self.input_sizes, self.input_sizes, 3)
+        label_shapes = [(size, size, self.anchor_per_scale, 5 + self.num_classes) for size in self.train_output_sizes]
+        bboxes_shape = (self.max_bbox_per_scale, 4)
+
+        def load(index, sample_seed):
+            sample = tf.numpy_function(self.load_sample, [index, sample_seed], [tf.float32] * 7)
+            for tensor, shape in zip(sample, [image_shape] + label_shapes + [bboxes_shape] * 3):
+                tensor.set_shape(shape)
+            image, label_sbbox, label_mbbox, label_lbbox, sbboxes, mbboxes, lbboxes = sample
+            return image, ((label_sbbox, sbboxes), (label_mbbox, mbboxes), (label_lbbox, lbboxes))
+
+        # Every pass over the samples is shuffled differently. Like __next__,
+        # the last batch of a pass is filled up with samples from the next one.
+        indices = tf.data.Dataset.range(self.num_samples)
+        indices = indices.shuffle(self.num_samples, seed=seed, reshuffle_each_iteration=True)
+        indices = indices.repeat()
+        sample_seeds = tf.data.experimental.RandomDataset(seed)
+
+        dataset = tf.data.Dataset.zip((indices, sample_seeds))
+        dataset = dataset.map(load, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        return dataset.batch(self.batch_size).prefetch(TRAIN_DATA_PREFETCH)
+
+    def load_sample(self, index, seed):
+        # Load, augment and preprocess a single sample, with its own random
+        # generator, so the result does not depend on the thread it runs on
+        annotation = self.annotations[index]
+        image, bboxes = self.parse_annotation(annotation, rng=random.Random(int(seed)))
+        try:
+            targets = self.preprocess_true_boxes(bboxes)
+        except IndexError:
+            self.Delete_bad_annotation(annotation)
+            print("IndexError, something wrong with", annotation[0], "removed this line from annotation file")
+            raise Exception("There were problems with dataset, I fixed them, now restart the training process.")
+        return [image.astype(np.float32)] + list(targets)
+
     def Delete_bad_annotation(self, bad_annotation):
         print(f'Deleting {bad_annotation} annotation line')
         bad_image_path = bad_annotation[0]
@@ -142,16 +277,16 @@ class Dataset(object):
                 np.random.shuffle(self.annotations)
                 raise StopIteration
 
-    def random_horizontal_flip(self, image, bboxes):
-        if random.random() < 0.5:
+    def random_horizontal_flip(self, image, bboxes, rng=random):
+        if rng.random() < 0.5:
             _, w, _ = image.shape
             image = image[:, ::-1, :]
             bboxes[:, [0,2]] = w - bboxes[:, [2,0]]
 
         return image, bboxes
 
-    def random_crop(self, image, bboxes):
-        if random.random() < 0.5:
+    def random_crop(self, image, bboxes, rng=random):
+        if rng.random() < 0.5:
             h, w, _ = image.shape
             max_bbox = np.concatenate([np.min(bboxes[:, 0:2], axis=0), np.max(bboxes[:, 2:4], axis=0)], axis=-1)
 
@@ -160,10 +295,10 @@ class Dataset(object):
             max_r_trans = w - max_bbox[2]
             max_d_trans = h - max_bbox[3]
 
-            crop_xmin = max(0, int(max_bbox[0] - random.uniform(0, max_l_trans)))
-            crop_ymin = max(0, int(max_bbox[1] - random.uniform(0, max_u_trans)))
-            crop_xmax = max(w, int(max_bbox[2] + random.uniform(0, max_r_trans)))
-            crop_ymax = max(h, int(max_bbox[3] + random.uniform(0, max_d_trans)))
+            crop_xmin = max(0, int(max_bbox[0] - rng.uniform(0, max_l_trans)))
+            crop_ymin = max(0, int(max_bbox[1] - rng.uniform(0, max_u_trans)))
+            crop_xmax = max(w, int(max_bbox[2] + rng.uniform(0, max_r_trans)))
+            crop_ymax = max(h, int(max_bbox[3] + rng.uniform(0, max_d_trans)))
 
             image = image[crop_ymin : crop_ymax, crop_xmin : crop_xmax]
 
@@ -172,8 +307,8 @@ class Dataset(object):
 
         return image, bboxes
 
-    def random_translate(self, image, bboxes):
-        if random.random() < 0.5:
+    def random_translate(self, image, bboxes, rng=random):
+        if rng.random() < 0.5:
             h, w, _ = image.shape
             max_bbox = np.concatenate([np.min(bboxes[:, 0:2], axis=0), np.max(bboxes[:, 2:4], axis=0)], axis=-1)
 
@@ -182,8 +317,8 @@ class Dataset(object):
             max_r_trans = w - max_bbox[2]
             max_d_trans = h - max_bbox[3]
 
-            tx = random.uniform(-(max_l_trans - 1), (max_r_trans - 1))
-            ty = random.uniform(-(max_u_trans - 1), (max_d_trans - 1))
+            tx = rng.uniform(-(max_l_trans - 1), (max_r_trans - 1))
+            ty = rng.uniform(-(max_u_trans - 1), (max_d_trans - 1))
 
             M = np.array([[1, 0, tx], [0, 1, ty]])
             image = cv2.warpAffine(image, M, (w, h))
@@ -193,20 +328,20 @@ class Dataset(object):
 
         return image, bboxes
 
-    def parse_annotation(self, annotation, mAP = 'False'):
+    def parse_annotation(self, annotation, mAP = 'False', rng=random):
         if TRAIN_LOAD_IMAGES_TO_RAM:
             image_path = annotation[0]
             image = annotation[2]
         else:
             image_path = annotation[0]
-            image = cv2.imread(image_path)
+            image = read_image(image_path)
             
         bboxes = np.array([list(map(int, box.split(','))) for box in annotation[1]])
 
         if self.data_aug:
-            image, bboxes = self.random_horizontal_flip(np.copy(image), np.copy(bboxes))
-            image, bboxes = self.random_crop(np.copy(image), np.copy(bboxes))
-            image, bboxes = self.random_translate(np.copy(image), np.copy(bboxes))
+            image, bboxes = self.random_horizontal_flip(np.copy(image), np.copy(bboxes), rng)
+            image, bboxes = self.random_crop(np.copy(image), np.copy(bboxes), rng)
+            image, bboxes = self.random_translate(np.copy(image), np.copy(bboxes), rng)
 
         #image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
         if mAP == True: 
@@ -216,63 +351,57 @@ class Dataset(object):
         return image, bboxes
 
     def preprocess_true_boxes(self, bboxes):
+        # Assigns all boxes to the anchors of all scales at once, with a matrix
+        # of the IoU of every box with the anchors at its grid cell. A box
+        # goes to the anchors it overlaps by more than 0.3, or else to the
+        # single best anchor of any scale. Where boxes share an anchor, the
+        # last box wins, like writing the boxes one by one.
+        bboxes = np.asarray(bboxes).reshape(-1, 5)
         label = [np.zeros((self.train_output_sizes[i], self.train_output_sizes[i], self.anchor_per_scale,
-                           5 + self.num_classes)) for i in range(3)]
-        bboxes_xywh = [np.zeros((self.max_bbox_per_scale, 4)) for _ in range(3)]
-        bbox_count = np.zeros((3,))
-
-        for bbox in bboxes:
-            bbox_coor = bbox[:4]
-            bbox_class_ind = bbox[4]
-
-            onehot = np.zeros(self.num_classes, dtype=np.float)
-            onehot[bbox_class_ind] = 1.0
-            uniform_distribution = np.full(self.num_classes, 1.0 / self.num_classes)
-            deta = 0.01
-            smooth_onehot = onehot * (1 - deta) + deta * uniform_distribution
-
-            bbox_xywh = np.concatenate([(bbox_coor[2:] + bbox_coor[:2]) * 0.5, bbox_coor[2:] - bbox_coor[:2]], axis=-1)
-            bbox_xywh_scaled = 1.0 * bbox_xywh[np.newaxis, :] / self.strides[:, np.newaxis]
-
-            iou = []
-            exist_positive = False
-            for i in range(3):
-                anchors_xywh = np.zeros((self.anchor_per_scale, 4))
-                anchors_xywh[:, 0:2] = np.floor(bbox_xywh_scaled[i, 0:2]).astype(np.int32) + 0.5
-                anchors_xywh[:, 2:4] = self.anchors[i]
-
-                iou_scale = bbox_iou(bbox_xywh_scaled[i][np.newaxis, :], anchors_xywh)
-                iou.append(iou_scale)
-                iou_mask = iou_scale > 0.3
-
-                if np.any(iou_mask):
-                    xind, yind = np.floor(bbox_xywh_scaled[i, 0:2]).astype(np.int32)
-
-                    label[i][yind, xind, iou_mask, :] = 0
-                    label[i][yind, xind, iou_mask, 0:4] = bbox_xywh
-                    label[i][yind, xind, iou_mask, 4:5] = 1.0
-                    label[i][yind, xind, iou_mask, 5:] = smooth_onehot
-
-                    bbox_ind = int(bbox_count[i] % self.max_bbox_per_scale)
-                    bboxes_xywh[i][bbox_ind, :4] = bbox_xywh
-                    bbox_count[i] += 1
-
-                    exist_positive = True
-
-            if not exist_positive:
-                best_anchor_ind = np.argmax(np.array(iou).reshape(-1), axis=-1)
-                best_detect = int(best_anchor_ind / self.anchor_per_scale)
-                best_anchor = int(best_anchor_ind % self.anchor_per_scale)
-                xind, yind = np.floor(bbox_xywh_scaled[best_detect, 0:2]).astype(np.int32)
-
-                label[best_detect][yind, xind, best_anchor, :] = 0
-                label[best_detect][yind, xind, best_anchor, 0:4] = bbox_xywh
-                label[best_detect][yind, xind, best_anchor, 4:5] = 1.0
-                label[best_detect][yind, xind, best_anchor, 5:] = smooth_onehot
-
-                bbox_ind = int(bbox_count[best_detect] % self.max_bbox_per_scale)
-                bboxes_xywh[best_detect][bbox_ind, :4] = bbox_xywh
-                bbox_count[best_detect] += 1
+                           5 + self.num_classes), dtype=np.float32) for i in range(3)]
+        bboxes_xywh = [np.zeros((self.max_bbox_per_scale, 4), dtype=np.float32) for _ in range(3)]
+
+        bbox_coor = bboxes[:, :4]
+        bbox_xywh = np.concatenate([(bbox_coor[:, 2:] + bbox_coor[:, :2]) * 0.5, bbox_coor[:, 2:] - bbox_coor[:, :2]], axis=-1)
+        # (scale, box, 4), and the grid cell of every box at every scale
+        bbox_xywh_scaled = 1.0 * bbox_xywh[np.newaxis, :, :] / self.strides[:, np.newaxis, np.newaxis]
+        grid_xy = np.floor(bbox_xywh_scaled[..., 0:2]).astype(np.int32)
+
+        # (scale, box, anchor)
+        anchors_xy = np.repeat(grid_xy[:, :, np.newaxis, :] + 0.5, self.anchor_per_scale, axis=2)
+        anchors_wh = np.broadcast_to(self.anchors[:, np.newaxis, :, :], anchors_xy.shape)
+        iou = anchor_iou(bbox_xywh_scaled[:, :, np.newaxis, :], np.concatenate([anchors_xy, anchors_wh], axis=-1))
+        assigned = iou > 0.3
+
+        no_positive = np.flatnonzero(~assigned.any(axis=(0, 2)))
+        best_anchor_ind = np.argmax(iou[:, no_positive].transpose(1, 0, 2).reshape(len(no_positive), 3 * self.anchor_per_scale), axis=-1)
+        assigned[best_anchor_ind // self.anchor_per_scale, no_positive, best_anchor_ind % self.anchor_per_scale] = True
+
+        deta = 0.01
+        onehot = np.zeros((len(bboxes), self.num_classes), dtype=np.float64)
+        onehot[np.arange(len(bboxes)), bboxes[:, 4].astype(np.int64)] = 1.0
+        smooth_onehot = onehot * (1 - deta) + deta * np.full(self.num_classes, 1.0 / self.num_classes)
+        rows = np.concatenate([bbox_xywh, np.ones((len(bboxes), 1)), smooth_onehot], axis=-1)
+
+        for i in range(3):
+            box_ind, anchor_ind = np.nonzero(assigned[i])
+            xind, yind = grid_xy[i, box_ind, 0], grid_xy[i, box_ind, 1]
+            # Indices out of the grid raise an IndexError, like indexing the
+            # label with them, negative ones count from the end
+            size = self.train_output_sizes[i]
+            if np.any((xind < -size) | (xind >= size) | (yind < -size) | (yind >= size)):
+                raise IndexError(f"box outside of the {size}x{size} grid")
+            cell = (yind % size * size + xind % size) * self.anchor_per_scale + anchor_ind
+            _, last = np.unique(cell[::-1], return_index=True)
+            last = len(cell) - 1 - last
+            label[i][yind[last], xind[last], anchor_ind[last]] = rows[box_ind[last]]
+
+            # The boxes of a scale are kept in a ring of max_bbox_per_scale,
+            # of which only the last ones remain
+            box_ind = np.flatnonzero(assigned[i].any(axis=-1))
+            bbox_ind = np.arange(len(box_ind)) % self.max_bbox_per_scale
+            bboxes_xywh[i][bbox_ind[-self.max_bbox_per_scale:]] = bbox_xywh[box_ind[-self.max_bbox_per_scale:]]
+
         label_sbbox, label_mbbox, label_lbbox = label
         sbboxes, mbboxes, lbboxes = bboxes_xywh
         return label_sbbox, label_mbbox, label_lbbox, sbboxes, mbboxes, lbboxes
@@ -0,0 +1,203 @@
+#================================================================
+#
+#   File name   : nms.py
+#   Description : vectorized hard and soft non-max suppression
+#
+#================================================================
+import numpy as np
+
+
+def _iou(boxes1, boxes2):
+    # Pairwise IoU of two sets of boxes, like utils.bboxes_iou(), but of
+    # (len(boxes1), len(boxes2)). Works on one coordinate at a time, which is
+    # faster for large sets than broadcasting over the last axis.
+    x1, y1, x2, y2 = [boxes1[:, i, np.newaxis] for i in range(4)]
+    bx1, by1, bx2, by2 = [boxes2[:, i] for i in range(4)]
+    boxes1_area = (x2 - x1) * (y2 - y1)
+    boxes2_area = (bx2 - bx1) * (by2 - by1)
+
+    inter_w       = np.maximum(np.minimum(x2, bx2) - np.maximum(x1, bx1), 0.0)
+    inter_h       = np.maximum(np.minimum(y2, by2) - np.maximum(y1, by1), 0.0)
+    inter_area    = inter_w * inter_h
+    union_area    = boxes1_area + boxes2_area - inter_area
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.maximum(1.0 * inter_area / union_area, np.finfo(np.float32).eps)
+
+
+def _sort_by_class(bboxes):
+    # Sort the candidates once, by class, in the order of set(classes) like
+    # the per-class loop of the original nms(), then by descending score. The
+    # sort is stable, so equal scores keep their order, like np.argmax() picks
+    # the first. Returns the order and the start of every class in it.
+    classes_in_img = list(set(bboxes[:, 5]))
+    rank = {cls: i for i, cls in enumerate(classes_in_img)}
+    class_rank = np.array([rank[cls] for cls in bboxes[:, 5]])
+    order = np.lexsort((-bboxes[:, 4], class_rank))
+    starts = np.searchsorted(class_rank[order], np.arange(len(classes_in_img) + 1))
+    return order, starts
+
+
+def hard_nms(bboxes, iou_threshold, block_size=64):
+    """
+    :param bboxes: (xmin, ymin, xmax, ymax, score, class)
+    :returns: indices of the kept boxes, ordered by class, then score
+
+    After sorting, a box is kept if none of the kept boxes before it overlaps
+    it by more than iou_threshold. The overlaps are computed as matrix for a
+    block of boxes at a time, only for boxes that are not suppressed yet.
+    """
+    order, starts = _sort_by_class(bboxes)
+    keep = []
+
+    for start, end in zip(starts[:-1], starts[1:]):
+        idx = order[start:end]
+        boxes = bboxes[idx, :4]
+        # Like the original nms(), the best box of a class is kept even if its
+        # score is not positive, and boxes with such scores are dropped
+        alive = bboxes[idx, 4] > 0.
+        alive[0] = True
+
+        for block in range(0, len(idx), block_size):
+            rows = np.flatnonzero(alive[block:block + block_size]) + block
+            if len(rows) == 0:
+                continue
+            # Only boxes that are not suppressed yet can still be suppressed
+            cols = np.flatnonzero(alive[block:]) + block
+            suppresses = _iou(boxes[rows], boxes[cols]) > iou_threshold
+
+            # Within the block, boxes are decided one by one. The boxes kept
+            # in the block then suppress the later blocks at once.
+            in_block = np.searchsorted(cols, block + block_size)
+            kept = []
+            for i, row in enumerate(rows):
+                if alive[row]:
+                    kept.append(i)
+                    keep.append(idx[row])
+                    # rows are the first columns, so row i is column i
+                    alive[cols[i + 1:in_block]] &= ~suppresses[i, i + 1:in_block]
+            alive[cols[in_block:]] &= ~suppresses[kept, in_block:].any(axis=0)
+
+    return np.array(keep, dtype=np.int64)
+
+
+def soft_nms(bboxes, sigma=0.3, max_matrix_size=4096):
+    """
+    :param bboxes: (xmin, ymin, xmax, ymax, score, class)
+    :returns: the kept boxes, with decayed scores, ordered by class, then
+              score
+
+    Note: soft-nms, https://arxiv.org/pdf/1704.04503.pdf
+    Decaying changes the order of the scores, so the best box is looked up
+    again after every step. Instead of rebuilding the candidates, picked and
+    dropped boxes get a score of -inf, and the decays within a class are
+    computed once, for classes of at most max_matrix_size candidates.
+    """
+    order, starts = _sort_by_class(bboxes)
+    best_bboxes = []
+
+    for start, end in zip(starts[:-1], starts[1:]):
+        # Keep the original order within the class, for the order of picks
+        idx = np.sort(order[start:end])
+        cls_bboxes = bboxes[idx]
+        scores = cls_bboxes[:, 4].copy()
+        decays = None
+        if len(idx) <= max_matrix_size:
+            iou = _iou(cls_bboxes[:, :4], cls_bboxes[:, :4])
+            decays = np.exp(-(1.0 * iou ** 2 / sigma))
+
+        while True:
+            best = np.argmax(scores)
+            if scores[best] == -np.inf:
+                break
+            best_bboxes.append(cls_bboxes[best])
+            best_bboxes[-1][4] = scores[best]
+            scores[best] = -np.inf
+
+            if decays is None:
+                iou = _iou(cls_bboxes[best:best + 1, :4], cls_bboxes[:, :4])[0]
+                decay = np.exp(-(1.0 * iou ** 2 / sigma))
+            else:
+                decay = decays[best]
+            scores *= decay
+            scores[~(scores > 0.)] = -np.inf
+
+    return np.array(best_bboxes).reshape(-1, 6)
+
+
+def nms(bboxes, iou_threshold, sigma=0.3, method='nms'):
+    """
+    :param bboxes: (xmin, ymin, xmax, ymax, score, class)
+    :returns: array of the kept boxes, ordered by class, then score
+    """
+    assert method in ['nms', 'soft-nms']
+    bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 6)
+
+    if method == 'nms':
+        return bboxes[hard_nms(bboxes, iou_threshold)]
+    return soft_nms(bboxes, sigma)
+
+
+def _nms_loop(bboxes, iou_threshold, sigma=0.3, method='nms'):
+    # The original implementation of utils.nms(), to compare against
+    classes_in_img = list(set(bboxes[:, 5]))
+    best_bboxes = []
+
+    for cls in classes_in_img:
+        cls_mask = (bboxes[:, 5] == cls)
+        cls_bboxes = bboxes[cls_mask]
+        while len(cls_bboxes) > 0:
+            max_ind = np.argmax(cls_bboxes[:, 4])
+            best_bbox = cls_bboxes[max_ind]
+            best_bboxes.append(best_bbox)
+            cls_bboxes = np.concatenate([cls_bboxes[: max_ind], cls_bboxes[max_ind + 1:]])
+            iou = _iou(best_bbox[np.newaxis, :4], cls_bboxes[:, :4])[0]
+            weight = np.ones((len(iou),), dtype=np.float32)
+
+            if method == 'nms':
+                iou_mask = iou > iou_threshold
+                weight[iou_mask] = 0.0
+
+            if method == 'soft-nms':
+                weight = np.exp(-(1.0 * iou ** 2 / sigma))
+
+            cls_bboxes[:, 4] = cls_bboxes[:, 4] * weight
+            score_mask = cls_bboxes[:, 4] > 0.
+            cls_bboxes = cls_bboxes[score_mask]
+
+    return np.array(best_bboxes).reshape(-1, 6)
+
+
+def _random_candidates(count, num_classes=10, image_size=608, spread=0.15, seed=0):
+    # Candidates clustered around a few objects, like the output of the
+    # model with a low score threshold. A larger spread gives candidates
+    # that overlap less, so more of them are kept.
+    rng = np.random.RandomState(seed)
+    objects = max(1, count // 50)
+    centers = rng.uniform(0, image_size, (objects, 2))
+    sizes = rng.uniform(10, 120, (objects, 2))
+    obj = rng.randint(objects, size=count)
+    xy = centers[obj] + rng.normal(0, spread, (count, 2)) * sizes[obj]
+    wh = sizes[obj] * np.exp(rng.normal(0, spread, (count, 2)))
+    return np.concatenate([xy - wh / 2, xy + wh / 2,
+                           rng.uniform(0.05, 1, (count, 1)),
+                           rng.randint(num_classes, size=(count, 1))], axis=-1)
+
+
+if __name__ == '__main__':
+    # Micro-benchmark over candidate counts, comparing to the original
+    # implementation. Run from the Tensorflow_YOLO folder, with
+    # python -m yolov3.nms
+    import time
+
+    for method, spread in [('nms', 0.15), ('nms', 1.0), ('soft-nms', 0.15)]:
+        for count in [100, 1000, 5000, 20000]:
+            bboxes = _random_candidates(count, spread=spread)
+            timings = []
+            for func in [_nms_loop, nms]:
+                start = time.perf_counter()
+                result = func(bboxes, 0.45, method=method)
+                timings.append((time.perf_counter() - start) * 1000)
+            expected = _nms_loop(bboxes, 0.45, method=method)
+            assert np.allclose(result, expected), (method, count)
+            print(f"{method:8s} spread {spread:4.2f}, {count:6d} candidates: loop {timings[0]:9.2f} ms, "
+                  f"vectorized {timings[1]:8.2f} ms, {len(result)} boxes kept")
@@ -17,6 +17,22 @@ from .configs import *
 STRIDES         = np.array(YOLO_STRIDES)
 ANCHORS         = (np.array(YOLO_ANCHORS).T/STRIDES).T
 
+def mixed_precision_policy(policy=None):
+    # Sets the global mixed precision policy, if given, and returns the global policy. The mixed precision API left
+    # experimental in TF 2.4, and the experimental API was removed in TF 2.13.
+    mixed_precision = tf.keras.mixed_precision
+    if hasattr(mixed_precision, "set_global_policy"):
+        if policy is not None: mixed_precision.set_global_policy(policy)
+        return mixed_precision.global_policy()
+    if policy is not None: mixed_precision.experimental.set_policy(policy)
+    return mixed_precision.experimental.global_policy()
+
+def loss_scale_optimizer(optimizer):
+    # Wraps the optimizer with dynamic loss scaling, the default of the non-experimental LossScaleOptimizer
+    if hasattr(tf.keras.mixed_precision, "LossScaleOptimizer"):
+        return tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
+    return tf.keras.mixed_precision.experimental.LossScaleOptimizer(optimizer, loss_scale="dynamic")
+
 def read_class_names(class_file_name):
     # loads class name from a file
     names = {}
@@ -393,6 +409,11 @@ def Create_Yolo(input_size=416, channels=3, training=False, CLASSES=YOLO_COCO_CL
         if YOLO_TYPE == "yolov3":
             conv_tensors = YOLOv3(input_layer, NUM_CLASS)
 
+    # With a mixed precision policy, the layers compute in float16 or bfloat16, but the outputs are decoded, and the
+    # loss is computed, in float32. BatchNormalization already normalizes 16-bit inputs in float32.
+    if mixed_precision_policy().compute_dtype != 'float32':
+        conv_tensors = [tf.keras.layers.Activation('linear', dtype='float32')(conv_tensor) for conv_tensor in conv_tensors]
+
     output_tensors = []
     for i, conv_tensor in enumerate(conv_tensors):
         pred_tensor = decode(conv_tensor, NUM_CLASS, i)
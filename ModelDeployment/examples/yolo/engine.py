@@ -0,0 +1,295 @@
+# AIDAtaPipeLine - A series of examples and utilities for Azure Machine Learning Services
+# Copyright (C) 2020-2021 The Ocean Cleanup™
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from Tensorflow_YOLO.yolov3.utils import create_detect_function
+import tensorflow as tf
+import numpy as np
+import argparse
+import sys
+import time
+
+
+class YoloEngine(object):
+    """
+    Runs a YOLO model through a single traced tf.function, instead of through
+    Keras' Model.predict(), which sets up a data adapter and callbacks on
+    every call. Reshaping and concatenating the outputs of the different
+    scales is part of the traced function, and optionally the postprocessing
+    as well.
+
+    The traced functions can be saved as SavedModel, and loaded without
+    rebuilding the Keras model.
+    """
+
+    def __init__(self, model, input_size=416, postprocess=False,
+                 score_threshold=0.3, iou_threshold=0.45, max_boxes=100,
+                 functions=None):
+        """
+        :param model:           The Keras YOLO model, as returned by
+                                Load_Yolo_model_custom()
+        :param input_size:      Width and height of the model input, or a
+                                list of them, to trace a function for each.
+                                Images of any of these sizes are accepted.
+        :param postprocess:     Whether score filtering, letterbox un-mapping
+                                and NMS are part of the traced function. If
+                                so, calls return the final boxes, and take
+                                the sizes of the original images.
+        :param score_threshold: Minimum score of a box, if postprocess is set
+        :param iou_threshold:   IoU above which NMS discards the box with the
+                                lower score, if postprocess is set
+        :param max_boxes:       Maximum number of boxes per image, if
+                                postprocess is set. Further boxes, with lower
+                                scores, are dropped.
+        :param functions:       Dict with the traced function per input size,
+                                as restored by load(). If given, nothing is
+                                traced.
+        """
+        self.model = model
+        self.input_sizes = [input_size] if isinstance(input_size, int) \
+            else list(input_size)
+        self.input_size = self.input_sizes[0]
+        self.postprocess = postprocess
+
+        if functions is not None:
+            self._functions = dict(functions)
+            return
+
+        # The batch dimension is left open, so batches of any size share one
+        # trace
+        self._functions = {}
+        for size in self.input_sizes:
+            if postprocess:
+                self._functions[size] = create_detect_function(
+                    model, size, score_threshold, iou_threshold, max_boxes)
+            else:
+                self._functions[size] = tf.function(
+                    self._predict,
+                    input_signature=[
+                        tf.TensorSpec([None, size, size, 3], tf.float32)
+                    ]
+                )
+
+    def _predict(self, images):
+        """
+        Forward pass, traced into a graph.
+
+        :param images:  Tensor of preprocessed images
+        :returns:       Tensor of (batch size, number of boxes, 5 + number of
+                        classes), holding the boxes of all scales.
+        """
+        pred_bbox = self.model(images, training=False)
+        batch_size = tf.shape(images)[0]
+        pred_bbox = [
+            tf.reshape(x, (batch_size, -1, tf.shape(x)[-1])) for x in pred_bbox
+        ]
+        return tf.concat(pred_bbox, axis=1)
+
+    def __call__(self, images, image_sizes=None):
+        """
+        Perform a forward pass.
+
+        :param images:      Numpy array of preprocessed images, of (batch
+                            size, input size, input size, 3), for one of the
+                            input sizes
+        :param image_sizes: Array of (batch size, 2), with the height and
+                            width of the original images. Required if
+                            postprocess is set.
+        :returns:           Numpy array of (batch size, number of boxes, 5 +
+                            number of classes), or if postprocess is set, a
+                            list with an array of (number of detections, 6)
+                            per image, holding xmin, ymin, xmax, ymax, score
+                            and class, like nms() returns.
+        """
+        images = np.asarray(images, dtype=np.float32)
+        if images.shape[1] not in self._functions:
+            raise ValueError(
+                f"Input size {images.shape[1]} is not one of the input sizes "
+                f"of the engine, {self.input_sizes}")
+        forward = self._functions[images.shape[1]]
+
+        images = tf.convert_to_tensor(images)
+        if not self.postprocess:
+            return forward(images).numpy()
+
+        image_sizes = np.asarray(image_sizes, dtype=np.int32)
+        result = forward(images, tf.convert_to_tensor(image_sizes))
+        boxes = result['boxes'].numpy()
+        scores = result['scores'].numpy()
+        classes = result['classes'].numpy()
+        return [
+            np.concatenate([
+                boxes[i, :n],
+                scores[i, :n, np.newaxis],
+                classes[i, :n, np.newaxis]
+            ], axis=-1)
+            for i, n in enumerate(result['valid_detections'].numpy())
+        ]
+
+    def warmup(self, batch_sizes=(1,), input_sizes=None):
+        """
+        Trace the functions and run them once for each of the batch sizes, so
+        the first requests do not pay for tracing, memory allocation and
+        kernel selection.
+
+        :param batch_sizes: Batch sizes to run
+        :param input_sizes: Input sizes to run, by default all input sizes of
+                            the engine
+        """
+        for input_size in input_sizes or self.input_sizes:
+            for batch_size in batch_sizes:
+                self(
+                    np.zeros(
+                        (batch_size, input_size, input_size, 3),
+                        dtype=np.float32
+                    ),
+                    np.full((batch_size, 2), input_size, dtype=np.int32)
+                )
+
+    def save(self, path):
+        """
+        Save the traced functions, with the weights of the model, as
+        SavedModel. Every input size gets a serving_<input size> signature.
+
+        :param path:    Directory to save to
+        """
+        module = tf.Module()
+        module.model = self.model
+        module.input_sizes = tf.Variable(self.input_sizes, trainable=False)
+        module.postprocess = tf.Variable(self.postprocess, trainable=False)
+        for size, function in self._functions.items():
+            setattr(module, f'forward_{size}', function)
+
+        tf.saved_model.save(module, path, signatures={
+            f'serving_{size}': function
+            for size, function in self._functions.items()
+        })
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load an engine saved by save(). The functions are restored as traced,
+        without building the Keras model.
+
+        :param path:    Directory of the SavedModel
+        :returns:       YoloEngine
+        """
+        loaded = tf.saved_model.load(path)
+        input_sizes = [int(size) for size in loaded.input_sizes.numpy()]
+        return cls(
+            loaded,
+            input_sizes,
+            postprocess=bool(loaded.postprocess.numpy()),
+            functions={
+                size: getattr(loaded, f'forward_{size}')
+                for size in input_sizes
+            }
+        )
+
+
+def _time_per_call(func, images, iterations):
+    """
+    Measure the mean wall time of a function, after one call to warm it up.
+
+    :param func:        Function to call with images
+    :param images:      Numpy array to pass to func
+    :param iterations:  Number of calls to time
+    :returns:           Mean time per call, in milliseconds.
+    """
+    func(images)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func(images)
+    return (time.perf_counter() - start) / iterations * 1000
+
+
+if __name__ == "__main__":
+    # Compare the time per request of Model.predict() with eager
+    # postprocessing, as score.py did before, to the engine, and Python
+    # postprocessing to postprocessing in the graph. Without weights,
+    # the model is randomly initialized, which does not affect the timing of
+    # the forward pass, but does affect the number of boxes to postprocess.
+    from Tensorflow_YOLO.yolov3.yolov4 import Create_Yolo
+    from Tensorflow_YOLO.yolov3.configs import YOLO_INPUT_SIZE, \
+        YOLO_EXPORT_MAX_BOXES
+    from Tensorflow_YOLO.yolov3.utils import postprocess_boxes, nms
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--classes', type=str, required=True,
+                        help='File with the names of the classes')
+    parser.add_argument('--weights', type=str, default=None)
+    parser.add_argument('--iterations', type=int, default=100)
+    parser.add_argument('--batch_sizes', type=int, nargs='*', default=[1, 8])
+    parser.add_argument('--export', type=str, default=None,
+                        help='Save the engine as SavedModel to this '
+                             'directory, instead of benchmarking')
+    parser.add_argument('--input_sizes', type=int, nargs='*',
+                        default=[YOLO_INPUT_SIZE],
+                        help='Input sizes to export the engine for. Must be '
+                             'multiples of 32')
+    parser.add_argument('--postprocess', action='store_true',
+                        help='Export the engine with postprocessing in the '
+                             'graph')
+    parser.add_argument('--max_boxes', type=int,
+                        default=YOLO_EXPORT_MAX_BOXES,
+                        help='Maximum number of boxes per image returned by '
+                             'an engine exported with --postprocess')
+    args = parser.parse_args()
+
+    yolo = Create_Yolo(input_size=YOLO_INPUT_SIZE, CLASSES=args.classes)
+    if args.weights is not None:
+        yolo.load_weights(args.weights)
+
+    if args.export is not None:
+        # score.py loads this, if saved to outputs/saved_model of the model
+        engine = YoloEngine(yolo, args.input_sizes, args.postprocess,
+                            max_boxes=args.max_boxes)
+        engine.save(args.export)
+        print(f"Saved engine for input sizes {args.input_sizes} to "
+              f"{args.export}")
+        sys.exit(0)
+
+    engine = YoloEngine(yolo, YOLO_INPUT_SIZE)
+    graph_engine = YoloEngine(yolo, YOLO_INPUT_SIZE, postprocess=True)
+
+    def keras_predict(images):
+        pred_bbox = yolo.predict(images)
+        pred_bbox = [tf.reshape(x, (-1, tf.shape(x)[-1])) for x in pred_bbox]
+        return tf.concat(pred_bbox, axis=0).numpy()
+
+    def python_postprocess(images):
+        original_image = np.zeros((480, 640, 3), dtype=np.uint8)
+        return [
+            nms(postprocess_boxes(
+                pred_bbox, original_image, YOLO_INPUT_SIZE, 0.3), 0.45)
+            for pred_bbox in engine(images)
+        ]
+
+    for batch_size in args.batch_sizes:
+        images = np.random.rand(
+            batch_size, YOLO_INPUT_SIZE, YOLO_INPUT_SIZE, 3).astype(np.float32)
+        image_sizes = np.tile([480, 640], (batch_size, 1))
+        before = _time_per_call(keras_predict, images, args.iterations)
+        after = _time_per_call(engine, images, args.iterations)
+        print(f"batch size {batch_size}: Model.predict {before:.2f} ms, "
+              f"engine {after:.2f} ms per call, "
+              f"{before - after:.2f} ms less per call")
+
+        before = _time_per_call(python_postprocess, images, args.iterations)
+        after = _time_per_call(
+            lambda x: graph_engine(x, image_sizes), images, args.iterations)
+        print(f"batch size {batch_size}: engine with Python postprocessing "
+              f"{before:.2f} ms, with postprocessing in the graph "
+              f"{after:.2f} ms per call")
@@ -14,85 +14,284 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import time
+import_start = time.perf_counter()
+
 from azureml.contrib.services.aml_request import AMLRequest, rawhttp
 from azureml.contrib.services.aml_response import AMLResponse
 from Tensorflow_YOLO.yolov3.utils import Load_Yolo_model_custom, \
-    image_preprocess, postprocess_boxes, nms, YOLO_CUSTOM_WEIGHTS
-import tensorflow as tf
+    letterbox, postprocess_boxes, nms, YOLO_CUSTOM_WEIGHTS
+from serving import MicroBatcher, Pipeline, ResultCache
+from engine import YoloEngine
 import cv2
 import numpy as np
 import os
 import json
 
+import_time = time.perf_counter() - import_start
+
 
 yolo = None
+engine = None
+batcher = None
+pipeline = None
+cache = None
 labels = []
-input_size = 416
+startup = {}
+input_size = int(os.getenv('INPUT_SIZE', 416))
 score_threshold=0.3
 iou_threshold=0.45
 
+# Concurrent requests are combined into batches of at most MAX_BATCH_SIZE
+# images. A request waits at most MAX_BATCH_WAIT_MS for others to join.
+max_batch_size = int(os.getenv('MAX_BATCH_SIZE', 8))
+max_batch_wait_ms = float(os.getenv('MAX_BATCH_WAIT_MS', 10))
+
+# Score filtering, letterbox un-mapping and NMS run in the graph, as part of
+# the forward pass, unless POSTPROCESS_IN_GRAPH is 0
+postprocess_in_graph = os.getenv('POSTPROCESS_IN_GRAPH', '1') != '0'
+# NMS in the graph returns at most MAX_BOXES boxes per image, with the highest
+# scores. Python postprocessing returns all boxes that NMS keeps.
+max_boxes = int(os.getenv('MAX_BOXES', 100))
+
+# If the model contains an engine exported by engine.py --export in
+# SAVED_MODEL_PATH, it is loaded instead of building the model from the
+# checkpoint. Before taking requests, the engine runs each of the
+# WARMUP_BATCH_SIZES at each of the WARMUP_INPUT_SIZES, by default all input
+# sizes of the engine.
+saved_model_path = os.getenv('SAVED_MODEL_PATH', 'outputs/saved_model')
+warmup_batch_sizes = [
+    int(size) for size in
+    os.getenv('WARMUP_BATCH_SIZES', f'1,{max_batch_size}').split(',') if size
+]
+warmup_input_sizes = [
+    int(size) for size in os.getenv('WARMUP_INPUT_SIZES', '').split(',') if size
+] or None
+
+# Requests are decoded by DECODE_WORKERS threads, and their results are
+# postprocessed and serialized by ENCODE_WORKERS threads, while the model runs.
+# At most PIPELINE_QUEUE_SIZE images wait for each of the stages.
+decode_workers = int(os.getenv('DECODE_WORKERS', 4))
+encode_workers = int(os.getenv('ENCODE_WORKERS', 4))
+pipeline_queue_size = int(os.getenv('PIPELINE_QUEUE_SIZE', 64))
+
+# Results of images that were seen before are returned from a cache of at
+# most RESULT_CACHE_MB, if set, for at most RESULT_CACHE_TTL_S seconds
+result_cache_mb = float(os.getenv('RESULT_CACHE_MB', 0))
+result_cache_ttl_s = float(os.getenv('RESULT_CACHE_TTL_S', 300))
+
+
+def predict_batch(items):
+    """
+    Perform a single forward pass for a list of preprocessed images.
+
+    :param items:   List of decoded images, as returned by decode()
+    :returns:       List with the predicted boxes of each image, as array of
+                    (number of boxes, 5 + number of classes), or, with
+                    postprocessing in the graph, the final boxes as array of
+                    (number of detections, 6)
+    """
+    images = np.stack([image_data for _, image_data, _ in items])
+    if engine.postprocess:
+        return engine(images, [original.shape[:2] for original, _, _ in items])
+    return list(engine(images))
+
 
 def init():
-    global yolo
-    print(os.listdir(os.getenv('AZUREML_MODEL_DIR')))
-    yolo = Load_Yolo_model_custom(
-        os.path.join(
-            os.getenv('AZUREML_MODEL_DIR'),
-            'outputs/checkpoint/yolov4_custom_Tiny'
-        ),
-        os.path.join(
-            os.getenv('AZUREML_MODEL_DIR'),
-            'outputs/labels.names'
+    global yolo, engine, batcher, pipeline, cache, input_size
+    model_dir = os.getenv('AZUREML_MODEL_DIR')
+    print(os.listdir(model_dir))
+
+    load_start = time.perf_counter()
+    if os.path.isdir(os.path.join(model_dir, saved_model_path)):
+        # Restores the traced functions, without building the Keras model
+        engine = YoloEngine.load(os.path.join(model_dir, saved_model_path))
+        yolo = engine.model
+        source = 'saved_model'
+    else:
+        yolo = Load_Yolo_model_custom(
+            os.path.join(model_dir, 'outputs/checkpoint/yolov4_custom_Tiny'),
+            os.path.join(model_dir, 'outputs/labels.names')
         )
-    )
-    with open(
-            os.path.join(os.getenv('AZUREML_MODEL_DIR'),
-                         'outputs/labels.names')) as f:
+        engine = YoloEngine(yolo, input_size, postprocess_in_graph,
+                            score_threshold, iou_threshold, max_boxes)
+        source = 'checkpoint'
+
+    with open(os.path.join(model_dir, 'outputs/labels.names')) as f:
         for l in f.readlines():
             labels.append(l.rstrip('\n'))
 
+    if input_size not in engine.input_sizes:
+        input_size = engine.input_size
+    load_time = time.perf_counter() - load_start
+
+    # Trace and run the inference function before the first request arrives
+    warmup_start = time.perf_counter()
+    engine.warmup(sorted(set(warmup_batch_sizes)), warmup_input_sizes)
+    warmup_time = time.perf_counter() - warmup_start
+
+    startup.update({
+        'source': source,
+        'import_s': import_time,
+        'load_s': load_time,
+        'warmup_s': warmup_time
+    })
+    print(f"Startup from {source}: import {import_time:.2f} s, "
+          f"load {load_time:.2f} s, warm-up {warmup_time:.2f} s")
+
+    batcher = MicroBatcher(predict_batch, max_batch_size, max_batch_wait_ms,
+                           max_queue_size=pipeline_queue_size)
+    pipeline = Pipeline(decode, batcher, encode, decode_workers,
+                        encode_workers, pipeline_queue_size)
+
+    # The model directory includes the name and version of the model
+    if result_cache_mb > 0:
+        cache = ResultCache(
+            result_cache_mb * 1024 ** 2,
+            result_cache_ttl_s,
+            namespace=(model_dir, source, input_size, score_threshold,
+                       iou_threshold, engine.postprocess, max_boxes)
+        )
+
+
+def decode(data):
+    """
+    Decode and preprocess an image.
+
+    :param data:    Binary representation of the image
+    :returns:       Tuple of (decoded image, preprocessed image, (scale,
+                    padding) of the letterbox), or None if the image could
+                    not be decoded
+    """
+    nparr = np.frombuffer(data, np.uint8)
+    original_image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    if original_image is None:
+        return None
+
+    # Resizes straight into a single float32 buffer, normalized to [0, 1]
+    image_data, scale, padding = letterbox(
+        original_image, [input_size, input_size])
+    return original_image, image_data, (scale, padding)
+
+
+def detections(original_image, pred_bbox, letterbox_info=None):
+    """
+    Turn the predicted boxes for an image into a list of detections.
+
+    :param original_image:  The decoded image
+    :param pred_bbox:       The predicted boxes, as returned by predict_batch
+    :param letterbox_info:  The (scale, padding) of the letterbox the image
+                            was preprocessed with
+    :returns:               List of dicts, one per detected object
+    """
+    if engine.postprocess:
+        bboxes = pred_bbox
+    else:
+        bboxes = postprocess_boxes(pred_bbox, original_image, input_size,
+                                   score_threshold, letterbox_info)
+        bboxes = nms(bboxes, iou_threshold, method='nms')
+
+    print(bboxes)
+
+    result = []
+    for box in bboxes:
+        result.append({
+            'xmin': int(box[0]),
+            'xmax': int(box[2]),
+            'ymin': int(box[1]),
+            'ymax': int(box[3]),
+            'score': float(box[4]),
+            'label': labels[int(box[5])]
+        })
+    return result
+
+
+def encode(decoded, pred_bbox):
+    """
+    Turn the predicted boxes for an image into the JSON of its detections.
+
+    :param decoded:     The decoded image, as returned by decode()
+    :param pred_bbox:   The predicted boxes, as returned by predict_batch
+    :returns:           The detections, as JSON
+    """
+    return json.dumps(detections(decoded[0], pred_bbox, decoded[2]))
+
+
+def score(images):
+    """
+    Get the detections of a number of images, from the cache where possible.
+    Images that are not cached are run through the pipeline.
+
+    :param images:  List of binary representations of images
+    :returns:       Tuple of (list with the detections of each image, as JSON,
+                    list with the indices of images that could not be
+                    decoded). If any image could not be decoded, no
+                    detections are returned.
+    """
+    results = [None] * len(images)
+    if cache is not None:
+        keys = [cache.key(data) for data in images]
+        results = [cache.get(key) for key in keys]
+
+    todo = [i for i, result in enumerate(results) if result is None]
+    failed = []
+    for i, result in zip(todo, pipeline.submit_many([images[i] for i in todo])):
+        if result is None:
+            failed.append(i)
+            continue
+        results[i] = result
+        if cache is not None:
+            cache.put(keys[i], result)
+
+    if len(failed) > 0:
+        return None, failed
+    return results, []
+
 
 @rawhttp
 def run(request):
     """
-    Perform inference on a single image, using the model.
+    Perform inference on a single image, using the model. Multiple images can
+    be sent at once as the parts of a multipart/form-data body, in which case
+    a list with the detections of each image is returned, in the order of the
+    parts. A GET request returns the latency and batching statistics, the
+    startup times, and the statistics of the result cache, if enabled.
 
     :param data:    Binary representation of the image
     :returns:       AMLResponse
     """
 
     if request.method == 'POST':
+        if request.mimetype == 'multipart/form-data':
+            images = [
+                f.read() for _, f in request.files.items(multi=True)
+            ]
+            if len(images) == 0:
+                return AMLResponse(
+                    "No images received - please provide images as parts "
+                    "of the body", 400)
+
+            results, failed = score(images)
+            if len(failed) > 0:
+                return AMLResponse(
+                    f"Could not decode the images in parts {failed}", 400)
+            return AMLResponse('[' + ', '.join(results) + ']', 200)
+
         data = request.get_data(False)
         if len(data) == 0:
             return AMLResponse(
                 "No data received - please provide an image as body", 400)
 
-        nparr = np.frombuffer(data, np.uint8)
-        original_image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-
-        image_data = image_preprocess(np.copy(original_image), [input_size, input_size])
-        image_data = image_data[np.newaxis, ...].astype(np.float32)
-        pred_bbox = yolo.predict(image_data)
-        pred_bbox = [tf.reshape(x, (-1, tf.shape(x)[-1])) for x in pred_bbox]
-        pred_bbox = tf.concat(pred_bbox, axis=0)
-
-        bboxes = postprocess_boxes(pred_bbox, original_image, input_size, score_threshold)
-        bboxes = nms(bboxes, iou_threshold, method='nms')
-
-        print(bboxes)
-
-        result = []
-        for box in bboxes:
-            result.append({
-                'xmin': int(box[0]),
-                'xmax': int(box[2]),
-                'ymin': int(box[1]),
-                'ymax': int(box[3]),
-                'score': float(box[4]),
-                'label': labels[int(box[5])]
-            })
-
-        return AMLResponse(json.dumps(result), 200)
+        results, failed = score([data])
+        if len(failed) > 0:
+            return AMLResponse("Could not decode the image", 400)
+        return AMLResponse(results[0], 200)
+    elif request.method == 'GET':
+        stats = pipeline.stats()
+        stats['startup'] = startup
+        if cache is not None:
+            stats['cache'] = cache.stats()
+        return AMLResponse(json.dumps(stats), 200)
     else:
         return AMLResponse("Method not allowed", 405)
 
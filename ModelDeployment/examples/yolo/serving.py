@@ -0,0 +1,426 @@
+# AIDAtaPipeLine - A series of examples and utilities for Azure Machine Learning Services
+# Copyright (C) 2020-2021 The Ocean Cleanup™
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from collections import deque, OrderedDict
+from concurrent.futures import Future
+import functools
+import hashlib
+import numpy as np
+import queue
+import threading
+import time
+
+
+class MicroBatcher(object):
+    """
+    Collects concurrent requests into batches, so the model performs one
+    forward pass for a number of requests, instead of one per request.
+
+    A batch is run as soon as max_batch_size requests are waiting, or when the
+    first request of the batch has waited for max_wait_ms. Every caller of
+    submit() receives the result for its own item.
+    """
+
+    def __init__(self, predict, max_batch_size=8, max_wait_ms=10,
+                 stats_window=10000, max_queue_size=0):
+        """
+        :param predict:         Function performing the forward pass. Is
+                                called with a list of items, and returns a
+                                list with a result per item, in the same order
+        :param max_batch_size:  Maximum number of items per batch
+        :param max_wait_ms:     Maximum time, in milliseconds, a request waits
+                                for other requests to join its batch
+        :param stats_window:    Number of most recent requests and batches to
+                                compute the statistics over
+        :param max_queue_size:  Maximum number of items waiting for a batch,
+                                after which adding items blocks. 0 for no
+                                maximum.
+        """
+        self.predict = predict
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000
+
+        self._queue = queue.Queue(max_queue_size)
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=stats_window)
+        self._batch_sizes = deque(maxlen=stats_window)
+        self._num_requests = 0
+        self._num_batches = 0
+
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def submit(self, item):
+        """
+        Add an item to the next batch, and wait for its result.
+
+        :param item:    The item to pass to predict
+        :returns:       The result of predict for this item. Exceptions raised
+                        by predict are raised here as well.
+        """
+        return self.submit_many([item])[0]
+
+    def submit_many(self, items):
+        """
+        Add a number of items to the next batches, and wait for their results.
+        Items are divided over as many batches as required.
+
+        :param items:   List of items to pass to predict
+        :returns:       List of the results of predict, in the same order as
+                        items. Exceptions raised by predict are raised here as
+                        well.
+        """
+        futures = [self.enqueue(item) for item in items]
+        return [future.result() for future in futures]
+
+    def enqueue(self, item):
+        """
+        Add an item to the next batch, without waiting for its result. Blocks
+        if max_queue_size items are waiting already.
+
+        :param item:    The item to pass to predict
+        :returns:       Future of the result of predict for this item
+        """
+        future = Future()
+        self._queue.put((item, future, time.perf_counter()))
+        return future
+
+    def stats(self):
+        """
+        Get statistics on the requests and batches handled so far.
+
+        :returns:       Dict with the number of items and batches, the
+                        50th and 99th percentile of the item latency in
+                        milliseconds, and the mean number of items per batch
+                        and mean batch fill, as fraction of max_batch_size.
+        """
+        with self._lock:
+            latencies = np.array(self._latencies) * 1000
+            batch_sizes = np.array(self._batch_sizes)
+            result = {
+                'requests': self._num_requests,
+                'batches': self._num_batches,
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': self.max_wait * 1000
+            }
+
+        if len(latencies) > 0:
+            result['latency_p50_ms'] = float(np.percentile(latencies, 50))
+            result['latency_p99_ms'] = float(np.percentile(latencies, 99))
+        if len(batch_sizes) > 0:
+            result['mean_batch_size'] = float(batch_sizes.mean())
+            result['mean_batch_fill'] = \
+                float(batch_sizes.mean()) / self.max_batch_size
+        return result
+
+    def _collect(self):
+        """
+        Wait for the next batch of requests.
+
+        :returns:       List of (item, future, time added) tuples.
+        """
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        """
+        Run batches in the background, for as long as the process runs.
+        """
+        while True:
+            batch = self._collect()
+            try:
+                results = self.predict([item for item, _, _ in batch])
+            except Exception as e:
+                results = None
+                error = e
+
+            end = time.perf_counter()
+            with self._lock:
+                self._batch_sizes.append(len(batch))
+                self._num_batches += 1
+                self._latencies.extend(end - start for _, _, start in batch)
+                self._num_requests += len(batch)
+
+            if results is None:
+                for _, future, _ in batch:
+                    future.set_exception(error)
+            else:
+                for (_, future, _), result in zip(batch, results):
+                    future.set_result(result)
+
+
+class Pipeline(object):
+    """
+    Runs requests through three stages, joined by bounded queues: decoding on
+    a pool of threads, inference in batches on a MicroBatcher, and
+    postprocessing and serializing on another pool of threads. The model keeps
+    running while the next requests are decoded, and the results of the
+    previous batch are serialized.
+
+    When a stage falls behind, its queue fills up, and the stages before it
+    block, up to the callers of submit_many().
+    """
+
+    def __init__(self, decode, batcher, encode, decode_workers=4,
+                 encode_workers=4, queue_size=64, stats_window=10000):
+        """
+        :param decode:          Function turning an item into the input of
+                                the batcher, or None if it cannot be decoded
+        :param batcher:         MicroBatcher performing the inference
+        :param encode:          Function turning the decoded item and the
+                                result of the batcher into the final result
+        :param decode_workers:  Number of threads decoding
+        :param encode_workers:  Number of threads encoding
+        :param queue_size:      Maximum number of items waiting for the decode
+                                and the encode stage
+        :param stats_window:    Number of most recent items to compute the
+                                statistics over
+        """
+        self.decode = decode
+        self.batcher = batcher
+        self.encode = encode
+
+        self._decode_queue = queue.Queue(queue_size)
+        self._encode_queue = queue.Queue(queue_size)
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=stats_window)
+
+        for target, workers in [(self._run_decode, decode_workers),
+                                (self._run_encode, encode_workers)]:
+            for _ in range(max(1, int(workers))):
+                threading.Thread(target=target, daemon=True).start()
+
+    def submit_many(self, items):
+        """
+        Run a number of items through the pipeline, and wait for their
+        results.
+
+        :param items:   List of items to pass to decode
+        :returns:       List of the results of encode, in the same order as
+                        items, with None for items that could not be decoded.
+                        Exceptions raised by any of the stages are raised here
+                        as well.
+        """
+        start = time.perf_counter()
+        futures = []
+        for item in items:
+            futures.append(Future())
+            self._decode_queue.put((item, futures[-1]))
+
+        try:
+            return [future.result() for future in futures]
+        finally:
+            latency = time.perf_counter() - start
+            with self._lock:
+                self._latencies.extend([latency] * len(items))
+
+    def stats(self):
+        """
+        Get statistics on the items handled so far.
+
+        :returns:       Dict with the statistics of the batcher, the 50th and
+                        99th percentile of the latency of items through all
+                        stages in milliseconds, and the number of items
+                        waiting for the decode and the encode stage.
+        """
+        result = self.batcher.stats()
+        with self._lock:
+            latencies = np.array(self._latencies) * 1000
+
+        if len(latencies) > 0:
+            result['pipeline_latency_p50_ms'] = \
+                float(np.percentile(latencies, 50))
+            result['pipeline_latency_p99_ms'] = \
+                float(np.percentile(latencies, 99))
+        result['decode_queue'] = self._decode_queue.qsize()
+        result['encode_queue'] = self._encode_queue.qsize()
+        return result
+
+    def _run_decode(self):
+        """
+        Decode items, and pass them to the batcher, for as long as the process
+        runs.
+        """
+        while True:
+            item, future = self._decode_queue.get()
+            try:
+                decoded = self.decode(item)
+            except Exception as e:
+                future.set_exception(e)
+                continue
+
+            if decoded is None:
+                future.set_result(None)
+                continue
+
+            # The batcher calls back when the batch is done, without blocking
+            # this thread
+            self.batcher.enqueue(decoded).add_done_callback(
+                functools.partial(self._to_encode, decoded, future))
+
+    def _to_encode(self, decoded, future, batch_future):
+        """
+        Pass the result of the batcher to the encode stage.
+
+        :param decoded:         The decoded item
+        :param future:          Future of the final result
+        :param batch_future:    Future of the result of the batcher
+        """
+        self._encode_queue.put((decoded, batch_future, future))
+
+    def _run_encode(self):
+        """
+        Encode the results of the batcher, for as long as the process runs.
+        """
+        while True:
+            decoded, batch_future, future = self._encode_queue.get()
+            try:
+                result = self.encode(decoded, batch_future.result())
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+
+class ResultCache(object):
+    """
+    Caches the results of requests by the content of their body, so requests
+    that send the same image again, such as retries and duplicate uploads, are
+    answered without decoding and inference.
+
+    Entries are evicted least recently used first, when the cached results
+    exceed max_bytes, and expire after ttl_s seconds.
+    """
+
+    # Estimate of the memory used by an entry, besides its key and result
+    ENTRY_OVERHEAD = 200
+
+    def __init__(self, max_bytes, ttl_s=300, namespace=()):
+        """
+        :param max_bytes:   Memory budget of the cache, in bytes
+        :param ttl_s:       Time in seconds after which a result expires, or
+                            None to keep results until they are evicted
+        :param namespace:   Values that change the result for the same body,
+                            such as the model version and thresholds. They
+                            are part of every key.
+        """
+        self.max_bytes = int(max_bytes)
+        self.ttl = ttl_s
+        self._namespace = repr(tuple(namespace)).encode()
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def key(self, data):
+        """
+        Compute the key of a request body.
+
+        :param data:    Request body, as bytes or memoryview
+        :returns:       The key, as bytes
+        """
+        # sha256 is accelerated by the SHA extensions of current CPUs, which
+        # makes it faster than blake2b for image sized bodies
+        h = hashlib.sha256(self._namespace)
+        h.update(data)
+        return h.digest()
+
+    def get(self, key):
+        """
+        Look up a result, and mark it as recently used.
+
+        :param key:     Key, as returned by key()
+        :returns:       The cached result, or None if there is none
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and \
+                    now - entry[1] > self.ttl:
+                self._remove(key)
+                entry = None
+
+            if entry is None:
+                self._misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[0]
+
+    def put(self, key, result):
+        """
+        Store a result, evicting the least recently used results if the
+        memory budget is exceeded. Results larger than the budget are not
+        stored.
+
+        :param key:     Key, as returned by key()
+        :param result:  Result to cache, as str or bytes
+        """
+        size = len(key) + len(result) + self.ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (result, time.monotonic(), size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self._evictions += 1
+
+    def stats(self):
+        """
+        Get statistics on the use of the cache.
+
+        :returns:       Dict with the number of hits, misses and evictions,
+                        the hit rate, and the number of entries and bytes in
+                        the cache.
+        """
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': self._hits / lookups if lookups > 0 else 0.0,
+                'evictions': self._evictions,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes
+            }
+
+    def _remove(self, key):
+        """
+        Remove an entry. Must be called with the lock held.
+
+        :param key:     Key of the entry
+        """
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
@@ -40,15 +40,25 @@ def run(request):
     """
     # data is a binary representation of an image.
     #
-    # TODO: If necessary, manipulate data into the correct form. Examples are:
-    # - Open file and write binary data to file:
+    # TODO: If necessary, manipulate data into the correct form. Prefer to
+    # keep the image in memory, writing it to a file costs syscalls and disk
+    # I/O for every request. Examples are:
+    # - Pass the bytes, or a memoryview of them, to the model directly:
     #   ```
-    #   Path('tmp').mkdir(parents=True, exist_ok=True)
-    #   fname = 'tmp/' + \
-    #       ''.join(random.choice(string.ascii_lowercase) for i in range(32))
-    #   with open(fname, 'wb') as f:
-    #       f.write(data)
+    #   result = model.predict(memoryview(data))
     #   ```
+    # - Only if the model requires a path, write binary data to a file on
+    #   tmpfs, and reuse it, as in `examples/example_model/score.py`:
+    #   ```
+    #   f = open(f'/dev/shm/score-{os.getpid()}', 'wb')  # once, in init()
+    #
+    #   f.seek(0)
+    #   f.truncate()
+    #   f.write(data)
+    #   f.flush()
+    #   result = model.predict(f.name)
+    #   ```
+    #   Use a file per thread if requests are handled concurrently.
     # - Create a OpenCV image in memory:
     #   ```
     #   import numpy as np
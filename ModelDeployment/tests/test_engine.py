@@ -0,0 +1,50 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+pytest.importorskip('cv2')
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), '..', 'examples', 'yolo'))
+from engine import YoloEngine  # noqa: E402
+
+NUM_CLASSES = 2
+
+
+def tiny_model():
+    """
+    Stand-in for a YOLO model, returning a grid of boxes at two scales, each
+    with x, y, w, h, confidence and class probabilities.
+    """
+    images = tf.keras.Input([None, None, 3])
+    outputs = []
+    for stride in [16, 32]:
+        x = tf.keras.layers.AveragePooling2D(stride)(images)
+        outputs.append(tf.keras.layers.Conv2D(
+            5 + NUM_CLASSES, 1, activation='sigmoid')(x))
+    return tf.keras.Model(images, outputs)
+
+
+@pytest.mark.parametrize('postprocess', [False, True])
+def test_saved_engine_predicts_like_the_original(tmp_path, postprocess):
+    engine = YoloEngine(tiny_model(), [32, 64], postprocess,
+                        score_threshold=0.0, max_boxes=5)
+    engine.save(str(tmp_path / 'saved_model'))
+    loaded = YoloEngine.load(str(tmp_path / 'saved_model'))
+
+    assert loaded.input_sizes == [32, 64]
+    assert loaded.postprocess == postprocess
+    for size in [32, 64]:
+        images = np.random.rand(2, size, size, 3).astype(np.float32)
+        image_sizes = [[size, size]] * 2
+        expected = engine(images, image_sizes)
+        result = loaded(images, image_sizes)
+        assert len(result) == 2
+        for e, r in zip(expected, result):
+            np.testing.assert_allclose(r, e, rtol=1e-5, atol=1e-5)
+            if postprocess:
+                assert 0 < len(r) <= 5
+                assert r.shape[1] == 6
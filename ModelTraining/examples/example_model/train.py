@@ -18,7 +18,7 @@ from azureml.core import Run, Dataset
 from model import Model
 import logging
 import os
-from utils import load_args, find_set, load_set_as_txt
+from utils import load_args, find_set, load_set_as_txt, finish_preparation
 
 logger = logging.getLogger('model')
 fh = logging.FileHandler('logs/model.log')
@@ -43,6 +43,9 @@ if __name__ == "__main__":
     train_set, train_labels = load_set_as_txt('train', parameters.train_sets)
     test_set, test_labels = load_set_as_txt('test', parameters.test_sets)
 
+    # Stop here if this run only prepares the datasets
+    finish_preparation(parameters)
+
     #### Implement/perform model training ####
 
     logger.info("Starting training")
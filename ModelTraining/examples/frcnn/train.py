@@ -20,6 +20,7 @@ import logging
 import os
 import shutil
 from utils import load_args, find_set, load_set_as_csv_pbtxt, DATASTORE_NAME
+from utils import finish_preparation
 
 from frcnn.model_main_tf2 import tf
 
@@ -59,6 +60,9 @@ if __name__ == "__main__":
     train_set, train_labels = load_set_as_csv_pbtxt('train', parameters.train_sets, True)
     test_set, _ = load_set_as_csv_pbtxt('test', parameters.test_sets, False)
 
+    # Stop here if this run only prepares the datasets
+    finish_preparation(parameters)
+
     #### Implement/perform model training ####
 
     logger.info("Starting training")
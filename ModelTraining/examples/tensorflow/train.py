@@ -20,6 +20,7 @@ import logging
 import os
 import shutil
 from utils import load_args, find_set, save_set_as_tfrecords, DATASTORE_NAME
+from utils import finish_preparation
 import select
 import re
 import sys
@@ -67,6 +68,9 @@ if __name__ == "__main__":
     test_path = save_set_as_tfrecords('test', parameters.test_sets, 'tf2od/annotations')
     print(test_path)
 
+    # Stop here if this run only prepares the datasets
+    finish_preparation(parameters)
+
     #### Implement/perform model training ####
 
     logger.info("Starting training")
@@ -18,24 +18,96 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
-from azureml.core import Run, Dataset
+from azureml.core import Run, Dataset, Datastore
 from PIL import Image
 import csv
 import argparse
 import ast
+import hashlib
+import json
+import multiprocessing
 import os
+import re
 import shutil
+import sqlite3
+import sys
 
 import io
+import numpy as np
 import pandas as pd
 import tensorflow.compat.v1 as tf
 
 from PIL import Image
-from collections import namedtuple, OrderedDict
+from collections import namedtuple, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 
 
 DATASTORE_NAME = 'main_datastore'
 
+# Patterns used to parse the label column without evaluating it row by row.
+# The column holds the repr() of a list of dicts, one dict per bounding box.
+_BOX_PATTERN = r"\{([^{}]*)\}"
+_LABEL_PATTERN = r"'label'\s*:\s*(?:'([^']*)'|\"([^\"]*)\")"
+_COORDINATE_PATTERN = r"'{}'\s*:\s*([-+0-9.eE]+)"
+BOX_COORDINATES = ['bottomX', 'bottomY', 'topX', 'topY']
+
+# Number of processes used to encode TFRecord shards. Defaults to one per CPU.
+TFRECORD_WORKERS = None
+
+# Number of (label, image) set combinations that are loaded at the same time
+LOAD_WORKERS = 8
+
+# Image headers are read from the mounted datasets by a pool of threads. On a
+# blob-fuse mount every open is a network round trip, so these determine how
+# many of those round trips are in flight at the same time.
+SCAN_WORKERS = 32
+SCAN_MAX_IN_FLIGHT = 256
+
+# Caches that are kept between runs. On AzureML, the home directory of a
+# compute node is preserved between the runs that are scheduled on that node.
+CACHE_DIR = os.getenv(
+    'TOC_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'toc_datapipeline')
+)
+
+# SQLite file holding the metadata of every image that has been seen before,
+# the same index as used by the other examples. Set to None to read the
+# header of every image on each run instead.
+IMAGE_INDEX_PATH = os.path.join(CACHE_DIR, 'image_index.sqlite')
+
+# Folder in which the outputs of earlier conversions are kept, so converting
+# the same label sets again copies the earlier records instead. Set to None to
+# always convert.
+CONVERSION_CACHE_DIR = os.path.join(CACHE_DIR, 'conversions')
+
+# Folder holding the serialized tf.train.Example of every image that has been
+# written to a record before, stored by a digest of the image and its labels.
+# A new version of a label set only encodes the images that are new or
+# changed, and copies the others from here. Set to None to always encode.
+EXAMPLE_CACHE_DIR = os.path.join(CACHE_DIR, 'examples')
+
+# Folder of downscaled images in the other examples. Records are written
+# from the original images, so stored conversions never refer to it.
+RESIZE_CACHE_DIR = os.path.join(CACHE_DIR, 'resized')
+
+# Stand in for the mount point of the i-th image set, and for the folder of
+# downscaled images, in cached outputs
+_IMAGE_FOLDER_TOKEN = '<<image_folder:{}>>'
+_RESIZE_CACHE_TOKEN = '<<resize_cache>>'
+
+# Matches the paths to downscaled images in stored conversions
+_RESIZE_CACHE_REFERENCE = re.compile(
+    re.escape(_RESIZE_CACHE_TOKEN).encode() +
+    rb'/[0-9]+/[0-9a-f]{32}\.(?:jpg|npy)'
+)
+
+# Mount point of datasets prepared by an earlier run, see load_args(). Its
+# conversions are used before those in CONVERSION_CACHE_DIR.
+PREPARED_DIR = None
+
+# Folder in which a preparation run collects its conversions
+PREPARATION_DIR = 'prepared'
+
 
 def load_args(parameters):
     """
@@ -60,6 +132,17 @@ def load_args(parameters):
         help='Test sets. Provide as labels:images,labels:images'
     )
 
+    # Datasets prepared by an earlier run, or the name to register the
+    # datasets prepared in this run under
+    parser.add_argument(
+        '--prepared', type=str, dest='prepared', default=None,
+        help='Mount point of a dataset prepared by an earlier run'
+    )
+    parser.add_argument(
+        '--prepare_as', type=str, dest='prepare_as', default=None,
+        help='Only prepare the datasets, and register them under this name'
+    )
+
     # Get the parameters to the model.
     for p in parameters:
         parser.add_argument(
@@ -69,7 +152,72 @@ def load_args(parameters):
             default=p[2]
         )
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.prepared is not None:
+        _use_prepared(args.prepared)
+    if args.prepare_as is not None:
+        _start_preparation()
+
+    return args
+
+
+def _use_prepared(prepared_dir):
+    """
+    Use the conversions in a dataset prepared by an earlier run.
+
+    :param prepared_dir:    Mount point of the prepared dataset
+    """
+    global PREPARED_DIR
+    PREPARED_DIR = prepared_dir
+
+
+def _start_preparation():
+    """
+    Collect all conversions of this run in PREPARATION_DIR, so
+    finish_preparation() can register them.
+    """
+    global CONVERSION_CACHE_DIR
+    preparation_dir = os.path.abspath(PREPARATION_DIR)
+    shutil.rmtree(preparation_dir, ignore_errors=True)
+    CONVERSION_CACHE_DIR = os.path.join(preparation_dir, 'conversions')
+
+
+def finish_preparation(parameters):
+    """
+    If the run was started to only prepare the datasets, register the
+    prepared datasets as File Dataset, and end the run. Call this after
+    loading the datasets, and before training. Otherwise, this does nothing.
+
+    The dataset is uploaded to the Datastore of the image sets, and registered
+    under the name passed as prepare_as, as a new version. Pass it to a later
+    run as prepared, to skip converting the datasets in that run.
+
+    :param parameters:  The arguments as returned by load_args()
+    """
+    if parameters.prepare_as is None:
+        return
+
+    run = Run.get_context()
+    workspace = run.experiment.workspace
+    datastore = Datastore.get(workspace, DATASTORE_NAME)
+    target_path = f'prepared/{parameters.prepare_as}/{run.id}'
+    datastore.upload(
+        src_dir=os.path.abspath(PREPARATION_DIR), target_path=target_path,
+        overwrite=True
+    )
+
+    dataset = Dataset.File.from_files(path=(datastore, target_path))
+    dataset = dataset.register(
+        workspace,
+        parameters.prepare_as,
+        description=f"Datasets prepared by run {run.id}",
+        create_new_version=True
+    )
+    run.log('prepared_dataset', f"{dataset.name}:{dataset.version}")
+    print(f"Registered prepared datasets as {dataset.name}, "
+          f"version {dataset.version}")
+
+    sys.exit(0)
 
 
 def labels_to_df(dataset):
@@ -85,6 +233,96 @@ def labels_to_df(dataset):
     return df
 
 
+def _evaluate_labels(labels):
+    """
+    Parse label column values by evaluating them one by one. This is used for
+    the rows load_labels() can not parse with its patterns, such as labels
+    that hold braces or quotes.
+
+    :param labels:      Series of label column values, indexed by the
+                        position of their image
+    :returns:           Tuple of (boxes, failed). boxes is a Pandas dataframe
+                        with the columns of the boxes returned by
+                        load_labels(), failed a list of the positions of the
+                        images that could not be parsed.
+    """
+    rows = []
+    failed = []
+    for image, text in labels.items():
+        try:
+            rows.extend(
+                [image, box['label']] + [box[c] for c in BOX_COORDINATES]
+                for box in ast.literal_eval(text)
+            )
+        except (ValueError, SyntaxError, TypeError, KeyError):
+            failed.append(image)
+
+    boxes = pd.DataFrame(rows, columns=['image', 'label'] + BOX_COORDINATES)
+    for c in BOX_COORDINATES:
+        boxes[c] = pd.to_numeric(boxes[c], errors='coerce')
+    return boxes, failed
+
+
+def load_labels(dataset):
+    """
+    Load a tabular label dataset as two tables: one row per image, and one row
+    per bounding box. The label column is parsed for the whole dataset at
+    once, instead of evaluating it row by row. Only rows that can not be
+    parsed that way are evaluated.
+
+    :param dataset:     The TabularDataset object to load.
+    :returns:           Tuple of two Pandas dataframes:
+                        - images, with the columns of the dataset, minus
+                          'label'. Its index runs from 0 to the number of
+                          images.
+                        - boxes, with the columns 'image' (position of the
+                          image in the images dataframe), 'label', 'bottomX',
+                          'bottomY', 'topX' and 'topY', ordered as they appear
+                          in the dataset.
+    """
+    df = dataset.to_pandas_dataframe().reset_index(drop=True)
+    labels = df.pop('label').astype(str)
+
+    # One row per box, indexed by (image, box number within the image)
+    box_text = labels.str.extractall(_BOX_PATTERN)[0]
+    image = box_text.index.get_level_values(0).to_numpy().astype(np.int64)
+
+    names = box_text.str.extract(_LABEL_PATTERN)
+    boxes = pd.DataFrame({
+        'image': image,
+        'label': names[0].fillna(names[1]).to_numpy()
+    })
+    for c in BOX_COORDINATES:
+        boxes[c] = pd.to_numeric(
+            box_text.str.extract(_COORDINATE_PATTERN.format(c), expand=False)
+        ).to_numpy()
+
+    # The patterns can not be trusted for rows with braces that are not
+    # boxes, or with escaped quotes, so those are evaluated instead
+    num_boxes = np.bincount(image, minlength=len(labels))
+    fallback = (
+        labels.str.contains('\\', regex=False).to_numpy()
+        | (labels.str.count('{').to_numpy() != num_boxes)
+        | (labels.str.count('}').to_numpy() != num_boxes)
+    )
+    fallback[image[boxes.isna().any(axis=1).to_numpy()]] = True
+
+    failed = []
+    if fallback.any():
+        evaluated, failed = _evaluate_labels(labels[fallback])
+        boxes = pd.concat(
+            [boxes[~fallback[image]], evaluated], ignore_index=True)
+        boxes = boxes.sort_values('image', kind='mergesort') \
+            .reset_index(drop=True)
+
+    invalid = boxes['image'][boxes.isna().any(axis=1)].tolist()
+    if failed or invalid:
+        urls = df['image_url'].iloc[np.unique(failed + invalid)]
+        raise ValueError(f"Could not parse labels of images {list(urls)}")
+
+    return df, boxes
+
+
 def find_set(set_id):
     """
     Find a dataset in the inputs by its ID, required for Tabular Datasets.
@@ -95,51 +333,158 @@ def find_set(set_id):
     return Dataset.get_by_id(Run.get_context().experiment.workspace, set_id)
 
 
-def load_set_as_txt(name, sets):
+def _load_set(label_id, image_folder):
     """
-    Load the datasets. Expects a list of (label, image) set combinations.
+    Load a single (label, image) set combination.
 
-    This version writes the output to text files, as expected by the some
-    models. In other cases, some other processing may be required. These files
-    are written to outputs/, so they are stored with the run and can be
-    inspected at a later time.
+    :param label_id:        ID of the label set
+    :param image_folder:    Mount point of the image set
+    :returns:               Tuple of (images, boxes, image_list). The first two
+                            are as returned by load_labels(), image_list is
+                            the set of files in image_folder.
+    """
+    images, boxes = load_labels(find_set(label_id))
+    return images, boxes, set(os.listdir(image_folder))
 
-    :param name:        Name to give the set output
-    :param sets:        A list of (label, image) set combinations
-    :returns:           Paths to the generated files.
+
+def load_sets(sets, workers=None):
     """
-    labelset = {}
-    rows = []
-    for label_id, image_folder in zip(sets[0::2], sets[1::2]):
-        labels = find_set(label_id)
+    Load a list of (label, image) set combinations. The label sets are
+    resolved and downloaded, and the image folders listed, for all
+    combinations at the same time. Results are returned in the order of sets.
+
+    :param sets:            A list of (label, image) set combinations
+    :param workers:         Number of combinations to load at the same time,
+                            defaults to LOAD_WORKERS
+    :returns:               List of (image_folder, images, boxes, image_list)
+                            tuples, see _load_set().
+    """
+    label_ids = list(sets[0::2])
+    image_folders = list(sets[1::2])
+    if not label_ids:
+        return []
+
+    workers = min(workers or LOAD_WORKERS, len(label_ids))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        loaded = list(executor.map(_load_set, label_ids, image_folders))
+
+    return [(f,) + result for f, result in zip(image_folders, loaded)]
 
-        for i, l in labels_to_df(labels).iterrows():
-            row = [f"{image_folder}/{DATASTORE_NAME}/{l['image_url']}"]
-            for label_entry in l['label']:
-                # Create new, numbered, entry of label in labelset
-                if label_entry['label'] not in labelset:
-                    labelset[label_entry['label']] = len(labelset)
 
-                row.append(','.join([
-                    str(label_entry['bottomX']),
-                    str(label_entry['bottomY']),
-                    str(label_entry['topX']),
-                    str(label_entry['topY']),
-                    str(labelset[label_entry['label']])
-                ]))
+def _read_image_metadata(fp, known=None):
+    """
+    Get the metadata of an image. If the metadata is known from the image
+    index, and the byte size and modification time of the file did not change
+    since, the known metadata is returned without opening the file. Otherwise
+    only the header of the image is read.
+
+    :param fp:          Path to the image
+    :param known:       Metadata of the image as found in the index, or None
+    :returns:           Tuple of (width, height, format, byte size, mtime,
+                        checksum). checksum is None unless it is known.
+    """
+    stat = os.stat(fp)
+    if known is not None and known[3] == stat.st_size and \
+            known[4] == stat.st_mtime:
+        return known
 
-            rows.append(' '.join(row) + '\n')
+    with Image.open(fp) as im:
+        return (im.width, im.height, im.format, stat.st_size, stat.st_mtime,
+                None)
+
+
+def _map_bounded(func, args, workers=None, max_in_flight=None):
+    """
+    Call a function for every item in args, using a pool of threads. At most
+    max_in_flight calls are submitted to the pool at any time, so memory use
+    does not grow with the size of the dataset.
+
+    :param func:            Function to call
+    :param args:            Iterable of argument tuples to call func with
+    :param workers:         Number of threads, defaults to SCAN_WORKERS
+    :param max_in_flight:   Maximum number of submitted, but not yet collected
+                            calls. Defaults to SCAN_MAX_IN_FLIGHT
+    :returns:               List of results, in the same order as args.
+    """
+    workers = workers or SCAN_WORKERS
+    max_in_flight = max(max_in_flight or SCAN_MAX_IN_FLIGHT, workers)
 
-    filepath = f'outputs/{name}.txt'
-    with open(filepath, 'w') as f:
-        f.writelines(rows)
+    results = []
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for a in args:
+            if len(pending) >= max_in_flight:
+                results.append(pending.popleft().result())
+            pending.append(executor.submit(func, *a))
+
+        while pending:
+            results.append(pending.popleft().result())
+
+    return results
+
+
+def _open_image_index(index_path):
+    """
+    Open the image index, creating it if it does not exist yet.
+
+    :param index_path:  Path to the SQLite file
+    :returns:           sqlite3 Connection object
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+    conn = sqlite3.connect(index_path, timeout=60)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS images ("
+        "image_url TEXT PRIMARY KEY, width INTEGER, height INTEGER, "
+        "format TEXT, size INTEGER, mtime REAL, checksum TEXT)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS images_checksum ON images (checksum)")
+    return conn
+
+
+def index_images(urls, paths, index_path=None):
+    """
+    Get the metadata of a list of images through the image index. Images that
+    are in the index, and did not change since, are not opened. Of all other
+    images the header is read, and their metadata is stored in the index.
+
+    :param urls:        List of image_url values, as found in the label set.
+                        These are the keys of the index.
+    :param paths:       List of paths to the images, in the same order
+    :param index_path:  Path to the SQLite file, defaults to IMAGE_INDEX_PATH
+    :returns:           List of (width, height, format, byte size, mtime,
+                        checksum) tuples, in the same order as urls.
+    """
+    urls = list(urls)
+    conn = _open_image_index(index_path or IMAGE_INDEX_PATH)
+
+    # Look up in chunks, to stay below the SQLite limit on query parameters
+    known = {}
+    for i in range(0, len(urls), 500):
+        chunk = urls[i:i + 500]
+        rows = conn.execute(
+            "SELECT image_url, width, height, format, size, mtime, checksum "
+            f"FROM images WHERE image_url IN ({','.join('?' * len(chunk))})",
+            chunk
+        )
+        for r in rows:
+            known[r[0]] = tuple(r[1:])
+
+    metadata = _map_bounded(
+        _read_image_metadata,
+        ((fp, known.get(url)) for url, fp in zip(urls, paths))
+    )
+
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(url,) + m for url, m in zip(urls, metadata)
+             if known.get(url) != m]
+        )
+    conn.close()
 
-    labelpath = f'outputs/{name}_labels.txt'
-    labelset_sorted = sorted(labelset.items(), key=lambda x: x[1])
-    with open(labelpath, 'w') as f:
-        f.writelines([str(x[0]) + '\n' for x in labelset_sorted])
+    return metadata
 
-    return filepath, labelpath
 
 def class_text_to_int(row_label):
     if row_label == 'plastic':
@@ -168,29 +513,34 @@ def bytes_list_feature(value):
 def float_list_feature(value):
   return tf.train.Feature(float_list=tf.train.FloatList(value=value))
 
-def create_tf_example(path, row):
-    with tf.gfile.GFile(os.path.join(path, '{}'.format(row['image_url'])), 'rb') as fid:
+def create_tf_example(path, image_url, labels, coordinates, size=None):
+    """
+    Create a tf.train.Example for a single image.
+
+    :param path:        Folder the image set is mounted in
+    :param image_url:   image_url of the image, relative to path
+    :param labels:      List of label names, one per bounding box
+    :param coordinates: Numpy array of shape (boxes, 4), holding bottomX,
+                        bottomY, topX and topY of each bounding box
+    :param size:        Tuple of (width, height) of the image, as found in
+                        the image index. If None, the image header is parsed
+    :returns:           tf.train.Example object.
+    """
+    with tf.gfile.GFile(os.path.join(path, '{}'.format(image_url)), 'rb') as fid:
         encoded_jpg = fid.read()
-    encoded_jpg_io = io.BytesIO(encoded_jpg)
-    image = Image.open(encoded_jpg_io)
-    width, height = image.size
+    if size is None:
+        size = Image.open(io.BytesIO(encoded_jpg)).size
+    width, height = size
 
-    filename = row['image_url'].encode('utf8')
+    filename = image_url.encode('utf8')
     image_format = b'jpg'
-    xmins = []
-    xmaxs = []
-    ymins = []
-    ymaxs = []
-    classes_text = []
-    classes = []
-
-    for r in row['label']:
-        xmins.append(r['bottomX'] / width)
-        xmaxs.append(r['topX'] / width)
-        ymins.append(r['bottomY'] / height)
-        ymaxs.append(r['topY'] / height)
-        classes_text.append(r['label'].encode('utf8'))
-        classes.append(class_text_to_int(r['label']))
+    coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 4)
+    xmins = (coordinates[:, 0] / width).tolist()
+    xmaxs = (coordinates[:, 2] / width).tolist()
+    ymins = (coordinates[:, 1] / height).tolist()
+    ymaxs = (coordinates[:, 3] / height).tolist()
+    classes_text = [l.encode('utf8') for l in labels]
+    classes = [class_text_to_int(l) for l in labels]
 
     tf_example = tf.train.Example(features=tf.train.Features(feature={
         'image/height': int64_feature(height),
@@ -208,138 +558,469 @@ def create_tf_example(path, row):
     }))
     return tf_example
 
-def save_set_as_tfrecords(name, sets, save_dir):
+def _serialized_example(image_folder, url, labels, coordinates, size,
+                        cache_path):
+    """
+    Get a serialized tf.train.Example for a single image, from the example
+    cache if it was encoded before. Otherwise it is encoded, and stored in the
+    cache.
+
+    :param image_folder:    Folder the image set is mounted in
+    :param url:             image_url of the image, relative to image_folder
+    :param labels:          List of label names, one per bounding box
+    :param coordinates:     Numpy array of bounding boxes, see
+                            create_tf_example()
+    :param size:            Tuple of (width, height) of the image
+    :param cache_path:      Path of the example in the example cache, or None
+                            to always encode it
+    :returns:               Tuple of (serialized example, whether it was
+                            taken from the cache).
+    """
+    if cache_path is not None and os.path.exists(cache_path):
+        with open(cache_path, 'rb') as f:
+            return f.read(), True
+
+    data = create_tf_example(
+        image_folder, url, labels, coordinates, size).SerializeToString()
+    if cache_path is not None:
+        # Write to a temporary file first, so other runs never read a partial
+        # example
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        partial = f'{cache_path}.{os.getpid()}.partial'
+        with open(partial, 'wb') as f:
+            f.write(data)
+        os.replace(partial, cache_path)
+    return data, False
+
+
+def _write_tfrecord_shard(output_path, compression, entries):
+    """
+    Write a single TFRecord shard. This runs in a worker process.
+
+    :param output_path: Path of the shard to write
+    :param compression: Compression type: None, 'GZIP' or 'ZLIB'
+    :param entries:     List of (image folder, image_url, labels, coordinates,
+                        size, cache path) tuples, as taken by
+                        _serialized_example()
+    :returns:           Number of examples that were taken from the example
+                        cache.
+    """
+    # Write a new file, instead of writing into one that may share its
+    # contents with another file
+    if os.path.lexists(output_path):
+        os.remove(output_path)
 
-    output_path = os.path.join(save_dir, name) + '.record'
-    writer = tf.python_io.TFRecordWriter(output_path)
-
-    for label_id, image_folder in zip(sets[0::2], sets[1::2]):
-        df = labels_to_df(find_set(label_id))
-        image_list = os.listdir(image_folder)
-
-        for i, l in df.iterrows():
-            if l['image_url'] in image_list:
-                # print(l['image_url'])
-                tf_example = create_tf_example(image_folder, l)
-                writer.write(tf_example.SerializeToString())
-    writer.close()
-    return output_path
+    cached = 0
+    options = tf.python_io.TFRecordOptions(compression_type=compression)
+    with tf.python_io.TFRecordWriter(output_path, options=options) as writer:
+        for entry in entries:
+            data, from_cache = _serialized_example(*entry)
+            writer.write(data)
+            cached += from_cache
 
+    return cached
 
-def _calc_bbox_center_fraction(img_width, img_height, topX, bottomX, topY,
-        bottomY):
-    """
-    Calculate yolo v5 representation of Bounding Box, which is different in two
-    ways:
-    - indicated as (center_x, center_y, width, height)
-    - coordinates and sizes are indicated as fraction of image, instead of
-      pixels.
-
-    :param img_width:   Width of the image
-    :param img_height:  Height of the image
-    :param topX:        Right border in x direction, as pixels
-    :param bottomX:     Left border in x direction, as pixels
-    :param topX:        Bottom border in x direction, as pixels
-    :param bottomX:     Top border in x direction, as pixels
-    :returns:           List of [
-                            X coordinate of center, as fraction,
-                            Y coordinate of center, as fraction,
-                            width of bounding box, as fraction,
-                            height of bounding box, as fraction
-                        ]
-    """
-    box_width = topX - bottomX
-    box_height = topY - bottomY
-    center_x = bottomX + (box_width / 2)
-    center_y = bottomY + (box_height / 2)
-    return [
-        center_x / img_width,
-        center_y / img_height,
-        box_width / img_width,
-        box_height / img_height
-    ]
 
+def _conversion_key(converter, options, sets):
+    """
+    Determine the key of a conversion in the conversion cache. Label sets are
+    identified by their ID, name and version. Which of the sets share the same
+    image folder is part of the key, as are the contents of this file, so
+    changes to the converters do not reuse outputs of earlier versions.
 
-def _parse_set_yolov5(set_type, sets, labelset):
+    :param converter:   Name of the conversion
+    :param options:     JSON serializable options that affect the output
+    :param sets:        A list of (label, image) set combinations
+    :returns:           Hex digest identifying the conversion.
+    """
+    label_sets = [find_set(label_id) for label_id in sets[0::2]]
+    image_folders = list(sets[1::2])
+    with open(__file__, 'rb') as f:
+        source = hashlib.sha256(f.read()).hexdigest()
+
+    description = json.dumps({
+        'converter': converter,
+        'options': options,
+        'sets': [[ds.id, ds.name, ds.version] for ds in label_sets],
+        'image_folders': [image_folders.index(f) for f in image_folders],
+        'source': source
+    }, sort_keys=True, default=str)
+    return hashlib.sha256(description.encode()).hexdigest()
+
+
+def _relocate(data, replacements):
     """
-    Parse a set of sets to move images in the correct folder and create label
-    files for yolov5.
+    Replace a number of strings in a bytes object, longest string first.
 
-    :param set_type:        The type of set (train or test)
-    :param sets:            A list of (label, image) set combinations
-    :param labelset:        Dict containing the labels and their int-based ID
-    :returns:               The adjusted labelset.
-    """
-    # Build train set
-    for label_id, image_folder in zip(sets[0::2], sets[1::2]):
-        labels = find_set(label_id)
-
-        for i, l in labels_to_df(labels).iterrows():
-            fp = f"{image_folder}/{DATASTORE_NAME}/{l['image_url']}"
-            im = Image.open(fp)
-            width, height = im.size
-
-            # Copy file into correct folder
-            img_url = l['image_url'].replace('/', '_')
-            target = f'data/{set_type}/images/{img_url}'
-            label_target = f'data/{set_type}/labels/' + \
-                '.'.join(img_url.split('.')[:-1] + ['txt'])
+    :param data:            The bytes object
+    :param replacements:    List of (old, new) string tuples
+    :returns:               The adjusted bytes object.
+    """
+    for old, new in sorted(replacements, key=lambda x: -len(x[0])):
+        data = data.replace(old.encode(), new.encode())
+    return data
+
+
+def _output_files(outputs):
+    """
+    List the files among a list of files and folders.
+
+    :param outputs:     List of paths to files and folders
+    :returns:           List of paths to files, including all files within the
+                        folders.
+    """
+    files = []
+    for path in outputs:
+        if not os.path.isdir(path):
+            files.append(path)
+            continue
+        for root, _, names in os.walk(path):
+            files += [os.path.join(root, n) for n in sorted(names)]
+    return files
+
+
+def _store_conversion(entry, outputs, result, image_folders):
+    """
+    Store the outputs of a conversion in the conversion cache. The mount
+    points of the image sets are replaced by tokens, as these differ between
+    runs. Next to the outputs, a manifest is stored of their sizes, and of the
+    downscaled images they refer to, see _conversion_intact().
+
+    :param entry:           Folder to store the conversion in
+    :param outputs:         Paths of the files and folders that were written
+    :param result:          Return value of the conversion
+    :param image_folders:   Mount points of the image sets
+    """
+    tokens = [(folder, _IMAGE_FOLDER_TOKEN.format(image_folders.index(folder)))
+              for folder in set(image_folders)]
+    tokens.append((RESIZE_CACHE_DIR, _RESIZE_CACHE_TOKEN))
+
+    # Write to a temporary folder first, so other runs never see an entry
+    # that is not complete
+    tmp = f'{entry}.{os.getpid()}.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    manifest = {}
+    references = set()
+    for path in _output_files(outputs):
+        target = os.path.join(tmp, 'files', path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        manifest[path] = 0
+        # Paths never hold a newline, so files are relocated line by line,
+        # without reading large outputs into memory at once
+        with open(path, 'rb') as src, open(target, 'wb') as dst:
+            for line in src:
+                line = _relocate(line, tokens)
+                dst.write(line)
+                manifest[path] += len(line)
+                references.update(_RESIZE_CACHE_REFERENCE.findall(line))
+
+    stored = _relocate(json.dumps(result).encode(), tokens)
+    references.update(_RESIZE_CACHE_REFERENCE.findall(stored))
+    with open(os.path.join(tmp, 'result.json'), 'wb') as f:
+        f.write(_relocate(json.dumps({
+            'folders': [p for p in outputs if os.path.isdir(p)],
+            'manifest': manifest,
+            'references': sorted(r.decode() for r in references),
+            'result': result
+        }).encode(), tokens))
+
+    try:
+        os.rename(tmp, entry)
+    except OSError:
+        # Another run stored the same conversion in the mean time
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def _restore_tokens(image_folders, resize_cache_dir):
+    """
+    Get the replacements of the tokens in a stored conversion.
+
+    :param image_folders:       Mount points of the image sets in this run
+    :param resize_cache_dir:    Folder holding the downscaled images that the
+                                outputs refer to
+    :returns:                   List of (token, path) tuples.
+    """
+    tokens = [(_IMAGE_FOLDER_TOKEN.format(i), folder)
+              for i, folder in enumerate(image_folders)]
+    tokens.append((_RESIZE_CACHE_TOKEN, resize_cache_dir))
+    return tokens
+
+
+def _read_stored_conversion(entry, image_folders, resize_cache_dir):
+    """
+    Read the description of a conversion in the conversion cache.
+
+    :param entry:               Folder the conversion is stored in
+    :param image_folders:       Mount points of the image sets in this run
+    :param resize_cache_dir:    Folder holding the downscaled images that the
+                                outputs refer to
+    :returns:                   Dictionary with the folders, manifest,
+                                references and result of the conversion.
+    """
+    tokens = _restore_tokens(image_folders, resize_cache_dir)
+    with open(os.path.join(entry, 'result.json'), 'rb') as f:
+        return json.loads(_relocate(f.read(), tokens))
+
+
+def _conversion_intact(entry, image_folders, resize_cache_dir):
+    """
+    Check whether a conversion in the conversion cache can be restored. All
+    files in its manifest need to be present with their stored size, as do
+    the downscaled images they refer to. Those are kept in the resize cache,
+    outside of the entry, and may have been removed since the conversion was
+    stored.
+
+    :param entry:               Folder the conversion is stored in
+    :param image_folders:       Mount points of the image sets in this run
+    :param resize_cache_dir:    Folder holding the downscaled images that the
+                                outputs refer to
+    :returns:                   True if the conversion can be restored.
+    """
+    if not os.path.isdir(entry):
+        return False
+
+    try:
+        stored = _read_stored_conversion(
+            entry, image_folders, resize_cache_dir)
+        files = os.path.join(entry, 'files')
+        intact = all(
+            os.path.getsize(os.path.join(files, path)) == size
+            for path, size in stored['manifest'].items()
+        ) and all(os.path.isfile(path) for path in stored['references'])
+    except (OSError, ValueError, KeyError):
+        intact = False
+
+    if not intact:
+        print(f"Conversion in {entry} is not complete, converting again")
+    return intact
+
+
+def _restore_conversion(entry, image_folders, resize_cache_dir):
+    """
+    Restore the outputs of a conversion from the conversion cache. Check that
+    the conversion is intact with _conversion_intact() first.
+
+    :param entry:               Folder the conversion is stored in
+    :param image_folders:       Mount points of the image sets in this run
+    :param resize_cache_dir:    Folder holding the downscaled images that the
+                                outputs refer to
+    :returns:                   Return value of the conversion.
+    """
+    tokens = _restore_tokens(image_folders, resize_cache_dir)
+    stored = _read_stored_conversion(entry, image_folders, resize_cache_dir)
+    for folder in stored['folders']:
+        os.makedirs(folder, exist_ok=True)
+
+    files = os.path.join(entry, 'files')
+    for path in _output_files([files]):
+        target = os.path.relpath(path, files)
+        if os.path.dirname(target):
             os.makedirs(os.path.dirname(target), exist_ok=True)
-            os.makedirs(os.path.dirname(label_target), exist_ok=True)
-            shutil.copy(fp, target)
-
-            with open(label_target, 'w') as f:
-                for label_entry in l['label']:
-                    # Create new, numbered, entry of label in labelset
-                    if label_entry['label'] not in labelset:
-                        labelset[label_entry['label']] = len(labelset)
-
-                    row = [str(labelset[label_entry['label']])] + \
-                        [str(x) for x in _calc_bbox_center_fraction(
-                            width,
-                            height,
-                            label_entry['topX'],
-                            label_entry['bottomX'],
-                            label_entry['topY'],
-                            label_entry['bottomY']
-                        )]
-                    f.write(' '.join(row) + '\n')
-
-    return labelset
-
-
-def load_datasets_for_yolo_v5(train_sets, test_sets):
-    """
-    Load the datasets. Expects a list of (label, image) set combinations.
-
-    This version writes the output to CSV files, as expected by the yolo v5
-    model. It moves the images all into /train/images and /test/images
-    locations, and generates a label .txt file per image in /train/labels and
-    /test/labels. It then creates a yaml file pointing to these files.
-
-    :param train_sets:  A list of (label, image) set combinations
-    :param test_sets:   A list of (label, image) set combinations
-    :returns:           Path to the generated yaml file.
-    """
-    # Prepare dirs
-    os.makedirs('outputs/data/train/images', exist_ok=True)
-    os.makedirs('outputs/data/train/labels', exist_ok=True)
-    os.makedirs('outputs/data/test/images', exist_ok=True)
-    os.makedirs('outputs/data/test/labels', exist_ok=True)
-    labelset = {}
-
-    labelset = _parse_set_yolov5("train", train_sets, labelset)
-    labelset = _parse_set_yolov5("test", test_sets, labelset)
-
-    labelset_sorted = sorted(labelset.items(), key=lambda x: x[1])
-
-    # Create yaml file
-    with open('outputs/data/dataset.yaml', 'w') as f:
-        f.write('train: ../data/train/images/\n')
-        f.write('val: ../data/test/images/\n')
-        f.write('\n')
-        f.write(f'nc: {str(len(labelset))}\n')
-        f.write('\n')
-        f.write(f'names: {[x[0] for x in labelset_sorted]}')
-
-    return 'outputs/data/dataset.yaml'
+        # Replace the target instead of writing into it, as it may share its
+        # contents with another file
+        partial = f'{target}.{os.getpid()}.partial'
+        with open(path, 'rb') as src, open(partial, 'wb') as dst:
+            for line in src:
+                dst.write(_relocate(line, tokens))
+        os.replace(partial, target)
+
+    return stored['result']
+
+
+def _cached_conversion(converter, options, sets, outputs, convert, *args):
+    """
+    Perform a conversion through the conversion cache. If the same label sets
+    were converted with the same options before, the earlier outputs are
+    restored and the conversion is skipped. Conversions in PREPARED_DIR are
+    used before those in CONVERSION_CACHE_DIR. Images are assumed not to
+    change once they are referred to by a registered label set. Conversions
+    that are not intact, see _conversion_intact(), are converted again.
+
+    :param converter:   Name of the conversion
+    :param options:     JSON serializable options that affect the output
+    :param sets:        A list of (label, image) set combinations
+    :param outputs:     Paths of the files and folders written by convert,
+                        relative to the working directory
+    :param convert:     Function performing the conversion. Its return value
+                        must be JSON serializable
+    :param args:        Arguments to call convert with
+    :returns:           Return value of convert.
+    """
+    if CONVERSION_CACHE_DIR is None and PREPARED_DIR is None:
+        return convert(*args)
+
+    image_folders = list(sets[1::2])
+    key = _conversion_key(converter, options, sets)
+    if PREPARED_DIR is not None:
+        entry = os.path.join(PREPARED_DIR, 'conversions', key)
+        resize_cache_dir = os.path.join(PREPARED_DIR, 'resized')
+        if _conversion_intact(entry, image_folders, resize_cache_dir):
+            print(f"Restoring {converter} conversion from {entry}")
+            return _restore_conversion(
+                entry, image_folders, resize_cache_dir)
+
+    if CONVERSION_CACHE_DIR is None:
+        return convert(*args)
+
+    entry = os.path.join(CONVERSION_CACHE_DIR, key)
+    if _conversion_intact(entry, image_folders, RESIZE_CACHE_DIR):
+        print(f"Restoring {converter} conversion from {entry}")
+        return _restore_conversion(entry, image_folders, RESIZE_CACHE_DIR)
+
+    result = convert(*args)
+    os.makedirs(CONVERSION_CACHE_DIR, exist_ok=True)
+    # An entry that is not intact is replaced
+    shutil.rmtree(entry, ignore_errors=True)
+    _store_conversion(entry, outputs, result, image_folders)
+    return result
+
+
+def _tfrecord_paths(name, save_dir, num_shards):
+    """
+    Determine the paths of the TFRecord files of a set, see
+    save_set_as_tfrecords().
+
+    :param name:        Name to give the set output
+    :param save_dir:    Folder to write the records to
+    :param num_shards:  Number of files to divide the records over
+    :returns:           Tuple of (list of paths, path or pattern matching all
+                        of them).
+    """
+    output_path = os.path.join(save_dir, name) + '.record'
+    if num_shards <= 1:
+        return [output_path], output_path
+
+    return [
+        f"{output_path}-{i:05d}-of-{num_shards:05d}" for i in range(num_shards)
+    ], f"{output_path}-?????-of-{num_shards:05d}"
+
+
+def save_set_as_tfrecords(name, sets, save_dir, num_shards=1,
+                          num_workers=None, compression=None):
+    """
+    Load the datasets and write them as TFRecords. Expects a list of (label,
+    image) set combinations.
+
+    The examples are divided round-robin over num_shards files, which are
+    written in parallel by separate processes. With a single shard, the output
+    is written to <save_dir>/<name>.record. Otherwise, shards are written to
+    <save_dir>/<name>.record-00000-of-0000N, and the returned path is a glob
+    pattern matching all of them. That pattern can be used as input_path of
+    the TF2 Object Detection input reader, which then reads the shards in
+    parallel (see num_readers).
+
+    Records of the same sets are restored from the conversion cache. Of other
+    sets, such as a new version of a label set, only the examples of new or
+    changed images are encoded, the others are copied from EXAMPLE_CACHE_DIR.
+
+    :param name:        Name to give the set output
+    :param sets:        A list of (label, image) set combinations
+    :param save_dir:    Folder to write the records to, relative to the
+                        working directory
+    :param num_shards:  Number of files to divide the records over
+    :param num_workers: Number of processes to use, defaults to
+                        TFRECORD_WORKERS, and otherwise the number of CPUs.
+                        Never more than num_shards.
+    :param compression: None, 'GZIP' or 'ZLIB'. Note that the TF2 Object
+                        Detection input reader expects uncompressed records.
+    :returns:           Path to the generated file, or pattern matching the
+                        generated shards.
+    """
+    return _cached_conversion(
+        'tfrecords',
+        {'name': name, 'save_dir': save_dir, 'num_shards': num_shards,
+         'compression': compression},
+        sets,
+        _tfrecord_paths(name, save_dir, num_shards)[0],
+        _convert_set_as_tfrecords, name, sets, save_dir, num_shards,
+        num_workers, compression
+    )
+
+
+def _convert_set_as_tfrecords(name, sets, save_dir, num_shards, num_workers,
+                              compression):
+    """
+    Convert the datasets to TFRecords, see save_set_as_tfrecords().
+
+    :param name:        Name to give the set output
+    :param sets:        A list of (label, image) set combinations
+    :param save_dir:    Folder to write the records to
+    :param num_shards:  Number of files to divide the records over
+    :param num_workers: Number of processes to use
+    :param compression: None, 'GZIP' or 'ZLIB'
+    :returns:           Path to the generated file, or pattern matching the
+                        generated shards.
+    """
+    # Examples are cached by the image, its labels and this file, so changes
+    # to create_tf_example() do not reuse examples of earlier versions
+    with open(__file__, 'rb') as f:
+        source = hashlib.sha256(f.read()).hexdigest()
+
+    entries = []
+    for image_folder, images, boxes, image_list in load_sets(sets):
+        # Boxes are ordered by image, so each image gets a contiguous slice
+        bounds = np.searchsorted(
+            boxes['image'].to_numpy(), np.arange(len(images) + 1))
+        labels = boxes['label'].to_numpy()
+        coordinates = boxes[BOX_COORDINATES].to_numpy(dtype=np.float64)
+
+        # The metadata of the images comes from the image index, so the
+        # writers only read the images that are not in the example cache, to
+        # embed them in the record
+        found = [
+            (i, url) for i, url in enumerate(images['image_url'])
+            if url in image_list
+        ]
+        urls = [url for _, url in found]
+        paths = [os.path.join(image_folder, url) for url in urls]
+        if IMAGE_INDEX_PATH is None:
+            metadata = _map_bounded(
+                _read_image_metadata, ((fp,) for fp in paths))
+        else:
+            metadata = index_images(urls, paths)
+
+        for (i, url), m in zip(found, metadata):
+            image_labels = list(labels[bounds[i]:bounds[i + 1]])
+            image_coordinates = coordinates[bounds[i]:bounds[i + 1]]
+            cache_path = None
+            if EXAMPLE_CACHE_DIR is not None:
+                key = hashlib.sha256(json.dumps([
+                    source, url, m[:5], image_labels,
+                    image_coordinates.tolist()
+                ], default=str).encode()).hexdigest()
+                cache_path = os.path.join(EXAMPLE_CACHE_DIR, key[:2], key)
+
+            entries.append((
+                image_folder,
+                url,
+                image_labels,
+                image_coordinates,
+                tuple(m[:2]),
+                cache_path
+            ))
+
+    shard_paths, output_path = _tfrecord_paths(name, save_dir, num_shards)
+    os.makedirs(save_dir or '.', exist_ok=True)
+    if num_shards <= 1:
+        cached = _write_tfrecord_shard(shard_paths[0], compression, entries)
+    else:
+        num_workers = min(
+            num_workers or TFRECORD_WORKERS or os.cpu_count() or 1,
+            num_shards
+        )
+
+        # Spawn instead of fork, so workers don't inherit TensorFlow state of
+        # the parent process
+        with multiprocessing.get_context('spawn').Pool(num_workers) as pool:
+            cached = sum(pool.starmap(
+                _write_tfrecord_shard,
+                [
+                    (shard_path, compression, entries[i::num_shards])
+                    for i, shard_path in enumerate(shard_paths)
+                ],
+                chunksize=1
+            ))
+
+    print(f"Wrote {len(entries)} examples to {output_path}, of which "
+          f"{cached} from the example cache")
+    return output_path
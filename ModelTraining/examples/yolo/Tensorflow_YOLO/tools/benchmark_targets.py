@@ -0,0 +1,138 @@
+#================================================================
+#
+#   File name   : benchmark_targets.py
+#   Description : checks that Dataset.preprocess_true_boxes() assigns
+#                 the same targets as the previous per-box loop, and
+#                 compares their time per image
+#
+#================================================================
+import os
+import sys
+
+foldername = os.path.basename(os.getcwd())
+if foldername == "tools":
+    os.chdir("..")
+sys.path.insert(1, os.getcwd())
+
+import time
+import numpy as np
+from yolov3.dataset import Dataset, anchor_iou
+from yolov3.configs import *
+
+
+def previous_preprocess_true_boxes(self, bboxes):
+    # preprocess_true_boxes() as it was, with anchor_iou() for bbox_iou()
+    label = [np.zeros((self.train_output_sizes[i], self.train_output_sizes[i], self.anchor_per_scale,
+                       5 + self.num_classes)) for i in range(3)]
+    bboxes_xywh = [np.zeros((self.max_bbox_per_scale, 4)) for _ in range(3)]
+    bbox_count = np.zeros((3,))
+
+    for bbox in bboxes:
+        bbox_coor = bbox[:4]
+        bbox_class_ind = bbox[4]
+
+        onehot = np.zeros(self.num_classes, dtype=np.float64)
+        onehot[bbox_class_ind] = 1.0
+        uniform_distribution = np.full(self.num_classes, 1.0 / self.num_classes)
+        deta = 0.01
+        smooth_onehot = onehot * (1 - deta) + deta * uniform_distribution
+
+        bbox_xywh = np.concatenate([(bbox_coor[2:] + bbox_coor[:2]) * 0.5, bbox_coor[2:] - bbox_coor[:2]], axis=-1)
+        bbox_xywh_scaled = 1.0 * bbox_xywh[np.newaxis, :] / self.strides[:, np.newaxis]
+
+        iou = []
+        exist_positive = False
+        for i in range(3):
+            anchors_xywh = np.zeros((self.anchor_per_scale, 4))
+            anchors_xywh[:, 0:2] = np.floor(bbox_xywh_scaled[i, 0:2]).astype(np.int32) + 0.5
+            anchors_xywh[:, 2:4] = self.anchors[i]
+
+            iou_scale = anchor_iou(bbox_xywh_scaled[i][np.newaxis, :], anchors_xywh)
+            iou.append(iou_scale)
+            iou_mask = iou_scale > 0.3
+
+            if np.any(iou_mask):
+                xind, yind = np.floor(bbox_xywh_scaled[i, 0:2]).astype(np.int32)
+
+                label[i][yind, xind, iou_mask, :] = 0
+                label[i][yind, xind, iou_mask, 0:4] = bbox_xywh
+                label[i][yind, xind, iou_mask, 4:5] = 1.0
+                label[i][yind, xind, iou_mask, 5:] = smooth_onehot
+
+                bbox_ind = int(bbox_count[i] % self.max_bbox_per_scale)
+                bboxes_xywh[i][bbox_ind, :4] = bbox_xywh
+                bbox_count[i] += 1
+
+                exist_positive = True
+
+        if not exist_positive:
+            best_anchor_ind = np.argmax(np.array(iou).reshape(-1), axis=-1)
+            best_detect = int(best_anchor_ind / self.anchor_per_scale)
+            best_anchor = int(best_anchor_ind % self.anchor_per_scale)
+            xind, yind = np.floor(bbox_xywh_scaled[best_detect, 0:2]).astype(np.int32)
+
+            label[best_detect][yind, xind, best_anchor, :] = 0
+            label[best_detect][yind, xind, best_anchor, 0:4] = bbox_xywh
+            label[best_detect][yind, xind, best_anchor, 4:5] = 1.0
+            label[best_detect][yind, xind, best_anchor, 5:] = smooth_onehot
+
+            bbox_ind = int(bbox_count[best_detect] % self.max_bbox_per_scale)
+            bboxes_xywh[best_detect][bbox_ind, :4] = bbox_xywh
+            bbox_count[best_detect] += 1
+    label_sbbox, label_mbbox, label_lbbox = label
+    sbboxes, mbboxes, lbboxes = bboxes_xywh
+    return label_sbbox, label_mbbox, label_lbbox, sbboxes, mbboxes, lbboxes
+
+
+def random_bboxes(rng, count, num_classes, input_size):
+    # Mostly small boxes, like debris, some of them on the same spot so they
+    # share anchors
+    xy = rng.randint(0, input_size - 4, (count, 2))
+    if count > 1:
+        xy[rng.rand(count) < 0.2] = xy[0]
+    wh = np.minimum(np.exp(rng.uniform(np.log(2), np.log(input_size), (count, 2))).astype(int),
+                    input_size - xy)
+    return np.concatenate([xy, xy + wh, rng.randint(num_classes, size=(count, 1))], axis=-1)
+
+
+def dataset_stub(num_classes=4, max_bbox_per_scale=100):
+    # The attributes preprocess_true_boxes() uses, without an annotation file
+    dataset = Dataset.__new__(Dataset)
+    dataset.strides = np.array(YOLO_STRIDES)
+    dataset.anchors = (np.array(YOLO_ANCHORS).T / dataset.strides).T
+    dataset.anchor_per_scale = YOLO_ANCHOR_PER_SCALE
+    dataset.max_bbox_per_scale = max_bbox_per_scale
+    dataset.num_classes = num_classes
+    dataset.train_output_sizes = TRAIN_INPUT_SIZE // dataset.strides
+    return dataset
+
+
+def check_equivalence(cases=500, seed=0):
+    rng = np.random.RandomState(seed)
+    for case in range(cases):
+        # A small ring, so it wraps around now and then
+        dataset = dataset_stub(num_classes=rng.randint(1, 6), max_bbox_per_scale=rng.choice([5, 100]))
+        bboxes = random_bboxes(rng, rng.randint(0, 60), dataset.num_classes, TRAIN_INPUT_SIZE)
+        expected = previous_preprocess_true_boxes(dataset, bboxes)
+        result = dataset.preprocess_true_boxes(bboxes)
+        for e, r in zip(expected, result):
+            assert r.dtype == np.float32
+            assert np.array_equal(e.astype(np.float32), r), case
+
+
+if __name__ == "__main__":
+    check_equivalence()
+    print("preprocess_true_boxes() matches the previous loop")
+
+    iterations = 100
+    rng = np.random.RandomState(1)
+    dataset = dataset_stub()
+    for count in [1, 10, 50, 200]:
+        bboxes = random_bboxes(rng, count, dataset.num_classes, TRAIN_INPUT_SIZE)
+        timings = []
+        for func in [previous_preprocess_true_boxes, Dataset.preprocess_true_boxes]:
+            start = time.perf_counter()
+            for _ in range(iterations):
+                func(dataset, bboxes)
+            timings.append((time.perf_counter() - start) / iterations * 1000)
+        print(f"{count:4d} boxes: loop {timings[0]:7.2f} ms, vectorized {timings[1]:6.2f} ms per image")
@@ -0,0 +1,161 @@
+#================================================================
+#
+#   File name   : loader.py
+#   Description : loads the batches of a Dataset in worker processes,
+#                 into shared memory buffers
+#
+#================================================================
+import ctypes
+import queue
+import random
+import traceback
+import multiprocessing
+import cv2
+import numpy as np
+
+
+def _worker(dataset, buffers, shapes, tasks, done):
+    # Fills the buffer of a batch with the samples of a task, until it gets
+    # None. OpenCV threads do not survive a fork, and the workers already run
+    # in parallel, so OpenCV runs single threaded.
+    cv2.setNumThreads(0)
+    views = [[np.frombuffer(array, dtype=np.float32).reshape(shape) for array, shape in zip(slot, shapes)]
+             for slot in buffers]
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        batch, slot, indices, seeds = task
+        try:
+            for num, (index, seed) in enumerate(zip(indices, seeds)):
+                for view, array in zip(views[slot], dataset.load_sample(index, seed)):
+                    view[num] = array
+            done.put((batch, slot, None))
+        except Exception:
+            done.put((batch, slot, traceback.format_exc()))
+
+
+class ProcessLoader(object):
+    """
+    Loads the batches of a Dataset in worker processes, which write them into
+    buffers in shared memory, so they are not pickled between processes. The
+    workers keep running, and loading the next epoch, between epochs, like
+    the InfiniteDataLoader of the yolov5 example.
+
+    Every epoch has a sample order and a seed for the augmentation of every
+    sample, which only depend on the seed, so the batches do not depend on
+    the number of workers or the order in which they finish.
+
+    The arrays of a batch are views into a buffer, which is reused once the
+    next batch is requested. Keep a copy of a batch to use it after that.
+
+    Workers are forked, so they share the images and annotations of the
+    Dataset with the training process, which requires Linux.
+    """
+    def __init__(self, dataset, workers, prefetch, seed=None):
+        """
+        :param dataset:     The Dataset to load batches of
+        :param workers:     Number of worker processes
+        :param prefetch:    Number of batches that are loaded ahead, while
+                            the training loop uses the current batch
+        :param seed:        Seed of the sample order and augmentation, or
+                            None for a different one every run
+        """
+        self.dataset = dataset
+        self.seed = seed if seed is not None else random.randrange(2 ** 31)
+        self.batch_size = dataset.batch_size
+        self.num_batchs = dataset.num_batchs
+
+        sizes = dataset.train_output_sizes
+        sample_shapes = [(dataset.input_sizes, dataset.input_sizes, 3)] + \
+            [(size, size, dataset.anchor_per_scale, 5 + dataset.num_classes) for size in sizes] + \
+            [(dataset.max_bbox_per_scale, 4)] * 3
+        self.shapes = [(self.batch_size,) + shape for shape in sample_shapes]
+
+        # One buffer for the batch the training loop uses, and one for every
+        # batch that is loaded ahead
+        context = multiprocessing.get_context('fork')
+        self.buffers = [[context.RawArray(ctypes.c_float, int(np.prod(shape))) for shape in self.shapes]
+                        for _ in range(prefetch + 1)]
+        self.views = [[np.frombuffer(array, dtype=np.float32).reshape(shape)
+                       for array, shape in zip(slot, self.shapes)] for slot in self.buffers]
+        self.free = list(range(len(self.buffers)))
+        self.held = None
+        self.ready = {}
+
+        # Batches are numbered over all epochs
+        self.submitted = 0
+        self.consumed = 0
+        self.plan_epoch = None
+        self.plan = None
+
+        self.tasks = context.Queue()
+        self.done = context.Queue()
+        self.workers = [
+            context.Process(target=_worker, args=(dataset, self.buffers, self.shapes, self.tasks, self.done),
+                            daemon=True)
+            for _ in range(workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+        self._submit()
+
+    def __len__(self):
+        return self.num_batchs
+
+    def __iter__(self):
+        # An epoch of batches, continuing where the previous epoch stopped
+        for _ in range(self.num_batchs):
+            yield self._next_batch()
+
+    def close(self):
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    def _epoch_plan(self, epoch):
+        # The samples of an epoch, and the seeds of their augmentation. Like
+        # Dataset.__next__, the last batch is filled up with samples from the
+        # start of the epoch.
+        if self.plan_epoch != epoch:
+            rng = np.random.RandomState([self.seed, epoch])
+            count = self.num_batchs * self.batch_size
+            order = rng.permutation(self.dataset.num_samples)
+            self.plan = order[np.arange(count) % len(order)], rng.randint(2 ** 31, size=count)
+            self.plan_epoch = epoch
+        return self.plan
+
+    def _submit(self):
+        # Hand out a batch for every free buffer
+        while self.free and self.num_batchs > 0:
+            epoch, number = divmod(self.submitted, self.num_batchs)
+            indices, seeds = self._epoch_plan(epoch)
+            batch = slice(number * self.batch_size, (number + 1) * self.batch_size)
+            self.tasks.put((self.submitted, self.free.pop(), indices[batch], seeds[batch]))
+            self.submitted += 1
+
+    def _next_batch(self):
+        if self.held is not None:
+            self.free.append(self.held)
+            self.held = None
+            self._submit()
+
+        # Batches arrive in the order the workers finish them
+        while self.consumed not in self.ready:
+            try:
+                batch, slot, error = self.done.get(timeout=1)
+            except queue.Empty:
+                if not all(worker.is_alive() for worker in self.workers):
+                    raise RuntimeError("A data loading worker exited unexpectedly")
+                continue
+            if error is not None:
+                raise Exception(f"Loading batch {batch} failed:\n{error}")
+            self.ready[batch] = slot
+
+        self.held = self.ready.pop(self.consumed)
+        self.consumed += 1
+        image, label_sbbox, label_mbbox, label_lbbox, sbboxes, mbboxes, lbboxes = self.views[self.held]
+        return image, ((label_sbbox, sbboxes), (label_mbbox, mbboxes), (label_lbbox, lbboxes))
@@ -17,6 +17,7 @@ import numpy as np
 import tensorflow as tf
 from .configs import *
 from .yolov4 import *
+from .nms import nms as vectorized_nms
 from tensorflow.python.saved_model import tag_constants
 
 def load_yolo_weights(model, weights_file):
@@ -100,18 +101,39 @@ def Load_Yolo_model():
 
     return yolo
 
-def image_preprocess(image, target_size, gt_boxes=None):
+def letterbox(image, target_size, out=None, dtype=np.float32):
+    # Resize an image into the letterbox of target_size, keeping its aspect
+    # ratio, straight into the output buffer. Only the borders are padded, and
+    # float32 output is normalized to [0, 1] while it is written. Pass a
+    # preallocated (height, width, 3) buffer as out to reuse it, or use uint8
+    # to normalize in the model. Returns the buffer, the scale and the
+    # padding (dw, dh), for postprocess_boxes().
     ih, iw    = target_size
     h,  w, _  = image.shape
 
     scale = min(iw/w, ih/h)
     nw, nh  = int(scale * w), int(scale * h)
+    dw, dh = (iw - nw) // 2, (ih-nh) // 2
+
+    if out is None:
+        out = np.empty((ih, iw, 3), dtype=dtype)
+    pad = 128 if out.dtype == np.uint8 else 128 / 255.
+    out[:dh] = pad
+    out[nh+dh:] = pad
+    out[dh:nh+dh, :dw] = pad
+    out[dh:nh+dh, nw+dw:] = pad
+
     image_resized = cv2.resize(image, (nw, nh))
+    if out.dtype == np.uint8:
+        out[dh:nh+dh, dw:nw+dw] = image_resized
+    else:
+        np.divide(image_resized, out.dtype.type(255.), out=out[dh:nh+dh, dw:nw+dw])
+
+    return out, scale, (dw, dh)
 
-    image_paded = np.full(shape=[ih, iw, 3], fill_value=128.0)
-    dw, dh = (iw - nw) // 2, (ih-nh) // 2
-    image_paded[dh:nh+dh, dw:nw+dw, :] = image_resized
-    image_paded = image_paded / 255.
+
+def image_preprocess(image, target_size, gt_boxes=None):
+    image_paded, scale, (dw, dh) = letterbox(image, target_size)
 
     if gt_boxes is None:
         return image_paded
@@ -193,42 +215,15 @@ def nms(bboxes, iou_threshold, sigma=0.3, method='nms'):
 
     Note: soft-nms, https://arxiv.org/pdf/1704.04503.pdf
           https://github.com/bharatsingh430/soft-nms
+    Implemented in yolov3/nms.py, which sorts the candidates once, instead of
+    rebuilding them for every kept box.
     """
-    classes_in_img = list(set(bboxes[:, 5]))
-    best_bboxes = []
-
-    for cls in classes_in_img:
-        cls_mask = (bboxes[:, 5] == cls)
-        cls_bboxes = bboxes[cls_mask]
-        # Process 1: Determine whether the number of bounding boxes is greater than 0 
-        while len(cls_bboxes) > 0:
-            # Process 2: Select the bounding box with the highest score according to socre order A
-            max_ind = np.argmax(cls_bboxes[:, 4])
-            best_bbox = cls_bboxes[max_ind]
-            best_bboxes.append(best_bbox)
-            cls_bboxes = np.concatenate([cls_bboxes[: max_ind], cls_bboxes[max_ind + 1:]])
-            # Process 3: Calculate this bounding box A and
-            # Remain all iou of the bounding box and remove those bounding boxes whose iou value is higher than the threshold 
-            iou = bboxes_iou(best_bbox[np.newaxis, :4], cls_bboxes[:, :4])
-            weight = np.ones((len(iou),), dtype=np.float32)
-
-            assert method in ['nms', 'soft-nms']
-
-            if method == 'nms':
-                iou_mask = iou > iou_threshold
-                weight[iou_mask] = 0.0
-
-            if method == 'soft-nms':
-                weight = np.exp(-(1.0 * iou ** 2 / sigma))
-
-            cls_bboxes[:, 4] = cls_bboxes[:, 4] * weight
-            score_mask = cls_bboxes[:, 4] > 0.
-            cls_bboxes = cls_bboxes[score_mask]
+    return list(vectorized_nms(bboxes, iou_threshold, sigma, method))
 
-    return best_bboxes
 
-
-def postprocess_boxes(pred_bbox, original_image, input_size, score_threshold):
+def postprocess_boxes(pred_bbox, original_image, input_size, score_threshold, letterbox_info=None):
+    # letterbox_info is the (scale, (dw, dh)) returned by letterbox(). If not
+    # given, it is computed from the size of the original image.
     valid_scale=[0, np.inf]
     pred_bbox = np.array(pred_bbox)
 
@@ -241,10 +236,13 @@ def postprocess_boxes(pred_bbox, original_image, input_size, score_threshold):
                                 pred_xywh[:, :2] + pred_xywh[:, 2:] * 0.5], axis=-1)
     # 2. (xmin, ymin, xmax, ymax) -> (xmin_org, ymin_org, xmax_org, ymax_org)
     org_h, org_w = original_image.shape[:2]
-    resize_ratio = min(input_size / org_w, input_size / org_h)
+    if letterbox_info is None:
+        resize_ratio = min(input_size / org_w, input_size / org_h)
 
-    dw = (input_size - resize_ratio * org_w) / 2
-    dh = (input_size - resize_ratio * org_h) / 2
+        dw = (input_size - resize_ratio * org_w) / 2
+        dh = (input_size - resize_ratio * org_h) / 2
+    else:
+        resize_ratio, (dw, dh) = letterbox_info
 
     pred_coor[:, 0::2] = 1.0 * (pred_coor[:, 0::2] - dw) / resize_ratio
     pred_coor[:, 1::2] = 1.0 * (pred_coor[:, 1::2] - dh) / resize_ratio
@@ -269,6 +267,89 @@ def postprocess_boxes(pred_bbox, original_image, input_size, score_threshold):
     return np.concatenate([coors, scores[:, np.newaxis], classes[:, np.newaxis]], axis=-1)
 
 
+def postprocess_boxes_tf(pred_bbox, image_sizes, input_size, score_threshold, iou_threshold, max_boxes=100):
+    # In-graph equivalent of postprocess_boxes() followed by nms(), for a batch.
+    # pred_bbox is (batch, boxes, 5 + classes), image_sizes is (batch, 2) with
+    # the height and width of the original images. Returns boxes (batch,
+    # max_boxes, 4) as (xmin, ymin, xmax, ymax), scores and classes (batch,
+    # max_boxes), and the number of valid detections per image (batch,).
+    # Unlike nms(), which keeps every box it does not suppress, at most
+    # max_boxes boxes per image are returned, those with the highest scores.
+    pred_xywh = pred_bbox[..., 0:4]
+    pred_conf = pred_bbox[..., 4]
+    pred_prob = pred_bbox[..., 5:]
+
+    # 1. (x, y, w, h) --> (xmin, ymin, xmax, ymax)
+    pred_coor = tf.concat([pred_xywh[..., :2] - pred_xywh[..., 2:] * 0.5,
+                           pred_xywh[..., :2] + pred_xywh[..., 2:] * 0.5], axis=-1)
+    # 2. (xmin, ymin, xmax, ymax) -> (xmin_org, ymin_org, xmax_org, ymax_org),
+    # with the ratio and padding of every image in the batch
+    image_sizes = tf.cast(image_sizes, tf.float32)
+    org_h, org_w = image_sizes[:, 0:1], image_sizes[:, 1:2]
+    resize_ratio = tf.minimum(input_size / org_w, input_size / org_h)
+
+    dw = (input_size - resize_ratio * org_w) / 2
+    dh = (input_size - resize_ratio * org_h) / 2
+
+    # 3. clip some boxes those are out of range
+    xmin = tf.maximum((pred_coor[..., 0] - dw) / resize_ratio, 0.)
+    ymin = tf.maximum((pred_coor[..., 1] - dh) / resize_ratio, 0.)
+    xmax = tf.minimum((pred_coor[..., 2] - dw) / resize_ratio, org_w - 1)
+    ymax = tf.minimum((pred_coor[..., 3] - dh) / resize_ratio, org_h - 1)
+
+    # 4. discard invalid boxes, and those without area
+    scale_mask = tf.logical_and(xmax > xmin, ymax > ymin)
+
+    # 5. discard boxes with low scores. Every box only scores for its best
+    # class, like nms() only compares boxes of the same class
+    classes = tf.argmax(pred_prob, axis=-1)
+    scores = pred_conf * tf.reduce_max(pred_prob, axis=-1)
+    mask = tf.logical_and(scale_mask, scores > score_threshold)
+    scores = tf.where(mask, scores, tf.zeros_like(scores))
+    class_scores = tf.one_hot(classes, tf.shape(pred_prob)[-1], dtype=scores.dtype) * scores[..., tf.newaxis]
+
+    # 6. per class NMS, for all images at once
+    boxes = tf.stack([xmin, ymin, xmax, ymax], axis=-1)[:, :, tf.newaxis, :]
+    boxes, scores, classes, valid_detections = tf.image.combined_non_max_suppression(
+        boxes, class_scores,
+        max_output_size_per_class=max_boxes,
+        max_total_size=max_boxes,
+        iou_threshold=iou_threshold,
+        score_threshold=score_threshold,
+        clip_boxes=False)
+
+    return boxes, scores, classes, valid_detections
+
+
+def create_detect_function(Yolo, input_size=416, score_threshold=0.3, iou_threshold=0.45, max_boxes=100):
+    # Trace the model, score filtering, letterbox un-mapping and NMS into a
+    # single tf.function, which takes preprocessed images and the sizes of the
+    # original images, and returns the final boxes
+    @tf.function(input_signature=[tf.TensorSpec([None, input_size, input_size, 3], tf.float32),
+                                  tf.TensorSpec([None, 2], tf.int32)])
+    def detect(images, image_sizes):
+        pred_bbox = Yolo(images, training=False)
+        batch_size = tf.shape(images)[0]
+        pred_bbox = [tf.reshape(x, (batch_size, -1, tf.shape(x)[-1])) for x in pred_bbox]
+        pred_bbox = tf.cast(tf.concat(pred_bbox, axis=1), tf.float32)
+
+        boxes, scores, classes, valid_detections = postprocess_boxes_tf(
+            pred_bbox, image_sizes, input_size, score_threshold, iou_threshold, max_boxes)
+        return {'boxes': boxes, 'scores': scores, 'classes': classes, 'valid_detections': valid_detections}
+
+    return detect
+
+
+def export_with_postprocessing(Yolo, export_dir, input_size=416, score_threshold=0.3, iou_threshold=0.45, max_boxes=100):
+    # Save the model as SavedModel with postprocessing in the graph. The
+    # serving_default signature returns the final boxes, in pixels of the
+    # original images.
+    module = tf.Module()
+    module.yolo = Yolo
+    module.detect = create_detect_function(Yolo, input_size, score_threshold, iou_threshold, max_boxes)
+    tf.saved_model.save(module, export_dir, signatures={'serving_default': module.detect})
+
+
 def detect_image(Yolo, image_path, output_path, input_size=416, show=False, CLASSES=YOLO_COCO_CLASSES, score_threshold=0.3, iou_threshold=0.45, rectangle_colors=''):
     original_image      = cv2.imread(image_path)
     original_image      = cv2.cvtColor(original_image, cv2.COLOR_BGR2RGB)
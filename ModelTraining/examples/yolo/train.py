@@ -9,7 +9,7 @@
 # that is used to register statistics about the model, both parameters and
 # performance metrics.
 from azureml.core import Run
-from utils import load_args, load_set_as_txt
+from utils import load_args, load_set_as_txt, finish_preparation
 from Tensorflow_YOLO.train import main as train_main
 import logging
 import shutil
@@ -32,7 +32,10 @@ if __name__ == "__main__":
         ['LR_INIT', float, 1e-4],
         ['LR_END', float, 1e-6],
         ['WARMUP_EPOCHS', int, 2],
-        ['EPOCHS', int, 100]
+        ['EPOCHS', int, 100],
+        ['RESIZE_TO', int, 0],
+        ['PRECISION', str, 'fp32'],
+        ['JIT_COMPILE', int, 0]
     ])
 
     logger.debug(parameters.LR_INIT)
@@ -45,29 +48,43 @@ if __name__ == "__main__":
             f"Tensorflow_YOLO/model_data/{f}"
         )
 
-    # Load/prepare the datasets
-    train_set, train_labels = load_set_as_txt('train', parameters.train_sets)
-    test_set, test_labels = load_set_as_txt('test', parameters.test_sets)
+    # Load/prepare the datasets. With RESIZE_TO set, the images are
+    # downscaled once and stored as arrays, instead of being decoded at full
+    # resolution every epoch
+    resize_to = parameters.RESIZE_TO or None
+    train_set, train_labels = load_set_as_txt(
+        'train', parameters.train_sets, resize_to, 'npy')
+    test_set, test_labels = load_set_as_txt(
+        'test', parameters.test_sets, resize_to, 'npy')
+
+    # Stop here if this run only prepares the datasets
+    finish_preparation(parameters)
 
     #### Implement/perform model training ####
 
     logger.info("Starting training")
 
+    # PRECISION is fp32, mixed_float16 or mixed_bfloat16, JIT_COMPILE
+    # compiles the training steps with XLA if not 0
     try:
-        mAP, fps = train_main(
+        mAP, fps, images_per_second = train_main(
             lr_init=parameters.LR_INIT,
             lr_end=parameters.LR_END,
             warmup_epochs=parameters.WARMUP_EPOCHS,
-            epochs=parameters.EPOCHS
+            epochs=parameters.EPOCHS,
+            precision=parameters.PRECISION,
+            jit_compile=bool(parameters.JIT_COMPILE)
         )
     except Exception as e:
         logger.debug(e)
         logger.info("Retrying once")
-        mAP, fps = train_main(
+        mAP, fps, images_per_second = train_main(
             lr_init=parameters.LR_INIT,
             lr_end=parameters.LR_END,
             warmup_epochs=parameters.WARMUP_EPOCHS,
-            epochs=parameters.EPOCHS
+            epochs=parameters.EPOCHS,
+            precision=parameters.PRECISION,
+            jit_compile=bool(parameters.JIT_COMPILE)
         )
 
     logger.info("Finished training")
@@ -102,12 +119,16 @@ if __name__ == "__main__":
         run.log('AP_' + k, v)
 
     run.log('FPS', fps)
+    run.log('train_images_per_second', images_per_second)
 
     # Also log the used parameters
     run.log('LR_INIT', parameters.LR_INIT)
     run.log('LR_END', parameters.LR_END)
     run.log('WARMUP_EPOCHS', parameters.WARMUP_EPOCHS)
     run.log('EPOCHS', parameters.EPOCHS)
+    run.log('RESIZE_TO', parameters.RESIZE_TO)
+    run.log('PRECISION', parameters.PRECISION)
+    run.log('JIT_COMPILE', parameters.JIT_COMPILE)
 
     # Move the model files to the outputs/ folder. This is then automatically
     # attached to the Run, and to any models registered from that run
@@ -25,7 +25,7 @@
 # that is used to register statistics about the model, both parameters and
 # performance metrics.
 from azureml.core import Run
-from utils import load_args, load_datasets_for_yolo_v5
+from utils import load_args, load_datasets_for_yolo_v5, finish_preparation
 import subprocess
 import logging
 import shutil
@@ -45,14 +45,21 @@ if __name__ == "__main__":
     # [<name>, <type>, <default value>]
     # TODO add the required parameters.
     parameters = load_args([
-        ['weights', str, '.']
+        ['weights', str, '.'],
+        ['resize_to', int, 0]
     ])
 
+    # With resize_to set, downscaled copies of the images are used, so they
+    # are not decoded at full resolution every epoch
     dataset_path = load_datasets_for_yolo_v5(
         parameters.train_sets,
-        parameters.test_sets
+        parameters.test_sets,
+        resize_to=parameters.resize_to or None
     )
 
+    # Stop here if this run only prepares the datasets
+    finish_preparation(parameters)
+
     # Move weights file to correct folder
 
 #     shutil.copy(
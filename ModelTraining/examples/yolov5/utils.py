@@ -14,17 +14,89 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from azureml.core import Run, Dataset
+from azureml.core import Run, Dataset, Datastore
 from PIL import Image
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
 import csv
 import argparse
 import ast
+import hashlib
+import io
+import json
 import os
+import re
 import shutil
+import sqlite3
+import sys
 
 
 DATASTORE_NAME = 'main_datastore'
 
+# Image headers are read from the mounted datasets by a pool of threads. On a
+# blob-fuse mount every open is a network round trip, so these determine how
+# many of those round trips are in flight at the same time.
+SCAN_WORKERS = 32
+SCAN_MAX_IN_FLIGHT = 256
+
+# Number of (label, image) set combinations that are loaded at the same time.
+# Each of them downloads a label set, and reads its images using one pool of
+# SCAN_WORKERS threads, which they share.
+LOAD_WORKERS = 8
+
+# Caches that are kept between runs. On AzureML, the home directory of a
+# compute node is preserved between the runs that are scheduled on that node.
+CACHE_DIR = os.getenv(
+    'TOC_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'toc_datapipeline')
+)
+
+# SQLite file holding the metadata of every image that has been seen before.
+# Set to None to read the header of every image on each run instead.
+IMAGE_INDEX_PATH = os.path.join(CACHE_DIR, 'image_index.sqlite')
+
+# How images are placed in the yolov5 dataset folders. 'link' creates a
+# hardlink if the image is on the same filesystem, and a symlink otherwise.
+# 'copy' always copies. Images are copied whenever links can not be created.
+MATERIALIZE_MODE = 'link'
+
+# Folder holding downscaled copies of images, see resize_images(). Copies are
+# stored by the checksum of the original image, in a folder per size.
+RESIZE_CACHE_DIR = os.path.join(CACHE_DIR, 'resized')
+
+# Folder in which the outputs of earlier conversions are kept, so converting
+# the same label sets again copies the earlier outputs instead. Set to None to
+# always convert.
+CONVERSION_CACHE_DIR = os.path.join(CACHE_DIR, 'conversions')
+
+# Stand in for the mount point of the i-th image set, and for the folder of
+# downscaled images, in cached outputs
+_IMAGE_FOLDER_TOKEN = '<<image_folder:{}>>'
+_RESIZE_CACHE_TOKEN = '<<resize_cache>>'
+
+# Matches the paths to downscaled images in stored conversions, see
+# _resize_image()
+_RESIZE_CACHE_REFERENCE = re.compile(
+    re.escape(_RESIZE_CACHE_TOKEN).encode() +
+    rb'/[0-9]+/[0-9a-f]{32}\.(?:jpg|npy)'
+)
+
+# Mount point of datasets prepared by an earlier run, see load_args(). Its
+# conversions are used before those in CONVERSION_CACHE_DIR.
+PREPARED_DIR = None
+
+# Folder in which a preparation run collects its conversions
+PREPARATION_DIR = 'prepared'
+
+# Patterns used to parse the label column without evaluating it row by row.
+# The column holds the repr() of a list of dicts, one dict per bounding box.
+_BOX_PATTERN = r"\{([^{}]*)\}"
+_LABEL_PATTERN = r"'label'\s*:\s*(?:'([^']*)'|\"([^\"]*)\")"
+_COORDINATE_PATTERN = r"'{}'\s*:\s*([-+0-9.eE]+)"
+BOX_COORDINATES = ['bottomX', 'bottomY', 'topX', 'topY']
+
 
 def load_args(parameters):
     """
@@ -49,6 +121,17 @@ def load_args(parameters):
         help='Test sets. Provide as labels:images,labels:images'
     )
 
+    # Datasets prepared by an earlier run, or the name to register the
+    # datasets prepared in this run under
+    parser.add_argument(
+        '--prepared', type=str, dest='prepared', default=None,
+        help='Mount point of a dataset prepared by an earlier run'
+    )
+    parser.add_argument(
+        '--prepare_as', type=str, dest='prepare_as', default=None,
+        help='Only prepare the datasets, and register them under this name'
+    )
+
     # Get the parameters to the model.
     for p in parameters:
         parser.add_argument(
@@ -58,7 +141,85 @@ def load_args(parameters):
             default=p[2]
         )
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.prepared is not None:
+        _use_prepared(args.prepared)
+    if args.prepare_as is not None:
+        _start_preparation()
+
+    return args
+
+
+def _use_prepared(prepared_dir):
+    """
+    Use the conversions in a dataset prepared by an earlier run. The image
+    index of that run is used as well, if there is no local one yet.
+
+    :param prepared_dir:    Mount point of the prepared dataset
+    """
+    global PREPARED_DIR
+    PREPARED_DIR = prepared_dir
+
+    index_path = os.path.join(prepared_dir, 'image_index.sqlite')
+    if IMAGE_INDEX_PATH is not None and os.path.exists(index_path) and \
+            not os.path.exists(IMAGE_INDEX_PATH):
+        os.makedirs(os.path.dirname(IMAGE_INDEX_PATH), exist_ok=True)
+        shutil.copyfile(index_path, IMAGE_INDEX_PATH)
+
+
+def _start_preparation():
+    """
+    Collect all conversions of this run, and the downscaled images they refer
+    to, in PREPARATION_DIR, so finish_preparation() can register them.
+    """
+    global CONVERSION_CACHE_DIR, RESIZE_CACHE_DIR
+    preparation_dir = os.path.abspath(PREPARATION_DIR)
+    shutil.rmtree(preparation_dir, ignore_errors=True)
+    CONVERSION_CACHE_DIR = os.path.join(preparation_dir, 'conversions')
+    RESIZE_CACHE_DIR = os.path.join(preparation_dir, 'resized')
+
+
+def finish_preparation(parameters):
+    """
+    If the run was started to only prepare the datasets, register the
+    prepared datasets as File Dataset, and end the run. Call this after
+    loading the datasets, and before training. Otherwise, this does nothing.
+
+    The dataset is uploaded to the Datastore of the image sets, and registered
+    under the name passed as prepare_as, as a new version. Pass it to a later
+    run as prepared, to skip converting the datasets in that run.
+
+    :param parameters:  The arguments as returned by load_args()
+    """
+    if parameters.prepare_as is None:
+        return
+
+    preparation_dir = os.path.abspath(PREPARATION_DIR)
+    if IMAGE_INDEX_PATH is not None and os.path.exists(IMAGE_INDEX_PATH):
+        shutil.copyfile(
+            IMAGE_INDEX_PATH,
+            os.path.join(preparation_dir, 'image_index.sqlite')
+        )
+
+    run = Run.get_context()
+    workspace = run.experiment.workspace
+    datastore = Datastore.get(workspace, DATASTORE_NAME)
+    target_path = f'prepared/{parameters.prepare_as}/{run.id}'
+    datastore.upload(
+        src_dir=preparation_dir, target_path=target_path, overwrite=True)
+
+    dataset = Dataset.File.from_files(path=(datastore, target_path))
+    dataset = dataset.register(
+        workspace,
+        parameters.prepare_as,
+        description=f"Datasets prepared by run {run.id}",
+        create_new_version=True
+    )
+    run.log('prepared_dataset', f"{dataset.name}:{dataset.version}")
+    print(f"Registered prepared datasets as {dataset.name}, "
+          f"version {dataset.version}")
+
+    sys.exit(0)
 
 
 def labels_to_df(dataset):
@@ -74,6 +235,141 @@ def labels_to_df(dataset):
     return df
 
 
+def _evaluate_labels(labels):
+    """
+    Parse label column values by evaluating them one by one. This is used for
+    the rows load_labels() can not parse with its patterns, such as labels
+    that hold braces or quotes.
+
+    :param labels:      Series of label column values, indexed by the
+                        position of their image
+    :returns:           Tuple of (boxes, failed). boxes is a Pandas dataframe
+                        with the columns of the boxes returned by
+                        load_labels(), failed a list of the positions of the
+                        images that could not be parsed.
+    """
+    rows = []
+    failed = []
+    for image, text in labels.items():
+        try:
+            rows.extend(
+                [image, box['label']] + [box[c] for c in BOX_COORDINATES]
+                for box in ast.literal_eval(text)
+            )
+        except (ValueError, SyntaxError, TypeError, KeyError):
+            failed.append(image)
+
+    boxes = pd.DataFrame(rows, columns=['image', 'label'] + BOX_COORDINATES)
+    for c in BOX_COORDINATES:
+        boxes[c] = pd.to_numeric(boxes[c], errors='coerce')
+    return boxes, failed
+
+
+def load_labels(dataset):
+    """
+    Load a tabular label dataset as two tables: one row per image, and one row
+    per bounding box. The label column is parsed for the whole dataset at
+    once, instead of evaluating it row by row. Only rows that can not be
+    parsed that way are evaluated.
+
+    :param dataset:     The TabularDataset object to load.
+    :returns:           Tuple of two Pandas dataframes:
+                        - images, with the columns of the dataset, minus
+                          'label'. Its index runs from 0 to the number of
+                          images.
+                        - boxes, with the columns 'image' (position of the
+                          image in the images dataframe), 'label', 'bottomX',
+                          'bottomY', 'topX' and 'topY', ordered as they appear
+                          in the dataset.
+    """
+    df = dataset.to_pandas_dataframe().reset_index(drop=True)
+    labels = df.pop('label').astype(str)
+
+    # One row per box, indexed by (image, box number within the image)
+    box_text = labels.str.extractall(_BOX_PATTERN)[0]
+    image = box_text.index.get_level_values(0).to_numpy().astype(np.int64)
+
+    names = box_text.str.extract(_LABEL_PATTERN)
+    boxes = pd.DataFrame({
+        'image': image,
+        'label': names[0].fillna(names[1]).to_numpy()
+    })
+    for c in BOX_COORDINATES:
+        boxes[c] = pd.to_numeric(
+            box_text.str.extract(_COORDINATE_PATTERN.format(c), expand=False)
+        ).to_numpy()
+
+    # The patterns can not be trusted for rows with braces that are not
+    # boxes, or with escaped quotes, so those are evaluated instead
+    num_boxes = np.bincount(image, minlength=len(labels))
+    fallback = (
+        labels.str.contains('\\', regex=False).to_numpy()
+        | (labels.str.count('{').to_numpy() != num_boxes)
+        | (labels.str.count('}').to_numpy() != num_boxes)
+    )
+    fallback[image[boxes.isna().any(axis=1).to_numpy()]] = True
+
+    failed = []
+    if fallback.any():
+        evaluated, failed = _evaluate_labels(labels[fallback])
+        boxes = pd.concat(
+            [boxes[~fallback[image]], evaluated], ignore_index=True)
+        boxes = boxes.sort_values('image', kind='mergesort') \
+            .reset_index(drop=True)
+
+    invalid = boxes['image'][boxes.isna().any(axis=1)].tolist()
+    if failed or invalid:
+        urls = df['image_url'].iloc[np.unique(failed + invalid)]
+        raise ValueError(f"Could not parse labels of images {list(urls)}")
+
+    return df, boxes
+
+
+def _assign_classes(names, labelset):
+    """
+    Map label names to their numbered entry in labelset. Labels that are not
+    yet in labelset are added, numbered in the order in which they appear.
+
+    :param names:       Pandas series of label names
+    :param labelset:    Dict containing the labels and their int-based ID. This
+                        is updated in place.
+    :returns:           Numpy array of class IDs.
+    """
+    for n in pd.unique(names):
+        if n not in labelset:
+            labelset[n] = len(labelset)
+
+    return names.map(labelset).to_numpy()
+
+
+def _format_numbers(values):
+    """
+    Format a column of numbers as strings, without a fractional part for
+    numbers that are whole.
+
+    :param values:      Pandas series of numbers
+    :returns:           Pandas series of strings.
+    """
+    whole = (values == np.floor(values)) & (values.abs() < 2 ** 53)
+    return values.astype(str).where(
+        ~whole, values.astype(np.int64).astype(str))
+
+
+def _join_per_image(lines, image, num_images, sep):
+    """
+    Join the lines of all boxes of each image into one string.
+
+    :param lines:       Pandas series of strings, one per box
+    :param image:       Image each box belongs to, as in load_labels()
+    :param num_images:  Total number of images
+    :param sep:         Separator to put between the lines
+    :returns:           Pandas series with one string per image. Images
+                        without boxes get an empty string.
+    """
+    return lines.groupby(np.asarray(image)).agg(sep.join) \
+        .reindex(range(num_images), fill_value='')
+
+
 def find_set(set_id):
     """
     Find a dataset in the inputs by its ID, required for Tabular Datasets.
@@ -84,7 +380,651 @@ def find_set(set_id):
     return Dataset.get_by_id(Run.get_context().experiment.workspace, set_id)
 
 
-def load_set_as_txt(name, sets):
+def _read_image_size(fp):
+    """
+    Read the size of an image. PIL only parses the header of the file when
+    opening it, the pixel data itself is not read.
+
+    :param fp:          Path to the image
+    :returns:           Tuple of (width, height)
+    """
+    with Image.open(fp) as im:
+        return im.size
+
+
+def _file_checksum(fp):
+    """
+    Compute the MD5 checksum of a file, reading it in blocks.
+
+    :param fp:          Path to the file
+    :returns:           Hex digest of the file.
+    """
+    md5 = hashlib.md5()
+    with open(fp, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def _read_image_metadata(fp, known=None, checksum=False):
+    """
+    Get the metadata of an image. If the metadata is known from the image
+    index, and the byte size and modification time of the file did not change
+    since, the known metadata is returned without opening the file.
+
+    Only the header of an image is read, unless its checksum is requested.
+    That reads the whole file, so it is only done for images that need it,
+    such as those that are resized, and only once per version of the image.
+
+    :param fp:          Path to the image
+    :param known:       Metadata of the image as found in the index, or None
+    :param checksum:    Whether to compute the checksum if it is not known
+    :returns:           Tuple of (width, height, format, byte size, mtime,
+                        checksum). checksum is None if it was not computed.
+    """
+    stat = os.stat(fp)
+    if known is not None and known[3] == stat.st_size and \
+            known[4] == stat.st_mtime:
+        if not checksum or known[5] is not None:
+            return known
+        return known[:5] + (_file_checksum(fp),)
+
+    if not checksum:
+        with Image.open(fp) as im:
+            return (im.width, im.height, im.format, stat.st_size,
+                    stat.st_mtime, None)
+
+    # The file is read anyway for the checksum, so the header is parsed from
+    # the same bytes
+    with open(fp, 'rb') as f:
+        data = f.read()
+
+    with Image.open(io.BytesIO(data)) as im:
+        width, height = im.size
+        image_format = im.format
+
+    return (width, height, image_format, len(data), stat.st_mtime,
+            hashlib.md5(data).hexdigest())
+
+
+def _map_bounded(func, args, workers=None, max_in_flight=None,
+                 executor=None):
+    """
+    Call a function for every item in args, using a pool of threads. At most
+    max_in_flight calls are submitted to the pool at any time, so memory use
+    does not grow with the size of the dataset.
+
+    :param func:            Function to call
+    :param args:            Iterable of argument tuples to call func with
+    :param workers:         Number of threads, defaults to SCAN_WORKERS
+    :param max_in_flight:   Maximum number of submitted, but not yet collected
+                            calls. Defaults to SCAN_MAX_IN_FLIGHT
+    :param executor:        Pool of threads to use, which may be shared with
+                            other calls. If None, a pool of workers threads
+                            is created for this call
+    :returns:               List of results, in the same order as args.
+    """
+    if executor is None:
+        workers = workers or SCAN_WORKERS
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return _map_bounded(
+                func, args, workers,
+                max(max_in_flight or SCAN_MAX_IN_FLIGHT, workers), executor
+            )
+
+    max_in_flight = max_in_flight or SCAN_MAX_IN_FLIGHT
+    results = []
+    pending = deque()
+    for a in args:
+        if len(pending) >= max_in_flight:
+            results.append(pending.popleft().result())
+        pending.append(executor.submit(func, *a))
+
+    while pending:
+        results.append(pending.popleft().result())
+
+    return results
+
+
+def scan_images(paths, workers=None, max_in_flight=None, executor=None):
+    """
+    Read the sizes of a list of images, using a pool of threads.
+
+    :param paths:           List of paths to the images
+    :param workers:         Number of threads, defaults to SCAN_WORKERS
+    :param max_in_flight:   Maximum number of submitted, but not yet collected
+                            images. Defaults to SCAN_MAX_IN_FLIGHT
+    :param executor:        Pool of threads to use instead of a new one, see
+                            _map_bounded()
+    :returns:               List of (width, height) tuples, in the same order
+                            as paths.
+    """
+    return _map_bounded(
+        _read_image_size, ((fp,) for fp in paths), workers, max_in_flight,
+        executor
+    )
+
+
+def _resize_image(fp, size, checksum, long_side, image_format):
+    """
+    Store a downscaled copy of an image in the resize cache, unless it is
+    there already.
+
+    :param fp:              Path to the image
+    :param size:            Tuple of (width, height) of the image
+    :param checksum:        Checksum of the image, as found in the image index
+    :param long_side:       Size of the longest side of the copy. Images that
+                            are smaller already are not scaled up
+    :param image_format:    'jpg' to store the copy as JPEG file, 'npy' to
+                            store it as numpy array of uint8 values, with the
+                            color channels in BGR order, like cv2.imread()
+    :returns:               Tuple of (path to the copy, (width, height) of the
+                            copy).
+    """
+    width, height = size
+    scale = min(1.0, long_side / max(width, height))
+    new_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+
+    target = os.path.join(
+        RESIZE_CACHE_DIR, str(long_side), f'{checksum}.{image_format}')
+    if os.path.exists(target):
+        return target, new_size
+
+    with Image.open(fp) as im:
+        # Let the JPEG decoder scale down while decoding, which is much
+        # cheaper than decoding at full resolution
+        im.draft('RGB', new_size)
+        im = im.convert('RGB')
+        if im.size != new_size:
+            im = im.resize(new_size, Image.LANCZOS)
+
+    # Write to a temporary file first, so other runs never read a partial
+    # copy
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    partial = f'{target}.{os.getpid()}.partial'
+    with open(partial, 'wb') as f:
+        if image_format == 'npy':
+            np.save(f, np.ascontiguousarray(np.asarray(im)[:, :, ::-1]))
+        else:
+            im.save(f, format='JPEG', quality=95)
+    os.replace(partial, target)
+
+    return target, new_size
+
+
+def resize_images(urls, paths, long_side, image_format='jpg'):
+    """
+    Get downscaled copies of a list of images, from the resize cache. Copies
+    that are not in the cache yet are created, using a pool of threads.
+
+    :param urls:            List of image_url values, as found in the label
+                            set
+    :param paths:           List of paths to the images, in the same order
+    :param long_side:       Size of the longest side of the copies. Images
+                            that are smaller already are not scaled up
+    :param image_format:    'jpg' or 'npy', see _resize_image()
+    :returns:               List of (path to the copy, horizontal scale,
+                            vertical scale) tuples, in the same order as
+                            urls. Multiply coordinates in the original image
+                            by the scales to get coordinates in the copy.
+    """
+    if image_format not in ('jpg', 'npy'):
+        raise ValueError(f"Unknown image format {image_format}")
+
+    if IMAGE_INDEX_PATH is None:
+        metadata = _map_bounded(
+            _read_image_metadata, ((fp, None, True) for fp in paths))
+    else:
+        metadata = index_images(urls, paths, checksums=True)
+
+    resized = _map_bounded(
+        _resize_image,
+        ((fp, m[:2], m[5], long_side, image_format)
+         for fp, m in zip(paths, metadata))
+    )
+    return [
+        (path, new_size[0] / m[0], new_size[1] / m[1])
+        for (path, new_size), m in zip(resized, metadata)
+    ]
+
+
+def _image_path(image_folder, url):
+    """
+    Get the path to an image in a mounted image set.
+
+    :param image_folder:    Mount point of the image set
+    :param url:             image_url of the image, as found in the label set
+    :returns:               Path to the image.
+    """
+    return f"{image_folder}/{DATASTORE_NAME}/{url}"
+
+
+def _load_set(label_id, image_folder, image_path=None, executor=None,
+              max_in_flight=None):
+    """
+    Load a single (label, image) set combination.
+
+    :param label_id:        ID of the label set
+    :param image_folder:    Mount point of the image set
+    :param image_path:      Function returning the path to an image, given
+                            image_folder and its image_url. If provided, the
+                            sizes of the images are read as well
+    :param executor:        Pool of threads to read the images with, see
+                            _map_bounded()
+    :param max_in_flight:   Maximum number of images that are submitted to
+                            the pool, but not yet collected
+    :returns:               Tuple of (images, boxes, paths, sizes). The first
+                            two are as returned by load_labels(). paths is a
+                            list of paths to the images, and sizes a numpy
+                            array of (width, height) rows. Both are None if
+                            image_path is not provided.
+    """
+    images, boxes = load_labels(find_set(label_id))
+    if image_path is None:
+        return images, boxes, None, None
+
+    paths = [image_path(image_folder, url) for url in images['image_url']]
+    sizes = np.array(
+        image_sizes(images['image_url'], paths, executor, max_in_flight),
+        dtype=np.int64
+    ).reshape(-1, 2)
+    return images, boxes, paths, sizes
+
+
+def load_sets(sets, image_path=None, workers=None):
+    """
+    Load a list of (label, image) set combinations. The label sets are
+    resolved and downloaded, and their images read, for all combinations at
+    the same time.
+
+    Results are returned in the order of sets, so assigning class IDs while
+    going through them gives the same IDs as loading the sets one by one.
+
+    :param sets:            A list of (label, image) set combinations
+    :param image_path:      Function returning the path to an image, given
+                            the image folder and its image_url. If provided,
+                            the sizes of the images are read as well
+    :param workers:         Number of combinations to load at the same time,
+                            defaults to LOAD_WORKERS
+    :returns:               List of (image_folder, images, boxes, paths, sizes)
+                            tuples, see _load_set().
+    """
+    label_ids = list(sets[0::2])
+    image_folders = list(sets[1::2])
+    if not label_ids:
+        return []
+
+    workers = min(workers or LOAD_WORKERS, len(label_ids))
+    # The combinations read their images using one pool, and divide the
+    # in-flight limit between them, so SCAN_WORKERS and SCAN_MAX_IN_FLIGHT
+    # hold for all of them together
+    max_in_flight = max(SCAN_MAX_IN_FLIGHT // workers, 1)
+    with ThreadPoolExecutor(max_workers=SCAN_WORKERS) as scan_executor, \
+            ThreadPoolExecutor(max_workers=workers) as executor:
+        loaded = list(executor.map(
+            _load_set, label_ids, image_folders,
+            [image_path] * len(label_ids),
+            [scan_executor] * len(label_ids),
+            [max_in_flight] * len(label_ids)
+        ))
+
+    return [(f,) + result for f, result in zip(image_folders, loaded)]
+
+
+def _open_image_index(index_path):
+    """
+    Open the image index, creating it if it does not exist yet.
+
+    :param index_path:  Path to the SQLite file
+    :returns:           sqlite3 Connection object
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+    conn = sqlite3.connect(index_path, timeout=60)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS images ("
+        "image_url TEXT PRIMARY KEY, width INTEGER, height INTEGER, "
+        "format TEXT, size INTEGER, mtime REAL, checksum TEXT)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS images_checksum ON images (checksum)")
+    return conn
+
+
+def index_images(urls, paths, index_path=None, checksums=False,
+                 executor=None, max_in_flight=None):
+    """
+    Get the metadata of a list of images through the image index. Images that
+    are in the index, and did not change since, are not opened. Of all other
+    images the header is read, and their metadata is stored in the index.
+
+    :param urls:            List of image_url values, as found in the label
+                            set. These are the keys of the index.
+    :param paths:           List of paths to the images, in the same order
+    :param index_path:      Path to the SQLite file, defaults to
+                            IMAGE_INDEX_PATH
+    :param checksums:       Whether to compute the checksums that are not in
+                            the index yet. This reads those images completely
+    :param executor:        Pool of threads to read the images with, see
+                            _map_bounded()
+    :param max_in_flight:   Maximum number of images that are submitted to
+                            the pool, but not yet collected
+    :returns:               List of (width, height, format, byte size, mtime,
+                            checksum) tuples, in the same order as urls.
+                            checksum is None for images of which it was never
+                            computed.
+    """
+    urls = list(urls)
+    conn = _open_image_index(index_path or IMAGE_INDEX_PATH)
+
+    # Look up in chunks, to stay below the SQLite limit on query parameters
+    known = {}
+    for i in range(0, len(urls), 500):
+        chunk = urls[i:i + 500]
+        rows = conn.execute(
+            "SELECT image_url, width, height, format, size, mtime, checksum "
+            f"FROM images WHERE image_url IN ({','.join('?' * len(chunk))})",
+            chunk
+        )
+        for r in rows:
+            known[r[0]] = tuple(r[1:])
+
+    metadata = _map_bounded(
+        _read_image_metadata,
+        ((fp, known.get(url), checksums) for url, fp in zip(urls, paths)),
+        max_in_flight=max_in_flight, executor=executor
+    )
+
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(url,) + m for url, m in zip(urls, metadata)
+             if known.get(url) != m]
+        )
+    conn.close()
+
+    return metadata
+
+
+def image_sizes(urls, paths, executor=None, max_in_flight=None):
+    """
+    Get the sizes of a list of images. This uses the image index, unless it is
+    disabled by setting IMAGE_INDEX_PATH to None.
+
+    :param urls:            List of image_url values, as found in the label
+                            set
+    :param paths:           List of paths to the images, in the same order
+    :param executor:        Pool of threads to read the images with, see
+                            _map_bounded()
+    :param max_in_flight:   Maximum number of images that are submitted to
+                            the pool, but not yet collected
+    :returns:               List of (width, height) tuples, in the same order
+                            as urls.
+    """
+    if IMAGE_INDEX_PATH is None:
+        return scan_images(paths, max_in_flight=max_in_flight,
+                           executor=executor)
+
+    return [
+        m[:2] for m in index_images(urls, paths, executor=executor,
+                                    max_in_flight=max_in_flight)
+    ]
+
+
+def _conversion_key(converter, options, sets):
+    """
+    Determine the key of a conversion in the conversion cache. Label sets are
+    identified by their ID, name and version. Which of the sets share the same
+    image folder is part of the key, as are the contents of this file, so
+    changes to the converters do not reuse outputs of earlier versions.
+
+    :param converter:   Name of the conversion
+    :param options:     JSON serializable options that affect the output
+    :param sets:        A list of (label, image) set combinations
+    :returns:           Hex digest identifying the conversion.
+    """
+    label_sets = [find_set(label_id) for label_id in sets[0::2]]
+    image_folders = list(sets[1::2])
+    with open(__file__, 'rb') as f:
+        source = hashlib.sha256(f.read()).hexdigest()
+
+    description = json.dumps({
+        'converter': converter,
+        'options': options,
+        'sets': [[ds.id, ds.name, ds.version] for ds in label_sets],
+        'image_folders': [image_folders.index(f) for f in image_folders],
+        'source': source
+    }, sort_keys=True, default=str)
+    return hashlib.sha256(description.encode()).hexdigest()
+
+
+def _relocate(data, replacements):
+    """
+    Replace a number of strings in a bytes object, longest string first.
+
+    :param data:            The bytes object
+    :param replacements:    List of (old, new) string tuples
+    :returns:               The adjusted bytes object.
+    """
+    for old, new in sorted(replacements, key=lambda x: -len(x[0])):
+        data = data.replace(old.encode(), new.encode())
+    return data
+
+
+def _output_files(outputs):
+    """
+    List the files among a list of files and folders.
+
+    :param outputs:     List of paths to files and folders
+    :returns:           List of paths to files, including all files within the
+                        folders.
+    """
+    files = []
+    for path in outputs:
+        if not os.path.isdir(path):
+            files.append(path)
+            continue
+        for root, _, names in os.walk(path):
+            files += [os.path.join(root, n) for n in sorted(names)]
+    return files
+
+
+def _store_conversion(entry, outputs, result, image_folders):
+    """
+    Store the outputs of a conversion in the conversion cache. The mount
+    points of the image sets are replaced by tokens, as these differ between
+    runs. Next to the outputs, a manifest is stored of their sizes, and of the
+    downscaled images they refer to, see _conversion_intact().
+
+    :param entry:           Folder to store the conversion in
+    :param outputs:         Paths of the files and folders that were written
+    :param result:          Return value of the conversion
+    :param image_folders:   Mount points of the image sets
+    """
+    tokens = [(folder, _IMAGE_FOLDER_TOKEN.format(image_folders.index(folder)))
+              for folder in set(image_folders)]
+    tokens.append((RESIZE_CACHE_DIR, _RESIZE_CACHE_TOKEN))
+
+    # Write to a temporary folder first, so other runs never see an entry
+    # that is not complete
+    tmp = f'{entry}.{os.getpid()}.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    manifest = {}
+    references = set()
+    for path in _output_files(outputs):
+        target = os.path.join(tmp, 'files', path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        manifest[path] = 0
+        # Paths never hold a newline, so files are relocated line by line,
+        # without reading large outputs into memory at once
+        with open(path, 'rb') as src, open(target, 'wb') as dst:
+            for line in src:
+                line = _relocate(line, tokens)
+                dst.write(line)
+                manifest[path] += len(line)
+                references.update(_RESIZE_CACHE_REFERENCE.findall(line))
+
+    stored = _relocate(json.dumps(result).encode(), tokens)
+    references.update(_RESIZE_CACHE_REFERENCE.findall(stored))
+    with open(os.path.join(tmp, 'result.json'), 'wb') as f:
+        f.write(_relocate(json.dumps({
+            'folders': [p for p in outputs if os.path.isdir(p)],
+            'manifest': manifest,
+            'references': sorted(r.decode() for r in references),
+            'result': result
+        }).encode(), tokens))
+
+    try:
+        os.rename(tmp, entry)
+    except OSError:
+        # Another run stored the same conversion in the mean time
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def _restore_tokens(image_folders, resize_cache_dir):
+    """
+    Get the replacements of the tokens in a stored conversion.
+
+    :param image_folders:       Mount points of the image sets in this run
+    :param resize_cache_dir:    Folder holding the downscaled images that the
+                                outputs refer to
+    :returns:                   List of (token, path) tuples.
+    """
+    tokens = [(_IMAGE_FOLDER_TOKEN.format(i), folder)
+              for i, folder in enumerate(image_folders)]
+    tokens.append((_RESIZE_CACHE_TOKEN, resize_cache_dir))
+    return tokens
+
+
+def _read_stored_conversion(entry, image_folders, resize_cache_dir):
+    """
+    Read the description of a conversion in the conversion cache.
+
+    :param entry:               Folder the conversion is stored in
+    :param image_folders:       Mount points of the image sets in this run
+    :param resize_cache_dir:    Folder holding the downscaled images that the
+                                outputs refer to
+    :returns:                   Dictionary with the folders, manifest,
+                                references and result of the conversion.
+    """
+    tokens = _restore_tokens(image_folders, resize_cache_dir)
+    with open(os.path.join(entry, 'result.json'), 'rb') as f:
+        return json.loads(_relocate(f.read(), tokens))
+
+
+def _conversion_intact(entry, image_folders, resize_cache_dir):
+    """
+    Check whether a conversion in the conversion cache can be restored. All
+    files in its manifest need to be present with their stored size, as do
+    the downscaled images they refer to. Those are kept in the resize cache,
+    outside of the entry, and may have been removed since the conversion was
+    stored.
+
+    :param entry:               Folder the conversion is stored in
+    :param image_folders:       Mount points of the image sets in this run
+    :param resize_cache_dir:    Folder holding the downscaled images that the
+                                outputs refer to
+    :returns:                   True if the conversion can be restored.
+    """
+    if not os.path.isdir(entry):
+        return False
+
+    try:
+        stored = _read_stored_conversion(
+            entry, image_folders, resize_cache_dir)
+        files = os.path.join(entry, 'files')
+        intact = all(
+            os.path.getsize(os.path.join(files, path)) == size
+            for path, size in stored['manifest'].items()
+        ) and all(os.path.isfile(path) for path in stored['references'])
+    except (OSError, ValueError, KeyError):
+        intact = False
+
+    if not intact:
+        print(f"Conversion in {entry} is not complete, converting again")
+    return intact
+
+
+def _restore_conversion(entry, image_folders, resize_cache_dir):
+    """
+    Restore the outputs of a conversion from the conversion cache. Check that
+    the conversion is intact with _conversion_intact() first.
+
+    :param entry:               Folder the conversion is stored in
+    :param image_folders:       Mount points of the image sets in this run
+    :param resize_cache_dir:    Folder holding the downscaled images that the
+                                outputs refer to
+    :returns:                   Return value of the conversion.
+    """
+    tokens = _restore_tokens(image_folders, resize_cache_dir)
+    stored = _read_stored_conversion(entry, image_folders, resize_cache_dir)
+    for folder in stored['folders']:
+        os.makedirs(folder, exist_ok=True)
+
+    files = os.path.join(entry, 'files')
+    for path in _output_files([files]):
+        target = os.path.relpath(path, files)
+        if os.path.dirname(target):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+        # Replace the target instead of writing into it, as it may share its
+        # contents with another file
+        partial = f'{target}.{os.getpid()}.partial'
+        with open(path, 'rb') as src, open(partial, 'wb') as dst:
+            for line in src:
+                dst.write(_relocate(line, tokens))
+        os.replace(partial, target)
+
+    return stored['result']
+
+
+def _cached_conversion(converter, options, sets, outputs, convert, *args):
+    """
+    Perform a conversion through the conversion cache. If the same label sets
+    were converted with the same options before, the earlier outputs are
+    restored and the conversion is skipped. Conversions in PREPARED_DIR are
+    used before those in CONVERSION_CACHE_DIR. Images are assumed not to
+    change once they are referred to by a registered label set. Conversions
+    that are not intact, see _conversion_intact(), are converted again.
+
+    :param converter:   Name of the conversion
+    :param options:     JSON serializable options that affect the output
+    :param sets:        A list of (label, image) set combinations
+    :param outputs:     Paths of the files and folders written by convert,
+                        relative to the working directory
+    :param convert:     Function performing the conversion. Its return value
+                        must be JSON serializable
+    :param args:        Arguments to call convert with
+    :returns:           Return value of convert.
+    """
+    if CONVERSION_CACHE_DIR is None and PREPARED_DIR is None:
+        return convert(*args)
+
+    image_folders = list(sets[1::2])
+    key = _conversion_key(converter, options, sets)
+    if PREPARED_DIR is not None:
+        entry = os.path.join(PREPARED_DIR, 'conversions', key)
+        resize_cache_dir = os.path.join(PREPARED_DIR, 'resized')
+        if _conversion_intact(entry, image_folders, resize_cache_dir):
+            print(f"Restoring {converter} conversion from {entry}")
+            return _restore_conversion(
+                entry, image_folders, resize_cache_dir)
+
+    if CONVERSION_CACHE_DIR is None:
+        return convert(*args)
+
+    entry = os.path.join(CONVERSION_CACHE_DIR, key)
+    if _conversion_intact(entry, image_folders, RESIZE_CACHE_DIR):
+        print(f"Restoring {converter} conversion from {entry}")
+        return _restore_conversion(entry, image_folders, RESIZE_CACHE_DIR)
+
+    result = convert(*args)
+    os.makedirs(CONVERSION_CACHE_DIR, exist_ok=True)
+    # An entry that is not intact is replaced
+    shutil.rmtree(entry, ignore_errors=True)
+    _store_conversion(entry, outputs, result, image_folders)
+    return result
+
+
+def load_set_as_txt(name, sets, resize_to=None, resize_format='jpg'):
     """
     Load the datasets. Expects a list of (label, image) set combinations.
 
@@ -93,37 +1033,73 @@ def load_set_as_txt(name, sets):
     are written to outputs/, so they are stored with the run and can be
     inspected at a later time.
 
-    :param name:        Name to give the set output
-    :param sets:        A list of (label, image) set combinations
-    :returns:           Paths to the generated files.
+    If resize_to is provided, the files refer to downscaled copies of the
+    images in the resize cache instead, and the bounding boxes are scaled and
+    rounded to whole pixels to match.
+
+    :param name:            Name to give the set output
+    :param sets:            A list of (label, image) set combinations
+    :param resize_to:       Size of the longest side of the images, or None
+                            to use the original images
+    :param resize_format:   'jpg' or 'npy', see resize_images()
+    :returns:               Paths to the generated files.
+    """
+    filepath = f'outputs/{name}.txt'
+    labelpath = f'outputs/{name}_labels.txt'
+    options = {'name': name}
+    if resize_to is not None:
+        options.update(resize_to=resize_to, resize_format=resize_format)
+
+    return tuple(_cached_conversion(
+        'txt', options, sets, [filepath, labelpath],
+        _convert_set_as_txt, filepath, labelpath, sets, resize_to,
+        resize_format
+    ))
+
+
+def _convert_set_as_txt(filepath, labelpath, sets, resize_to, resize_format):
+    """
+    Convert the datasets to text files, see load_set_as_txt().
+
+    :param filepath:        Path to write the images and their labels to
+    :param labelpath:       Path to write the label names to
+    :param sets:            A list of (label, image) set combinations
+    :param resize_to:       Size of the longest side of the images, or None
+    :param resize_format:   'jpg' or 'npy'
+    :returns:               Paths to the generated files.
     """
     labelset = {}
     rows = []
-    for label_id, image_folder in zip(sets[0::2], sets[1::2]):
-        labels = find_set(label_id)
-
-        for i, l in labels_to_df(labels).iterrows():
-            row = [f"{image_folder}/{DATASTORE_NAME}/{l['image_url']}"]
-            for label_entry in l['label']:
-                # Create new, numbered, entry of label in labelset
-                if label_entry['label'] not in labelset:
-                    labelset[label_entry['label']] = len(labelset)
-
-                row.append(','.join([
-                    str(label_entry['bottomX']),
-                    str(label_entry['bottomY']),
-                    str(label_entry['topX']),
-                    str(label_entry['topY']),
-                    str(labelset[label_entry['label']])
-                ]))
-
-            rows.append(' '.join(row) + '\n')
+    for image_folder, images, boxes, _, _ in load_sets(sets):
+        # Create new, numbered, entries of labels in labelset
+        classes = _assign_classes(boxes['label'], labelset)
+
+        paths = f"{image_folder}/{DATASTORE_NAME}/" + images['image_url']
+        coordinates = [boxes[c] for c in BOX_COORDINATES]
+        if resize_to is not None:
+            resized = resize_images(
+                images['image_url'], paths, resize_to, resize_format)
+            paths = pd.Series([r[0] for r in resized])
+            scales = np.array([r[1:] for r in resized]).reshape(-1, 2)
+            image = boxes['image'].to_numpy()
+            coordinates = [
+                (c * scales[image, i % 2]).round().astype(np.int64)
+                for i, c in enumerate(coordinates)
+            ]
+
+        entries = _format_numbers(coordinates[0]) + ',' + \
+            _format_numbers(coordinates[1]) + ',' + \
+            _format_numbers(coordinates[2]) + ',' + \
+            _format_numbers(coordinates[3]) + ',' + \
+            pd.Series(classes).astype(str)
+        entries = _join_per_image(entries, boxes['image'], len(images), ' ')
+
+        rows += list(
+            paths + entries.where(entries == '', ' ' + entries) + '\n')
 
-    filepath = f'outputs/{name}.txt'
     with open(filepath, 'w') as f:
         f.writelines(rows)
 
-    labelpath = f'outputs/{name}_labels.txt'
     labelset_sorted = sorted(labelset.items(), key=lambda x: x[1])
     with open(labelpath, 'w') as f:
         f.writelines([str(x[0]) + '\n' for x in labelset_sorted])
@@ -146,38 +1122,53 @@ def load_set_as_csv_pbtxt(name, sets, pbtxt=False):
                         labels
     :returns:           Paths to the generated files.
     """
-    labelset = set()
-    rows = [['class', 'filename', 'height', 'width', 'xmax', 'xmin', 'ymax', 'ymin']]
-    for label_id, image_folder in zip(sets[0::2], sets[1::2]):
-        labels = find_set(label_id)
-
-        for i, l in labels_to_df(labels).iterrows():
-            fp = f"{image_folder}/{DATASTORE_NAME}/{l['image_url']}"
-            im = Image.open(fp)
-            width, height = im.size
-
-            for label_entry in l['label']:
-                row = [
-                    label_entry['label'],
-                    fp,
-                    height,
-                    width,
-                    label_entry['topX'],
-                    label_entry['bottomX'],
-                    label_entry['topY'],
-                    label_entry['bottomY']
-                ]
-                labelset.add(label_entry['label'])
-                rows.append(row)
-
     filepath = f'outputs/{name}.csv'
+    labelpath = f'outputs/labelmap.pbtxt'
+    outputs = [filepath, labelpath] if pbtxt else [filepath]
+    return tuple(_cached_conversion(
+        'csv_pbtxt', {'name': name, 'pbtxt': pbtxt}, sets, outputs,
+        _convert_set_as_csv_pbtxt, filepath, labelpath, sets, pbtxt
+    ))
+
+
+def _convert_set_as_csv_pbtxt(filepath, labelpath, sets, pbtxt):
+    """
+    Convert the datasets to a CSV file, and optionally a pbtxt file with
+    labels, see load_set_as_csv_pbtxt().
+
+    :param filepath:    Path to write the CSV file to
+    :param labelpath:   Path to write the pbtxt file to
+    :param sets:        A list of (label, image) set combinations
+    :param pbtxt:       Boolean indicating whether to generate pbtxt file with
+                        labels
+    :returns:           Paths to the generated files.
+    """
+    labelset = {}
+    tables = []
+    for _, images, boxes, paths, sizes in load_sets(sets, _image_path):
+        _assign_classes(boxes['label'], labelset)
+
+        image = boxes['image'].to_numpy()
+        tables.append(pd.DataFrame({
+            'class': boxes['label'],
+            'filename': np.array(paths, dtype=object)[image],
+            'height': sizes[image, 1],
+            'width': sizes[image, 0],
+            'xmax': boxes['topX'],
+            'xmin': boxes['bottomX'],
+            'ymax': boxes['topY'],
+            'ymin': boxes['bottomY']
+        }))
+
+    columns = ['class', 'filename', 'height', 'width', 'xmax', 'xmin', 'ymax',
+               'ymin']
     with open(filepath, 'w') as f:
         w = csv.writer(f)
+        w.writerow(columns)
 
-        for row in rows:
-            w.writerow(row)
+        for t in tables:
+            w.writerows(t[columns].itertuples(index=False, name=None))
 
-    labelpath = f'outputs/labelmap.pbtxt'
     if pbtxt:
         with open(labelpath, 'w') as f:
             out = ""
@@ -226,65 +1217,133 @@ def _calc_bbox_center_fraction(img_width, img_height, topX, bottomX, topY,
     ]
 
 
-def _parse_set_yolov5(set_type, sets, labelset):
+def _materialize_file(src, target, mode):
+    """
+    Place a file at target, by linking or copying it from src. Targets that
+    are already in place, from an earlier, interrupted, attempt, are kept.
+
+    :param src:         Path to the original file
+    :param target:      Path to place the file at
+    :param mode:        'link' or 'copy', see MATERIALIZE_MODE
+    :returns:           'existing', 'hardlink', 'symlink' or 'copy', depending
+                        on what was done.
     """
-    Parse a set of sets to move images in the correct folder and create label
-    files for yolov5.
+    src = os.path.abspath(src)
+    if os.path.lexists(target):
+        # A dangling symlink is not in place, os.path.exists follows links
+        if os.path.exists(target) and \
+                os.path.getsize(target) == os.path.getsize(src):
+            return 'existing'
+        os.remove(target)
+
+    if mode == 'link':
+        try:
+            target_dir = os.path.dirname(os.path.abspath(target))
+            if os.stat(src).st_dev == os.stat(target_dir).st_dev:
+                os.link(src, target)
+                return 'hardlink'
+            os.symlink(src, target)
+            return 'symlink'
+        except OSError:
+            pass
+
+    # Copy to a temporary name first, so an interrupted copy is not mistaken
+    # for a complete one when resuming
+    partial = target + '.partial'
+    shutil.copyfile(src, partial)
+    os.replace(partial, target)
+    return 'copy'
+
+
+def _yolov5_image_path(image_folder, url):
+    """
+    Get the path to an image in a mounted image set, for yolov5.
+
+    :param image_folder:    Mount point of the image set
+    :param url:             image_url of the image, as found in the label set
+    :returns:               Path to the image.
+    """
+    return f"{image_folder}/{url}"
+
+
+def _parse_set_yolov5(set_type, loaded_sets, labelset, placements,
+                      resize_to=None):
+    """
+    Parse a set of sets to create label files for yolov5, and determine where
+    to place the images.
 
     :param set_type:        The type of set (train or test)
-    :param sets:            A list of (label, image) set combinations
+    :param loaded_sets:     A list of loaded (label, image) set combinations,
+                            as returned by load_sets()
     :param labelset:        Dict containing the labels and their int-based ID
+    :param placements:      List to which (image path, target path) tuples
+                            are added, for the images to place in the correct
+                            folder
+    :param resize_to:       Size of the longest side of the images, or None
+                            to use the original images
     :returns:               The adjusted labelset.
     """
+    os.makedirs(f'data/{set_type}/images', exist_ok=True)
+    os.makedirs(f'data/{set_type}/labels', exist_ok=True)
+
     # Build train set
-    for label_id, image_folder in zip(sets[0::2], sets[1::2]):
-        labels = find_set(label_id)
+    for _, images, boxes, paths, sizes in loaded_sets:
+        # Create new, numbered, entries of labels in labelset
+        classes = _assign_classes(boxes['label'], labelset)
+
+        image = boxes['image'].to_numpy()
+        rows = pd.Series(classes).astype(str)
+        for x in _calc_bbox_center_fraction(
+                sizes[image, 0],
+                sizes[image, 1],
+                boxes['topX'].to_numpy(),
+                boxes['bottomX'].to_numpy(),
+                boxes['topY'].to_numpy(),
+                boxes['bottomY'].to_numpy()):
+            rows = rows + ' ' + pd.Series(x).astype(str)
+        rows = _join_per_image(rows + '\n', image, len(images), '')
 
-        for i, l in labels_to_df(labels).iterrows():
-            fp = f"{image_folder}/{l['image_url']}"
-            im = Image.open(fp)
-            width, height = im.size
+        # Labels are fractions of the image size, so they do not change when
+        # using downscaled copies
+        if resize_to is not None:
+            paths = [
+                r[0] for r in resize_images(images['image_url'], paths,
+                                            resize_to)
+            ]
 
-            # Copy file into correct folder
-            img_url = l['image_url'].replace('/', '_')
+        for url, fp, label_rows in zip(images['image_url'], paths, rows):
+            img_url = url.replace('/', '_')
             target = f'data/{set_type}/images/{img_url}'
             label_target = f'data/{set_type}/labels/' + \
                 '.'.join(img_url.split('.')[:-1] + ['txt'])
-            os.makedirs(os.path.dirname(target), exist_ok=True)
-            os.makedirs(os.path.dirname(label_target), exist_ok=True)
-            shutil.copy(fp, target)
+            placements.append((fp, target))
 
             with open(label_target, 'w') as f:
-                for label_entry in l['label']:
-                    # Create new, numbered, entry of label in labelset
-                    if label_entry['label'] not in labelset:
-                        labelset[label_entry['label']] = len(labelset)
-
-                    row = [str(labelset[label_entry['label']])] + \
-                        [str(x) for x in _calc_bbox_center_fraction(
-                            width,
-                            height,
-                            label_entry['topX'],
-                            label_entry['bottomX'],
-                            label_entry['topY'],
-                            label_entry['bottomY']
-                        )]
-                    f.write(' '.join(row) + '\n')
+                f.write(label_rows)
 
     return labelset
 
 
-def load_datasets_for_yolo_v5(train_sets, test_sets):
+def load_datasets_for_yolo_v5(train_sets, test_sets, mode=None,
+                              resize_to=None):
     """
     Load the datasets. Expects a list of (label, image) set combinations.
 
     This version writes the output to CSV files, as expected by the yolo v5
-    model. It moves the images all into /train/images and /test/images
+    model. It places the images all into /train/images and /test/images
     locations, and generates a label .txt file per image in /train/labels and
     /test/labels. It then creates a yaml file pointing to these files.
 
+    By default the images are linked from the mounted datasets rather than
+    copied, see MATERIALIZE_MODE. If resize_to is provided, downscaled JPEG
+    copies of the images from the resize cache are used instead.
+
     :param train_sets:  A list of (label, image) set combinations
     :param test_sets:   A list of (label, image) set combinations
+    :param mode:        How to place the images, 'link' or 'copy'. Defaults
+                        to MATERIALIZE_MODE
+    :param resize_to:   Size of the longest side of the images, or None to use
+                        the original images
     :returns:           Path to the generated yaml file.
     """
     # Prepare dirs
@@ -292,10 +1351,53 @@ def load_datasets_for_yolo_v5(train_sets, test_sets):
     os.makedirs('outputs/data/train/labels', exist_ok=True)
     os.makedirs('outputs/data/test/images', exist_ok=True)
     os.makedirs('outputs/data/test/labels', exist_ok=True)
+
+    # The label files are restored from the conversion cache if possible, the
+    # images are placed again in every run
+    outputs = ['data/train/labels', 'data/test/labels',
+               'outputs/data/dataset.yaml']
+    options = {'num_train_sets': len(train_sets) // 2}
+    if resize_to is not None:
+        options['resize_to'] = resize_to
+
+    placements = _cached_conversion(
+        'yolov5', options, train_sets + test_sets, outputs,
+        _convert_sets_yolov5, train_sets, test_sets, resize_to
+    )
+
+    # Link or copy the images into the correct folder
+    os.makedirs('data/train/images', exist_ok=True)
+    os.makedirs('data/test/images', exist_ok=True)
+    _map_bounded(
+        _materialize_file,
+        ((fp, target, mode or MATERIALIZE_MODE) for fp, target in placements)
+    )
+
+    return 'outputs/data/dataset.yaml'
+
+
+def _convert_sets_yolov5(train_sets, test_sets, resize_to):
+    """
+    Create the label files and yaml file for yolov5, see
+    load_datasets_for_yolo_v5().
+
+    :param train_sets:  A list of (label, image) set combinations
+    :param test_sets:   A list of (label, image) set combinations
+    :param resize_to:   Size of the longest side of the images, or None
+    :returns:           List of (image path, target path) tuples, for the
+                        images to place in the correct folder.
+    """
     labelset = {}
+    placements = []
 
-    labelset = _parse_set_yolov5("train", train_sets, labelset)
-    labelset = _parse_set_yolov5("test", test_sets, labelset)
+    # Load the train and test sets at the same time
+    loaded_sets = load_sets(train_sets + test_sets, _yolov5_image_path)
+    num_train = len(train_sets) // 2
+
+    labelset = _parse_set_yolov5(
+        "train", loaded_sets[:num_train], labelset, placements, resize_to)
+    labelset = _parse_set_yolov5(
+        "test", loaded_sets[num_train:], labelset, placements, resize_to)
 
     labelset_sorted = sorted(labelset.items(), key=lambda x: x[1])
 
@@ -308,4 +1410,4 @@ def load_datasets_for_yolo_v5(train_sets, test_sets):
         f.write('\n')
         f.write(f'names: {[x[0] for x in labelset_sorted]}')
 
-    return 'outputs/data/dataset.yaml'
+    return placements
@@ -25,7 +25,7 @@
 # that is used to register statistics about the model, both parameters and
 # performance metrics.
 from azureml.core import Run
-from utils import load_args, find_set, load_set_as_txt
+from utils import load_args, find_set, load_set_as_txt, finish_preparation
 import argparse
 import logging
 
@@ -51,6 +51,9 @@ if __name__ == "__main__":
     train_set, train_labels = load_set_as_txt('train', parameters.train_sets)
     test_set, test_labels = load_set_as_txt('test', parameters.test_sets)
 
+    # Stop here if this run only prepares the datasets
+    finish_preparation(parameters)
+
     # TODO: This is an example, adjust as required:
     regularization_rate = parameters.regularization_rate
 
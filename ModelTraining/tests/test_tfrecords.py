@@ -0,0 +1,103 @@
+import importlib.util
+import os
+
+import pytest
+
+pytest.importorskip('azureml.core')
+tf = pytest.importorskip('tensorflow')
+Image = pytest.importorskip('PIL.Image')
+pd = pytest.importorskip('pandas')
+
+_spec = importlib.util.spec_from_file_location(
+    'tf_utils',
+    os.path.join(os.path.dirname(__file__), '..', 'examples', 'tensorflow',
+                 'utils.py')
+)
+tf_utils = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(tf_utils)
+
+
+class LabelSet(object):
+    """
+    Stand-in for a version of a TabularDataset, with one plastic box per
+    image.
+    """
+    def __init__(self, version, urls):
+        self.id = f'labels-{version}'
+        self.name = 'labels'
+        self.version = version
+        self.urls = urls
+
+    def to_pandas_dataframe(self):
+        return pd.DataFrame({
+            'image_url': self.urls,
+            'label': [repr([{'label': 'plastic', 'bottomX': 1, 'bottomY': 2,
+                             'topX': 5, 'topY': 6}])] * len(self.urls)
+        })
+
+
+def record_urls(path):
+    urls = []
+    for record in tf.data.TFRecordDataset(path):
+        example = tf.train.Example.FromString(record.numpy())
+        feature = example.features.feature['image/filename']
+        urls.append(feature.bytes_list.value[0].decode())
+    return urls
+
+
+@pytest.fixture
+def converter(tmp_path, monkeypatch):
+    images = tmp_path / 'images'
+    images.mkdir()
+    for i in range(3):
+        Image.new('RGB', (16 + i, 12)).save(images / f'{i}.jpg')
+
+    label_sets = {
+        'labels-1': LabelSet(1, ['0.jpg', '1.jpg']),
+        'labels-2': LabelSet(2, ['0.jpg', '1.jpg', '2.jpg']),
+    }
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(tf_utils, 'find_set', label_sets.get)
+    monkeypatch.setattr(tf_utils, 'CACHE_DIR', str(tmp_path / 'cache'))
+    for name in ['IMAGE_INDEX_PATH', 'CONVERSION_CACHE_DIR',
+                 'EXAMPLE_CACHE_DIR']:
+        monkeypatch.setattr(tf_utils, name, str(tmp_path / 'cache' / name))
+
+    encoded = []
+    create_tf_example = tf_utils.create_tf_example
+
+    def counting_create_tf_example(path, image_url, *args):
+        encoded.append(image_url)
+        return create_tf_example(path, image_url, *args)
+
+    monkeypatch.setattr(
+        tf_utils, 'create_tf_example', counting_create_tf_example)
+
+    def convert(label_id):
+        encoded.clear()
+        path = tf_utils.save_set_as_tfrecords(
+            'train', [label_id, str(images)], 'annotations')
+        return path, list(encoded)
+
+    return convert
+
+
+def test_new_label_set_version_only_encodes_new_images(converter):
+    path, encoded = converter('labels-1')
+    assert record_urls(path) == ['0.jpg', '1.jpg']
+    assert encoded == ['0.jpg', '1.jpg']
+
+    path, encoded = converter('labels-2')
+    assert record_urls(path) == ['0.jpg', '1.jpg', '2.jpg']
+    assert encoded == ['2.jpg']
+
+
+def test_cached_records_are_not_overwritten(converter):
+    converter('labels-1')
+    converter('labels-2')
+
+    # Writing the records of version 2 to the same path must leave the
+    # stored records of version 1 as they were
+    path, encoded = converter('labels-1')
+    assert encoded == []
+    assert record_urls(path) == ['0.jpg', '1.jpg']
@@ -0,0 +1,159 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('azureml.core')
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), '..', 'skeleton_files'))
+import utils  # noqa: E402
+
+pd = pytest.importorskip('pandas')
+
+
+class LabelSet(object):
+    """
+    Stand-in for a TabularDataset, holding label column values as they are
+    stored by the label API: the repr() of a list of boxes.
+    """
+    def __init__(self, labels, urls=None):
+        self.labels = labels
+        self.urls = urls or [f'{i}.jpg' for i in range(len(labels))]
+
+    def to_pandas_dataframe(self):
+        return pd.DataFrame({
+            'image_url': self.urls,
+            'label': [repr(boxes) for boxes in self.labels]
+        })
+
+
+def box(label, x):
+    return {'label': label, 'bottomX': x, 'bottomY': 1, 'topX': x + 10,
+            'topY': 11}
+
+
+def test_load_labels_falls_back_to_evaluating_rows():
+    labels = [
+        [box('plastic', 0), box('net', 1)],
+        [box('bottle {cap}', 2), box('crate', 3)],
+        [],
+        [box("it's \"quoted\"", 4)],
+        [box('open {', 5), box("buoy's", 6)],
+        [box('wood', 7)],
+    ]
+    images, boxes = utils.load_labels(LabelSet(labels))
+
+    expected = [
+        (image, b['label'], b['bottomX'])
+        for image, row in enumerate(labels) for b in row
+    ]
+    assert list(images['image_url']) == [f'{i}.jpg' for i in range(6)]
+    assert list(zip(boxes['image'], boxes['label'], boxes['bottomX'])) == \
+        expected
+    assert list(boxes['topY']) == [11] * len(expected)
+
+
+def test_load_labels_reports_invalid_rows():
+    dataset = LabelSet([[box('plastic', 0)], [box('net', 1)]])
+    df = dataset.to_pandas_dataframe()
+    df.loc[1, 'label'] = "[{'label': 'net', 'bottomX': 1"
+    dataset.to_pandas_dataframe = lambda: df
+
+    with pytest.raises(ValueError, match='1.jpg'):
+        utils.load_labels(dataset)
+
+
+def test_cached_conversion_converts_again_if_resized_images_are_gone(
+        tmp_path, monkeypatch):
+    resized = tmp_path / 'resized' / '64' / (32 * 'a' + '.jpg')
+    resized.parent.mkdir(parents=True)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(utils, 'RESIZE_CACHE_DIR', str(tmp_path / 'resized'))
+    monkeypatch.setattr(
+        utils, 'CONVERSION_CACHE_DIR', str(tmp_path / 'conversions'))
+    monkeypatch.setattr(utils, 'PREPARED_DIR', None)
+    monkeypatch.setattr(utils, '_conversion_key', lambda *args: 'key')
+
+    calls = []
+
+    def convert():
+        calls.append(True)
+        resized.write_bytes(b'jpeg')
+        with open('train.txt', 'w') as f:
+            f.write(f'{resized} 1,1,2,2,0\n')
+        return len(calls)
+
+    def cached():
+        return utils._cached_conversion(
+            'txt', {}, ['labels', 'images'], ['train.txt'], convert)
+
+    assert cached() == 1
+    assert cached() == 1
+    assert (tmp_path / 'train.txt').read_text().startswith(str(resized))
+
+    resized.unlink()
+    assert cached() == 2
+    assert cached() == 2
+    assert len(calls) == 2
+
+
+def test_load_labels_without_boxes():
+    images, boxes = utils.load_labels(LabelSet([[], None]))
+
+    assert list(images['image_url']) == ['0.jpg', '1.jpg']
+    assert len(boxes) == 0
+    assert list(boxes.columns) == ['image', 'label'] + utils.BOX_COORDINATES
+
+
+def test_load_labels_with_empty_rows():
+    labels = [[], [box('plastic', 0)], [], [box('net', 1), box('rope', 2)]]
+    images, boxes = utils.load_labels(LabelSet(labels))
+
+    assert len(images) == 4
+    assert list(zip(boxes['image'], boxes['label'])) == \
+        [(1, 'plastic'), (3, 'net'), (3, 'rope')]
+
+
+def test_load_sets_shares_one_pool_of_scan_workers(tmp_path, monkeypatch):
+    Image = pytest.importorskip('PIL.Image')
+    label_sets = {}
+    for s in range(4):
+        folder = tmp_path / f'images{s}'
+        folder.mkdir()
+        for i in range(6):
+            Image.new('RGB', (8, 8)).save(folder / f'{s}-{i}.jpg')
+        label_sets[f'labels{s}'] = LabelSet(
+            [[box('plastic', 0)]] * 6, [f'{s}-{i}.jpg' for i in range(6)])
+
+    running = []
+    most = []
+    lock = threading.Lock()
+    read_image_metadata = utils._read_image_metadata
+
+    def slow_read_image_metadata(*args):
+        with lock:
+            running.append(True)
+            most.append(len(running))
+        time.sleep(0.01)
+        with lock:
+            running.pop()
+        return read_image_metadata(*args)
+
+    monkeypatch.setattr(utils, 'find_set', label_sets.get)
+    monkeypatch.setattr(
+        utils, '_read_image_metadata', slow_read_image_metadata)
+    monkeypatch.setattr(
+        utils, 'IMAGE_INDEX_PATH', str(tmp_path / 'index.sqlite'))
+    monkeypatch.setattr(utils, 'SCAN_WORKERS', 3)
+
+    sets = []
+    for s in range(4):
+        sets += [f'labels{s}', str(tmp_path / f'images{s}')]
+    loaded = utils.load_sets(
+        sets, lambda folder, url: f'{folder}/{url}', workers=4)
+
+    assert [len(sizes) for _, _, _, _, sizes in loaded] == [6] * 4
+    assert max(most) <= 3
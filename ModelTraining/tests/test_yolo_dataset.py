@@ -0,0 +1,58 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')
+pytest.importorskip('cv2')
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(__file__), '..', 'examples', 'yolo', 'Tensorflow_YOLO'))
+from yolov3 import dataset as yolo_dataset  # noqa: E402
+
+
+def sample_dataset(num_samples=12, batch_size=3):
+    """
+    A Dataset without annotation file, of which every sample is an image
+    filled with its index.
+    """
+    dataset = yolo_dataset.Dataset.__new__(yolo_dataset.Dataset)
+    dataset.input_sizes = 32
+    dataset.batch_size = batch_size
+    dataset.num_samples = num_samples
+    dataset.num_batchs = int(np.ceil(num_samples / batch_size))
+    dataset.strides = np.array([8, 16, 32])
+    dataset.train_output_sizes = dataset.input_sizes // dataset.strides
+    dataset.anchor_per_scale = 3
+    dataset.num_classes = 1
+    dataset.max_bbox_per_scale = 4
+    dataset.loader = None
+    dataset.tf_batches = None
+
+    def load_sample(index, seed):
+        image = np.full((32, 32, 3), index, np.float32)
+        labels = [np.zeros((size, size, 3, 6), np.float32)
+                  for size in dataset.train_output_sizes]
+        bboxes = [np.zeros((4, 4), np.float32)] * 3
+        return [image] + labels + bboxes
+
+    dataset.load_sample = load_sample
+    return dataset
+
+
+def epoch_order(dataset):
+    return [int(i) for image, _ in dataset for i in image[:, 0, 0, 0]]
+
+
+def test_tf_data_epochs_are_shuffled_differently(monkeypatch):
+    monkeypatch.setattr(yolo_dataset, 'TRAIN_TF_DATA', True)
+    monkeypatch.setattr(yolo_dataset, 'TRAIN_DATA_WORKERS', 0)
+    dataset = sample_dataset()
+
+    first = epoch_order(dataset)
+    second = epoch_order(dataset)
+
+    assert sorted(first) == list(range(dataset.num_samples))
+    assert sorted(second) == list(range(dataset.num_samples))
+    assert first != second
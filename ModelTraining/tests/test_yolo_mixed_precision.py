@@ -0,0 +1,65 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+pytest.importorskip('cv2')
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(__file__), '..', 'examples', 'yolo', 'Tensorflow_YOLO'))
+from yolov3 import yolov4  # noqa: E402
+
+INPUT_SIZE = 64
+
+
+@pytest.fixture
+def mixed_bfloat16():
+    yolov4.mixed_precision_policy('mixed_bfloat16')
+    yield
+    yolov4.mixed_precision_policy('float32')
+
+
+def targets(yolo, batch_size, num_classes):
+    """
+    Labels and boxes of each scale, with one box of class 0 in the middle of
+    every image.
+    """
+    result = []
+    for pred in yolo.outputs[1::2]:
+        size = pred.shape[1]
+        label = np.zeros((batch_size, size, size, 3, 5 + num_classes),
+                         np.float32)
+        label[:, size // 2, size // 2, 0, :6] = [32, 32, 16, 16, 1, 1]
+        bboxes = np.zeros((batch_size, 4, 4), np.float32)
+        bboxes[:, 0] = [32, 32, 16, 16]
+        result.append((label, bboxes))
+    return result
+
+
+def test_train_step_under_mixed_bfloat16(tmp_path, mixed_bfloat16):
+    classes = tmp_path / 'classes.names'
+    classes.write_text('plastic\nnet\n')
+    yolo = yolov4.Create_Yolo(
+        input_size=INPUT_SIZE, training=True, CLASSES=str(classes))
+    optimizer = tf.keras.optimizers.Adam(1e-3)
+    images = np.random.rand(2, INPUT_SIZE, INPUT_SIZE, 3).astype(np.float32)
+    target = targets(yolo, 2, 2)
+
+    with tf.GradientTape() as tape:
+        pred_result = yolo(images, training=True)
+        total_loss = 0
+        for i, (label, bboxes) in enumerate(target):
+            conv, pred = pred_result[i * 2], pred_result[i * 2 + 1]
+            total_loss += sum(yolov4.compute_loss(
+                pred, conv, label, bboxes, i, CLASSES=str(classes)))
+    gradients = tape.gradient(total_loss, yolo.trainable_variables)
+    optimizer.apply_gradients(zip(gradients, yolo.trainable_variables))
+
+    # The layers compute in bfloat16, but the outputs and the loss are float32
+    assert yolo.layers[1].compute_dtype == 'bfloat16'
+    assert all(output.dtype == tf.float32 for output in pred_result)
+    assert total_loss.dtype == tf.float32
+    assert np.isfinite(total_loss.numpy())
+    assert all(gradient is not None for gradient in gradients)
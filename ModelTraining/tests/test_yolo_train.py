@@ -0,0 +1,65 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+pytest.importorskip('cv2')
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(__file__), '..', 'examples', 'yolo'))
+from Tensorflow_YOLO import train  # noqa: E402
+
+INPUT_SIZE = 64
+BATCH_SIZE = 2
+
+
+def sample_batch(yolo, num_classes):
+    """
+    A batch of random images, with the labels and boxes of each scale, for
+    one box of class 0 in the middle of every image.
+    """
+    images = np.random.rand(
+        BATCH_SIZE, INPUT_SIZE, INPUT_SIZE, 3).astype(np.float32)
+    target = []
+    for pred in yolo.outputs[1::2]:
+        size = pred.shape[1]
+        label = np.zeros((BATCH_SIZE, size, size, 3, 5 + num_classes),
+                         np.float32)
+        label[:, size // 2, size // 2, 0, :6] = [32, 32, 16, 16, 1, 1]
+        bboxes = np.zeros((BATCH_SIZE, 4, 4), np.float32)
+        bboxes[:, 0] = [32, 32, 16, 16]
+        target.append((label, bboxes))
+    return images, target
+
+
+def test_train_steps_with_two_steps_per_call(tmp_path, monkeypatch):
+    classes = tmp_path / 'classes.names'
+    classes.write_text('plastic\nnet\n')
+    monkeypatch.setattr(train, 'TRAIN_CLASSES', str(classes))
+    monkeypatch.setattr(train, 'TRAIN_STEPS_PER_CALL', 2)
+
+    yolo = train.Create_Yolo(
+        input_size=INPUT_SIZE, training=True, CLASSES=str(classes))
+    lr_schedule = train.WarmupCosineDecay(1e-3, 1e-6, 2, 10)
+    optimizer = tf.keras.optimizers.Adam(learning_rate=lr_schedule)
+    global_steps = tf.Variable(1, trainable=False, dtype=tf.int64)
+    writer = tf.summary.create_file_writer(str(tmp_path / 'log'))
+    train_steps = train.create_train_steps(
+        yolo, optimizer, lr_schedule, global_steps, writer)
+
+    # Three batches are run as one call of two steps, and one of one step
+    batches = [sample_batch(yolo, 2) for _ in range(3)]
+    calls = []
+    for images, targets in train.grouped_batches(
+            batches, train.TRAIN_STEPS_PER_CALL):
+        assert images.shape[1:] == (BATCH_SIZE, INPUT_SIZE, INPUT_SIZE, 3)
+        calls.append([result.numpy() for result in train_steps(
+            images, targets)])
+
+    assert [int(results[0]) for results in calls] == [3, 4]
+    assert int(optimizer.iterations.numpy()) == 3
+    for results in calls:
+        assert np.all(np.isfinite(results[1:]))
+        assert np.isclose(results[5], sum(results[2:5]), rtol=1e-4)
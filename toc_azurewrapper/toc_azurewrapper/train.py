@@ -25,9 +25,14 @@ def create_experiment(workspace, experiment_name):
     return Experiment(workspace=workspace, name=experiment_name)
 
 
-def _create_args(trainsets=[], testsets=[], parameters={}):
+def _create_args(trainsets=[], testsets=[], parameters={}, prepared=None):
     args = []
 
+    # Datasets prepared by an earlier run, see prepare_datasets()
+    if prepared is not None:
+        args.append("--prepared")
+        args.append(prepared.as_named_input('prepared').as_mount())
+
     args.append("--train_sets")
     for i, (labels, images) in enumerate(trainsets):
         lab = labels.as_named_input(f'train_labels_{str(i)}')
@@ -51,13 +56,13 @@ def _create_args(trainsets=[], testsets=[], parameters={}):
 
 def perform_run(experiment, script, source_directory, environment=None,
         compute_target=None, trainsets=[], testsets=[], parameters={},
-        distributed_job_config=None):
+        distributed_job_config=None, prepared=None):
 
     if environment is None:
         environment = Environment("user-managed-env")
         environment.python.user_managed_dependencies = True
 
-    args = _create_args(trainsets, testsets, parameters)
+    args = _create_args(trainsets, testsets, parameters, prepared)
 
     # No compute target is provided, hence the Run is performed locally
     src = ScriptRunConfig(
@@ -71,3 +76,50 @@ def perform_run(experiment, script, source_directory, environment=None,
 
     run = experiment.submit(config=src)
     return run
+
+
+def prepare_datasets(experiment, script, source_directory, name,
+        environment=None, compute_target=None, trainsets=[], testsets=[],
+        parameters={}):
+    """
+    Perform a run that only converts the datasets, in the same way the train
+    script would, and registers the result as File Dataset under the given
+    name. Pass that dataset as prepared to perform_run() to skip the
+    conversion in the training run. The train script must call
+    finish_preparation() from utils after loading the datasets.
+
+    The prepared dataset only applies to runs with the same train script
+    source, and the same train- and testsets and parameters that affect the
+    conversion. Other runs convert the datasets themselves, as usual.
+
+    :param experiment:          The experiment to perform the run in.
+    :param script:              The train script to run.
+    :param source_directory:    Directory holding the train script and utils.
+    :param name:                Name to register the prepared dataset under.
+                                Every preparation adds a new version.
+    :param environment:         Environment to run in, see perform_run().
+    :param compute_target:      Compute target to run on. The preparation does
+                                not need a GPU.
+    :param trainsets:           List of (labels, images) tuples.
+    :param testsets:            List of (labels, images) tuples.
+    :param parameters:          Parameters to the train script.
+    :returns:                   The submitted Run object.
+    """
+    parameters = dict(parameters, prepare_as=name)
+    return perform_run(
+        experiment, script, source_directory, environment=environment,
+        compute_target=compute_target, trainsets=trainsets, testsets=testsets,
+        parameters=parameters
+    )
+
+
+def get_prepared_dataset(workspace, name, version='latest'):
+    """
+    Get a dataset registered by prepare_datasets().
+
+    :param workspace:   The Azure ML workspace to use.
+    :param name:        Name the dataset was registered under.
+    :param version:     Version of the dataset, defaults to the latest.
+    :returns:           A FileDataset object.
+    """
+    return Dataset.get_by_name(workspace, name, version=version)